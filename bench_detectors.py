@@ -0,0 +1,122 @@
+"""
+speed and agreement of the face detectors in detectors.py, to pick the one a board can run
+
+runs every available backend over the frames in a directory (JPEG/PNG, sorted by name) scaled down
+to every --size, --batch frames per detect() call, and reports per backend and size: ms per frame,
+frames per second, faces per frame and the agreement with the --reference backend at the first
+size. boxes are compared in frame pixels and agree at IoU >= --iou, the agreement is the F1 score
+2 * agreeing boxes / (boxes + reference boxes) over all frames, 1.0 when both find the same faces.
+
+python bench_detectors.py --frames ~/doorbell --size 320x240 640x480
+python bench_detectors.py --frames ~/doorbell --backends haar lbp --reference haar --batch 8
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import cv2
+
+import detectors
+import tracking
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def load_frames(directory: str, limit: int):
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_SUFFIXES))[:limit]
+    frames = [cv2.imread(os.path.join(directory, name)) for name in names]
+    return [frame for frame in frames if frame is not None]
+
+
+def parse_size(text: str):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def run(detector, frames, size, batch: int):
+    """(seconds, [(boxes, scores)] in frame pixels), only detect() is timed
+    """
+    images, scales = [], []
+    for frame in frames:
+        height, width = frame.shape[:2]
+        scale = min(1.0, size[0] / width, size[1] / height)
+        images.append(cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+                      if scale < 1.0 else frame)
+        scales.append(scale)
+    detector.detect(images[:batch])  # warm up, lazy initialisation inside the library
+    found = []
+    start = time.perf_counter()
+    for index in range(0, len(images), batch):
+        found.extend(detector.detect(images[index:index + batch]))
+    seconds = time.perf_counter() - start
+    return seconds, [(boxes / scale, scores) for (boxes, scores), scale in zip(found, scales)]
+
+
+def agreeing(boxes, reference, threshold: float) -> int:
+    """boxes matched one to one with a reference box of IoU >= threshold, best overlap first
+    """
+    if not len(boxes) or not len(reference):
+        return 0
+    overlap = tracking.iou(boxes, reference)
+    matched = 0
+    while True:
+        row, column = np.unravel_index(np.argmax(overlap), overlap.shape)
+        if overlap[row, column] < threshold:
+            return matched
+        matched += 1
+        overlap[row, :] = 0
+        overlap[:, column] = 0
+
+
+def agreement(found, reference, threshold: float) -> float:
+    boxes = sum(len(boxes) for boxes, _ in found) + sum(len(boxes) for boxes, _ in reference)
+    if not boxes:
+        return 1.0
+    return 2 * sum(agreeing(a, b, threshold) for (a, _), (b, _) in zip(found, reference)) / boxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', required=True, help='directory of JPEG/PNG frames')
+    parser.add_argument('--limit', type=int, default=200, help='frames read from --frames')
+    parser.add_argument('--size', nargs='+', default=['320x240'], help='WIDTHxHEIGHT, frames are scaled down to fit')
+    parser.add_argument('--backends', nargs='+', default=list(detectors.BACKENDS), help='default: every one that is available')
+    parser.add_argument('--reference', help='default: the first backend that runs')
+    parser.add_argument('--batch', type=int, default=1, help='frames per detect() call')
+    parser.add_argument('--iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, args.limit)
+    if not frames:
+        parser.error(f'no frames in {args.frames}')
+    sizes = [parse_size(size) for size in args.size]
+    missing = detectors.available()
+    backends = []
+    for name in args.backends:
+        if missing.get(name, 'unknown detector'):
+            print(f'{name}: skipped, {missing.get(name, "unknown detector")}')
+        else:
+            backends.append(name)
+    reference = args.reference or (backends[0] if backends else None)
+    print(f'{len(frames)} frames of {frames[0].shape[1]}x{frames[0].shape[0]}, batch {args.batch}, reference {reference} '
+          f'at {sizes[0][0]}x{sizes[0][1]}')
+    if reference not in backends:
+        print(f'reference {reference} is not available')
+        return
+
+    results = {}
+    for name in [reference] + [name for name in backends if name != reference]:
+        detector = detectors.create(name)
+        for size in sizes:
+            results[name, size] = run(detector, frames, size, args.batch)
+    reference_found = results[reference, sizes[0]][1]
+    print(f'{"backend":18} {"size":>9} {"ms/frame":>9} {"frames/s":>9} {"faces/frame":>12} {"agreement":>10}')
+    for (name, size), (seconds, found) in results.items():
+        faces = sum(len(boxes) for boxes, _ in found) / len(frames)
+        print(f'{name:18} {size[0]:>4}x{size[1]:<4} {seconds / len(frames) * 1000:9.2f} {len(frames) / seconds:9.1f} '
+              f'{faces:12.2f} {agreement(found, reference_found, args.iou):10.2f}')
+
+
+if __name__ == '__main__':
+    main()
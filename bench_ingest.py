@@ -0,0 +1,214 @@
+"""
+compare the StreamReader ingest (handle_cam) with ingest.FrameIngestProtocol
+
+no sockets involved, both paths get the same frames cut into recv sized chunks:
+- StreamReader: the transport allocates a bytes object per recv and calls feed_data
+- FrameIngestProtocol: the transport copies into the buffer returned by get_buffer (recv_into)
+both hand the frame to a session that keeps it like CameraSession.queue_frame does: bytes(payload),
+one copy of the receive buffer on the BufferedProtocol path, none for the bytes of a StreamReader
+
+per frame it reports
+- peak bytes: memory allocated on top of the steady state while handling the frame
+  (tracemalloc), in bytes and in copies of the payload that were alive at the same time
+- allocs: large (>1KB) allocations made for the frame, counted by keeping every object
+  the handler creates alive until the frame is done
+- time: wall time spent in the ingest path, numpy view included
+
+python bench_ingest.py --frames 500 --frame-size 100000
+python bench_ingest.py --decode --width 1280 --height 720  # real JPEGs through cv2.imdecode
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+import numpy as np
+
+import frame_protocol
+import ingest
+
+RECV_SIZE = 1 << 16  # what a socket read typically returns on the Pi
+
+
+def make_payloads(args):
+    if args.decode:
+        import cv2
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (9, 9), 0)  # compressible like a real scene
+        _, buffer = cv2.imencode('.jpg', image)
+        payload = buffer.tobytes()
+    else:
+        payload = np.random.default_rng(0).integers(0, 255, args.frame_size, dtype=np.uint8).tobytes()
+        payload = payload.replace(frame_protocol.FRAME_SEPARATOR, b'')
+    return [payload] * args.frames
+
+
+def consume(data, decode):
+    frame = np.frombuffer(data, dtype=np.uint8)
+    if decode:
+        import cv2
+        cv2.imdecode(frame, -1)
+    return frame
+
+
+class Stats:
+
+    def __init__(self, name, payload_size):
+        self.name = name
+        self.payload_size = payload_size
+        self.allocs = 0
+        self.peak_bytes = []
+        self.seconds = []
+
+    def measure(self, handle_one):
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        handle_one()
+        self.seconds.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+        self.peak_bytes.append(peak - current)
+
+    def report(self):
+        peak = sorted(self.peak_bytes)[len(self.peak_bytes) // 2]
+        seconds = sum(self.seconds) / len(self.seconds)
+        print(f'{self.name:<22} peak bytes/frame {peak:>10}  '
+              f'({peak / self.payload_size:4.1f} payload copies)  '
+              f'allocs/frame {self.allocs:3}  '
+              f'{seconds * 1e6:8.1f} us/frame')
+
+
+def count_allocations(handle_one):
+    """number of large blocks allocated while handling one frame
+
+    tracemalloc only sees live blocks, so handle_one appends every intermediate object
+    to the list it is given and nothing is freed before the second snapshot
+    """
+    gc.collect()
+    keep = []
+    before = tracemalloc.take_snapshot()
+    handle_one(keep)
+    after = tracemalloc.take_snapshot()
+    diff = after.compare_to(before, 'traceback')
+    count = sum(stat.count_diff for stat in diff if stat.count_diff > 0 and stat.size_diff > 1024 * stat.count_diff)
+    del keep
+    return count
+
+
+def wire_for(payload, legacy):
+    """the bytes as they arrive from the socket, built outside the measurement
+    """
+    if legacy:
+        return payload + frame_protocol.FRAME_SEPARATOR
+    header = frame_protocol.make_header(0, time.time(), len(payload))
+    return frame_protocol.pack_header(header) + payload
+
+
+def bench_stream_reader(payloads, decode, legacy):
+    loop = asyncio.new_event_loop()
+    reader = asyncio.StreamReader(limit=1024*1204*8, loop=loop)
+    stats = Stats('StreamReader' + (' legacy' if legacy else ' v1'), len(payloads[0]))
+
+    def handle_one(wire, keep):
+        view = memoryview(wire)
+        for offset in range(0, len(wire), RECV_SIZE):
+            chunk = bytes(view[offset:offset + RECV_SIZE])  # transport: new bytes per recv
+            keep.append(chunk)
+            reader.feed_data(chunk)
+        if legacy:
+            raw_data = loop.run_until_complete(reader.readuntil(frame_protocol.FRAME_SEPARATOR))
+            keep.append(raw_data)
+            raw_data = raw_data[:-frame_protocol.SEPARATOR_LENGTH]  # what handle_cam used to do
+            keep.append(raw_data)
+            raw_data = bytearray(raw_data)
+            keep.append(raw_data)
+            keep.append(np.asarray(raw_data, dtype=np.uint8))
+            keep.append(consume(keep[-1], decode))
+        else:
+            _, raw_data = loop.run_until_complete(frame_protocol.read_frame(reader))
+            keep.append(raw_data)
+            raw_data = bytes(raw_data)  # CameraSession.queue_frame, readexactly returned bytes already: no copy
+            keep.append(consume(raw_data, decode))
+
+    wires = [wire_for(payload, legacy) for payload in payloads]
+    for wire in wires:
+        stats.measure(lambda: handle_one(wire, []))
+    stats.allocs = count_allocations(lambda keep: handle_one(wires[0], keep))
+    loop.close()
+    return stats
+
+
+def bench_protocol(payloads, decode, legacy):
+
+    keep = []
+
+    class Session:
+        def __init__(self, transport, camera_id, version):
+            pass
+
+        def on_frame(self, header, payload):
+            payload = bytes(payload)  # CameraSession.queue_frame: the buffer is reused, the queue keeps a copy
+            keep.append(payload)
+            keep.append(consume(payload, decode))
+
+        def close(self):
+            pass
+
+    class Transport:
+        def get_extra_info(self, name):
+            return ('bench', 0)
+
+        def write(self, data):
+            pass
+
+        def close(self):
+            pass
+
+    protocol = ingest.FrameIngestProtocol(Session)
+    protocol.connection_made(Transport())
+    stats = Stats('BufferedProtocol' + (' legacy' if legacy else ' v1'), len(payloads[0]))
+
+    def feed(wire):
+        view = memoryview(wire)
+        offset = 0
+        while offset < len(wire):
+            buffer = protocol.get_buffer(-1)
+            nbytes = min(len(buffer), RECV_SIZE, len(wire) - offset)
+            buffer[:nbytes] = view[offset:offset + nbytes]  # kernel: recv_into
+            protocol.buffer_updated(nbytes)
+            offset += nbytes
+
+    if not legacy:
+        feed(frame_protocol.pack_hello(frame_protocol.PROTOCOL_VERSION, 'bench'))
+
+    wires = [wire_for(payload, legacy) for payload in payloads]
+    for wire in wires:
+        stats.measure(lambda: feed(wire))
+        del keep[:]  # outside the measurement, like the list of handle_one in bench_stream_reader
+    stats.allocs = count_allocations(lambda _: feed(wires[0]))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--frame-size', type=int, default=100_000, help='payload bytes without --decode')
+    parser.add_argument('--decode', action='store_true', help='decode real JPEGs with cv2.imdecode')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args)
+    print(f'{args.frames} frames of {len(payloads[0])} bytes, recv size {RECV_SIZE}')
+    tracemalloc.start(1)
+    for legacy in (True, False):
+        bench_stream_reader(payloads, args.decode, legacy).report()
+        bench_protocol(payloads, args.decode, legacy).report()
+    tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+load test for the live view (live_http.py)
+
+starts pi_cam_stream_server.py in a child process (one worker, nothing written to disk), streams
+a synthetic camera into it and attaches many MJPEG viewers, some of them deliberately slow.
+every fast viewer should get close to the camera rate, a slow viewer skips frames but does not
+lower the rate of the camera or of the other viewers.
+
+python bench_live.py --viewers 50 --slow 5 --seconds 20
+python bench_live.py --url http://10.0.0.99:8080/camera/pi --viewers 50  # against a running server
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import urllib.parse
+
+import numpy as np
+import cv2
+
+import frame_protocol
+import pi_cam_stream_server
+
+HOST = '127.0.0.1'
+CAMERA_ID = 'bench'
+
+
+def run_server(server_port, live_port):
+    pi_cam_stream_server.SERVER_IP = HOST
+    pi_cam_stream_server.SERVER_PORT = server_port
+    pi_cam_stream_server.LIVE_HTTP_PORT = live_port
+    pi_cam_stream_server.WRITE_VIDEO_TO_FILE = False
+    pi_cam_stream_server.CATALOG_PATH = os.path.join(tempfile.mkdtemp(), 'catalog.sqlite3')
+    pi_cam_stream_server.run_worker(0)
+
+
+async def discard_acks(reader):
+    """a v2 server acknowledges every frame, keep the socket drained
+    """
+    try:
+        while True:
+            await frame_protocol.read_frame_ack(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+async def camera(port, fps, seconds, width, height):
+    """stream the same JPEG with the v1 framing, returns the frames sent
+    """
+    image = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+    jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    version = await frame_protocol.negotiate(reader, writer, camera_id=CAMERA_ID)
+    if version >= frame_protocol.PROTOCOL_ACKS:
+        asyncio.ensure_future(discard_acks(reader))
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        frame_protocol.write_frame(writer, frame_protocol.make_header(sent, time.time(), len(jpeg), width, height), jpeg)
+        await writer.drain()
+        sent += 1
+        await asyncio.sleep(max(0.0, start + sent / fps - time.perf_counter()))
+    writer.close()
+    return sent
+
+
+async def viewer(url, seconds, delay):
+    """read the multipart stream for `seconds`, sleeping `delay` after every frame, returns the frames
+    """
+    parts = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    writer.write(f'GET {parts.path} HTTP/1.0\r\nHost: {parts.netloc}\r\n\r\n'.encode())
+    frames = 0
+    deadline = time.perf_counter() + seconds
+    try:
+        status = await reader.readline()
+        if b' 200 ' not in status:
+            raise RuntimeError(f'{url}: {status.decode().strip()}')
+        while await reader.readline() not in (b'\r\n', b''):
+            pass
+        while time.perf_counter() < deadline:
+            length = None
+            while True:  # part headers
+                line = await asyncio.wait_for(reader.readline(), deadline - time.perf_counter())
+                if line == b'':
+                    return frames
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+                elif line == b'\r\n' and length is not None:
+                    break
+            await reader.readexactly(length + 2)
+            frames += 1
+            if delay:
+                await asyncio.sleep(delay)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+    return frames
+
+
+async def fetch_stats(url):
+    parts = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    writer.write(b'GET /stats HTTP/1.0\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+
+def summary(name, counts, seconds):
+    if not counts:
+        return
+    rates = [count / seconds for count in counts]
+    print(f'{name:<14} {len(counts):4} viewers  fps min {min(rates):6.1f}  mean {sum(rates) / len(rates):6.1f}  max {max(rates):6.1f}')
+
+
+async def bench(args):
+    url = args.url or f'http://{HOST}:{args.live_port}/camera/{CAMERA_ID}'
+    tasks = []
+    if args.url is None:
+        tasks.append(asyncio.ensure_future(camera(args.server_port, args.fps, args.seconds + 2, args.width, args.height)))
+        await asyncio.sleep(1)  # the camera has to be connected before the viewers ask for it
+    fast = [asyncio.ensure_future(viewer(url, args.seconds, 0)) for _ in range(args.viewers - args.slow)]
+    slow = [asyncio.ensure_future(viewer(url, args.seconds, args.slow_delay)) for _ in range(args.slow)]
+    await asyncio.sleep(args.seconds / 2)
+    stats = await fetch_stats(url)  # while every viewer is connected
+    fast_counts = await asyncio.gather(*fast)
+    slow_counts = await asyncio.gather(*slow)
+    if tasks:
+        print(f'camera         {await tasks[0] / (args.seconds + 2):6.1f} fps sent')
+    summary('fast viewers', fast_counts, args.seconds)
+    summary('slow viewers', slow_counts, args.seconds)
+    print(f'server /stats  {stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='stream of a running server, default: start one')
+    parser.add_argument('--viewers', type=int, default=50)
+    parser.add_argument('--slow', type=int, default=5, help='viewers that sleep --slow-delay after every frame')
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--fps', type=float, default=15, help='synthetic camera')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--server-port', type=int, default=18888)
+    parser.add_argument('--live-port', type=int, default=18080)
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        server = multiprocessing.Process(target=run_server, args=(args.server_port, args.live_port), daemon=True)
+        server.start()
+        time.sleep(2)
+    try:
+        asyncio.run(bench(args))
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
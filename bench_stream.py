@@ -0,0 +1,263 @@
+"""
+end-to-end benchmark of pi_cam_stream_server.py on loopback, no camera needed
+
+a server worker runs in a child process with the configuration under test, the benchmark process
+plays `--clients` cameras that send synthetic JPEGs with the same protocol as
+pi_cam_stream_client.py (v2 and later length-prefixed with acks, v1 without, or legacy separator framing).
+--ir makes the scene gray like the night time IR cameras see it, still sent as a BGR JPEG, --gray
+sends that scene as the single channel JPEG of VIDEO_COLOR_GRAY (FLAG_GRAY from --protocol v7 on).
+
+reported per run, also written to --json so runs can be compared across releases:
+- frames/s sent by the clients, accepted by the server, written to disk
+- dropped frames: pipeline drop policy, sequence gaps
+- decode and write (encode + disk) ms per frame, from the pipeline counters
+- CPU of the server process (all threads, 1.0 = one core) and its peak RSS
+- ingest latency p50/p99: capture time in the frame header to arrival in the server,
+  write latency p50/p99: capture time to the VideoWriter/MJPEG write returning
+
+python bench_stream.py --clients 4 --fps 15 --width 1280 --height 720 --seconds 20
+python bench_stream.py --record passthrough --json passthrough.json
+python bench_stream.py --protocol legacy --ingest stream --drop-policy block --json legacy.json
+python bench_stream.py --protocol v7 --ir --json bgr.json && python bench_stream.py --protocol v7 --gray --json gray.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import cv2
+
+import frame_protocol
+import pipeline
+import pi_cam_stream_server
+
+HOST = '127.0.0.1'
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return round(float(np.percentile(values, q)) * 1000, 2)
+
+
+def rss_bytes() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_server(args, save_path, connection):
+    """child process: one server worker, the sessions are measured from the outside
+    """
+    server = pi_cam_stream_server
+    server.SERVER_IP = HOST
+    server.SERVER_PORT = args.port
+    server.LIVE_HTTP_PORT = None
+    server.VIDEO_SAVE_PATH = save_path
+    server.CATALOG_PATH = os.path.join(save_path, 'catalog.sqlite3')
+    server.WRITE_VIDEO_TO_FILE = args.record != 'none'
+    if args.record != 'none':
+        server.RECORD_MODE = args.record
+    server.ZERO_COPY_INGEST = args.ingest == 'zero-copy'
+    server.DROP_POLICY = args.drop_policy
+    server.DECODE_WORKERS = args.decode_workers
+    server.PIPELINE_STATS_INTERVAL = float('inf')
+
+    sessions = []
+    ingest_latency = []
+    write_latency = []
+
+    class MeasuredSession(server.CameraSession):
+
+        def __init__(self, transport, camera_id, version):
+            super().__init__(transport, camera_id, version)
+            sessions.append(self)
+
+        def on_frame(self, header, payload):
+            if header is not None:
+                ingest_latency.append(time.time() - header.timestamp)
+            super().on_frame(header, payload)
+
+        def write_frame(self, item):
+            super().write_frame(item)
+            write_latency.append(time.time() - item[0])  # list.append is thread safe
+
+    server.CameraSession = MeasuredSession
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        tcp_server = await server.start_server()
+        connection.send('ready')
+        await loop.run_in_executor(None, connection.recv)  # clients start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        del ingest_latency[:], write_latency[:]
+        await loop.run_in_executor(None, connection.recv)  # clients are done
+        seconds = time.perf_counter() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (end_usage.ru_utime - usage.ru_utime + end_usage.ru_stime - usage.ru_stime) / seconds
+        stats = [session.pipeline.stats() for session in sessions]
+        tcp_server.close()
+        connection.send({
+            'seconds': seconds,
+            'cpu_cores': round(cpu, 3),
+            'rss_bytes': rss_bytes(),
+            'max_rss_bytes': end_usage.ru_maxrss * 1024,
+            'accepted': sum(stat['ingest']['frames'] - stat['ingest']['dropped'] for stat in stats),
+            'written': sum(stat['write']['frames'] for stat in stats),
+            'dropped_queue': sum(stat['ingest']['dropped'] for stat in stats),
+            'dropped_seq': sum(session.dropped_frames for session in sessions),
+            'decode_ms_per_frame': _mean([stat['decode']['ms_per_frame'] for stat in stats]),
+            'write_ms_per_frame': _mean([stat['write']['ms_per_frame'] for stat in stats]),
+            'ingest_latency_ms': {'p50': percentile(ingest_latency, 50), 'p99': percentile(ingest_latency, 99)},
+            'write_latency_ms': {'p50': percentile(write_latency, 50), 'p99': percentile(write_latency, 99)},
+            'pipelines': stats,
+        })
+
+    asyncio.run(serve())
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def make_jpeg(width, height, quality, seed, ir=False, gray=False):
+    """a blurred noise image, compresses roughly like a real scene
+
+    ir: gray pixels in a BGR image, what an IR camera delivers, gray: the same as a single channel image
+    """
+    channels = () if ir or gray else (3,)
+    image = np.random.default_rng(seed).integers(0, 255, (height, width, *channels), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (9, 9), 0)
+    if ir and not gray:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+async def discard_acks(reader):
+    """a v2 server acknowledges every frame, keep the socket drained
+    """
+    try:
+        while True:
+            await frame_protocol.read_frame_ack(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+async def client(index, args, jpeg, start_at):
+    """one synthetic camera, returns (frames sent, frames sent late)
+    """
+    flags = 0
+    if args.protocol == 'legacy':
+        # legacy clients are named after their IP, give every one its own loopback address
+        reader, writer = await asyncio.open_connection(HOST, args.port, local_addr=(f'127.0.0.{index + 2}', 0))
+    else:
+        reader, writer = await asyncio.open_connection(HOST, args.port)
+        version = await frame_protocol.negotiate(reader, writer, int(args.protocol[1:]), camera_id=f'bench{index}')
+        if version >= frame_protocol.PROTOCOL_ACKS:
+            asyncio.ensure_future(discard_acks(reader))
+        if args.gray and version >= frame_protocol.PROTOCOL_GRAY:
+            flags = frame_protocol.FLAG_GRAY
+    await asyncio.sleep(max(0.0, start_at - time.perf_counter()))
+    sent = late = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.seconds:
+        if args.protocol == 'legacy':
+            frame_protocol.write_legacy_frame(writer, jpeg)
+        else:
+            header = frame_protocol.make_header(sent, time.time(), len(jpeg), args.width, args.height, flags=flags)
+            frame_protocol.write_frame(writer, header, jpeg)
+        await writer.drain()  # a server that does not keep up slows the client down here
+        sent += 1
+        delay = start + sent / args.fps - time.perf_counter()
+        if delay < 0:
+            late += 1
+        await asyncio.sleep(max(0.0, delay))
+    writer.close()
+    return sent, late
+
+
+async def run_clients(args):
+    jpegs = [make_jpeg(args.width, args.height, args.quality, index, args.ir, args.gray) for index in range(args.clients)]
+    start_at = time.perf_counter() + 0.5  # every client connected before the first frame
+    results = await asyncio.gather(*(client(index, args, jpeg, start_at) for index, jpeg in enumerate(jpegs)))
+    return results, len(jpegs[0])
+
+
+def bench(args) -> dict:
+    save_path = tempfile.mkdtemp(prefix='bench_stream_')
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(args, save_path, child), daemon=True)
+    server.start()
+    try:
+        parent.recv()  # ready
+        parent.send('start')
+        results, jpeg_bytes = asyncio.run(run_clients(args))
+        time.sleep(args.drain)  # let the pipelines catch up
+        parent.send('stop')
+        server_stats = parent.recv()
+    finally:
+        server.terminate()
+        shutil.rmtree(save_path, ignore_errors=True)
+    seconds = server_stats.pop('seconds')
+    sent = sum(result[0] for result in results)
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'port')},
+        'host': {'machine': platform.machine(), 'python': platform.python_version(), 'opencv': cv2.__version__,
+                 'cpus': os.cpu_count()},
+        'jpeg_bytes': jpeg_bytes,
+        'sent': sent,
+        'sent_late': sum(result[1] for result in results),
+        'sent_fps': round(sent / args.seconds, 2),
+        'accepted_fps': round(server_stats['accepted'] / args.seconds, 2),
+        'written_fps': round(server_stats['written'] / args.seconds, 2),
+        'measured_seconds': round(seconds, 2),
+        **server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--fps', type=float, default=10, help='per client')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--quality', type=int, default=95, help='JPEG quality, the client default (JPEG_QUALITY) is 95')
+    parser.add_argument('--protocol', choices=[f'v{version}' for version in range(frame_protocol.PROTOCOL_VERSION, 0, -1)] + ['legacy'],
+                        default='v3')
+    parser.add_argument('--ir', action='store_true', help='a gray scene in BGR JPEGs, like an IR camera at night')
+    parser.add_argument('--gray', action='store_true', help='the --ir scene in single channel JPEGs, like VIDEO_COLOR_GRAY')
+    parser.add_argument('--ingest', choices=('zero-copy', 'stream'), default='zero-copy')
+    parser.add_argument('--record', choices=(pi_cam_stream_server.RECORD_TRANSCODE, pi_cam_stream_server.RECORD_PASSTHROUGH, 'none'),
+                        default=pi_cam_stream_server.RECORD_TRANSCODE)
+    parser.add_argument('--drop-policy', choices=pipeline.DROP_POLICIES, default=pipeline.DROP_OLDEST)
+    parser.add_argument('--decode-workers', type=int, default=pi_cam_stream_server.DECODE_WORKERS)
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for the pipelines after the clients stop')
+    parser.add_argument('--port', type=int, default=18890)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    result = bench(args)
+    print(f"{args.clients} clients x {args.fps} fps, {args.width}x{args.height} q{args.quality} "
+          f"({result['jpeg_bytes']} bytes{', gray' if args.gray else ', ir' if args.ir else ''}), {args.protocol}, {args.ingest} ingest, record {args.record}, {args.drop_policy}")
+    print(f"fps sent {result['sent_fps']}  accepted {result['accepted_fps']}  written {result['written_fps']}  "
+          f"dropped {result['dropped_queue']} (queue) {result['dropped_seq']} (seq)")
+    print(f"decode {result['decode_ms_per_frame']} ms/frame  write {result['write_ms_per_frame']} ms/frame  "
+          f"cpu {result['cpu_cores']} cores  rss {result['max_rss_bytes'] >> 20} MB")
+    print(f"ingest latency ms {result['ingest_latency_ms']}  write latency ms {result['write_latency_ms']}")
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(result, output, indent=2)
+        print(f'Output File: {args.json}')
+
+
+if __name__ == '__main__':
+    main()
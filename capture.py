@@ -0,0 +1,205 @@
+"""
+capture / encode / send pipeline of pi_cam_stream_client.py
+
+    capture thread     cap.read() as fast as the camera delivers, keeps only the latest frame
+      -> encoder pool  `encode_workers` threads, each takes the newest frame when it is free
+                       and the send queue has room, frames captured in between are skipped
+      -> send queue    at most `send_queue_depth` JPEGs, the oldest is dropped when full
+      -> sender        asyncio, write + drain, the only stage that touches the socket
+
+a slow link only fills the send queue, the encoders keep working on fresh frames and the
+camera is never blocked, so the latency of what is sent stays bounded by the queue depth.
+cv2.VideoCapture.read and cv2.imencode release the GIL, threads are enough.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import cv2
+
+
+class CaptureThread(threading.Thread):
+    """owns the camera, call stop() to release it
+
+    open_camera() -> cv2.VideoCapture, opens the camera again for restart()
+    """
+
+    def __init__(self, cap: cv2.VideoCapture, open_camera=None):
+        super().__init__(name='capture', daemon=True)
+        self.cap = cap
+        self.open_camera = open_camera
+        self.captured = 0
+        self.failures = 0
+        self.restarts = 0
+        self._latest = None  # (index, timestamp, frame)
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._stopped = threading.Event()
+        self._restart = threading.Event()
+
+    def add_listener(self, callback) -> None:
+        """callback() is called on the capture thread after every new frame
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback) -> None:
+        self._listeners.remove(callback)
+
+    def latest(self):
+        """(index, timestamp, frame) of the newest frame, None before the first one
+        """
+        with self._lock:
+            return self._latest
+
+    def restart(self) -> None:
+        """release and open the camera again, on the capture thread between two reads
+        """
+        if self.open_camera is not None:
+            self._restart.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            if self._restart.is_set():
+                self._restart.clear()
+                self.cap.release()
+                self.cap = self.open_camera()
+                self.restarts += 1
+            ok, frame = self.cap.read()
+            timestamp = time.time()
+            if not ok:
+                self.failures += 1
+                time.sleep(0.1)
+                continue
+            with self._lock:
+                self._latest = (self.captured, timestamp, frame)
+                self.captured += 1
+            for callback in list(self._listeners):
+                callback()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+        self.cap.release()
+
+
+class ClientPipeline:
+    """encoder pool + send queue for one connection, the capture thread outlives it
+
+    encode(frame) -> (payload, width, height, ...) or None to skip the frame (e.g. unchanged scene),
+    runs on the encoder threads
+    send(timestamp, payload, width, height, ...), a coroutine on the event loop, gets what encode
+    returned, may raise to end run()
+    """
+
+    def __init__(self,
+                 capture: CaptureThread,
+                 encode,
+                 send,
+                 executor: concurrent.futures.Executor,
+                 encode_workers: int = 2,
+                 send_queue_depth: int = 2):
+        self.capture = capture
+        self.encode = encode
+        self.send = send
+        self.executor = executor
+        self.encode_workers = encode_workers
+        self.frame_skip = 1  # take every frame_skip-th captured frame at most, e.g. set by rate control
+        self.sent = 0
+        self.encoded = 0
+        self.skipped = 0  # captured frames no encoder picked up
+        self.dropped = 0  # encoded frames that were too old or did not fit in the send queue
+        self.unchanged = 0  # frames encode() skipped
+        self.errors = 0
+        self._queue = collections.deque()
+        self._queue_depth = send_queue_depth
+        self._last_taken = -1
+        self._last_queued = -1
+        self._encoding = 0
+
+    async def run(self) -> None:
+        """until send raises, e.g. the connection broke
+        """
+        loop = asyncio.get_running_loop()
+        new_frame = asyncio.Event()
+        queued = asyncio.Event()
+        room = asyncio.Event()
+
+        def on_frame():
+            loop.call_soon_threadsafe(new_frame.set)
+
+        async def encode_one(index, timestamp, frame):
+            try:
+                encoded = await loop.run_in_executor(self.executor, self.encode, frame)
+            except Exception:
+                self.errors += 1
+                return
+            finally:
+                self._encoding -= 1
+                slots.release()
+                room.set()
+            if encoded is None:
+                self.unchanged += 1
+                return
+            self.encoded += 1
+            if index < self._last_queued:  # a newer frame finished first
+                self.dropped += 1
+                return
+            self._last_queued = index
+            if len(self._queue) >= self._queue_depth:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((timestamp, *encoded))
+            queued.set()
+
+        async def encode_loop():
+            tasks = set()
+            while True:
+                await slots.acquire()
+                while len(self._queue) + self._encoding >= self._queue_depth:  # do not encode frames that would be dropped
+                    room.clear()
+                    await room.wait()
+                latest = self.capture.latest()
+                while latest is None or latest[0] < self._last_taken + self.frame_skip:
+                    new_frame.clear()
+                    await new_frame.wait()
+                    latest = self.capture.latest()
+                index, timestamp, frame = latest
+                self.skipped += index - self._last_taken - 1 if self._last_taken >= 0 else 0
+                self._last_taken = index
+                self._encoding += 1
+                task = asyncio.ensure_future(encode_one(index, timestamp, frame))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        async def send_loop():
+            while True:
+                while not self._queue:
+                    queued.clear()
+                    await queued.wait()
+                item = self._queue.popleft()
+                room.set()
+                await self.send(*item)
+                self.sent += 1
+
+        slots = asyncio.Semaphore(self.encode_workers)
+        self.capture.add_listener(on_frame)
+        encoder = asyncio.ensure_future(encode_loop())
+        try:
+            await send_loop()
+        finally:
+            self.capture.remove_listener(on_frame)
+            encoder.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'captured': self.capture.captured,
+            'skipped': self.skipped,
+            'unchanged': self.unchanged,
+            'encoded': self.encoded,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'sent': self.sent,
+            'queued': len(self._queue),
+        }
@@ -0,0 +1,281 @@
+"""
+segment catalog and retention for pi_cam_stream_server.py
+
+every recorded file is a row in a small sqlite database next to the videos:
+
+    segments(id, camera, path, start_time, end_time, bytes, frames)
+
+the workers add a row when they open a segment and fill in end_time/bytes/frames when they
+close it, so nothing ever has to list the video directory while recording. the supervisor
+runs RetentionPolicy every few seconds and deletes at most a batch of the oldest segments
+per run, until all limits hold again:
+
+- disk quota: once the segments take more than quota_high_bytes, delete down to quota_low_bytes
+- free space: delete while the file system has less than min_free_bytes left
+- max age: delete segments that ended more than max_age_seconds ago
+- max count: keep at most max_count segments per camera
+
+sqlite in WAL mode lets the worker processes write while the supervisor reads. triggers keep
+camera_totals(camera, segments, bytes) up to date on every insert, update and delete, so the quota
+and the max count read a row per camera instead of summing or ranking the whole segments table.
+
+live_streams(camera, port, pid) tells the live view (live_http.py) which worker process has a camera.
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    frames INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS segments_start ON segments (start_time);
+CREATE INDEX IF NOT EXISTS segments_camera_start ON segments (camera, start_time);
+CREATE INDEX IF NOT EXISTS segments_end ON segments (end_time);  -- max age, open segments are NULL
+CREATE TABLE IF NOT EXISTS camera_totals (
+    camera TEXT PRIMARY KEY,
+    segments INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN
+    -- not INSERT OR IGNORE, the OR REPLACE of open_segment would override it and reset the row
+    INSERT INTO camera_totals (camera) SELECT NEW.camera WHERE NOT EXISTS (SELECT 1 FROM camera_totals WHERE camera = NEW.camera);
+    UPDATE camera_totals SET segments = segments + 1, bytes = bytes + NEW.bytes WHERE camera = NEW.camera;
+END;
+CREATE TRIGGER IF NOT EXISTS segments_update AFTER UPDATE OF bytes ON segments BEGIN
+    UPDATE camera_totals SET bytes = bytes - OLD.bytes + NEW.bytes WHERE camera = NEW.camera;
+END;
+CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN
+    UPDATE camera_totals SET segments = segments - 1, bytes = bytes - OLD.bytes WHERE camera = OLD.camera;
+END;
+-- a catalog from before camera_totals, counted once
+INSERT OR IGNORE INTO camera_totals (camera, segments, bytes)
+    SELECT camera, COUNT(*), SUM(bytes) FROM segments WHERE NOT EXISTS (SELECT 1 FROM camera_totals) GROUP BY camera;
+CREATE TABLE IF NOT EXISTS live_streams (
+    camera TEXT PRIMARY KEY,
+    port INTEGER NOT NULL,
+    pid INTEGER NOT NULL
+);
+"""
+_COLUMNS = 'id, camera, path, start_time, end_time, bytes, frames'
+
+
+class Segment(NamedTuple):
+    id: int
+    camera: str
+    path: str
+    start_time: float
+    end_time: Optional[float]  # None while the segment is being written
+    bytes: int
+    frames: int
+
+
+class SegmentCatalog:
+    """thread safe, one instance per process
+    """
+
+    def __init__(self, path: str, sidecar_suffixes=()):
+        self.path = path
+        self.sidecar_suffixes = tuple(sidecar_suffixes)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA recursive_triggers=ON')  # the row INSERT OR REPLACE replaces leaves camera_totals
+        self._db.executescript('BEGIN IMMEDIATE;' + _SCHEMA + 'COMMIT;')  # no worker inserts between table and count
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, args=()) -> List[Segment]:
+        with self._lock:
+            return [Segment(*row) for row in self._db.execute(sql, args).fetchall()]
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args)
+
+    def open_segment(self, camera: str, path: str, start_time: float) -> int:
+        cursor = self._execute('INSERT OR REPLACE INTO segments (camera, path, start_time) VALUES (?, ?, ?)',
+                               (camera, path, start_time))
+        return cursor.lastrowid
+
+    def close_segment(self, segment_id: int, end_time: float, size: int, frames: int) -> None:
+        self._execute('UPDATE segments SET end_time = ?, bytes = ?, frames = ? WHERE id = ?',
+                      (end_time, size, frames, segment_id))
+
+    def segments(self, camera: str = None, start_time: float = None, end_time: float = None) -> List[Segment]:
+        """segments overlapping [start_time, end_time], oldest first
+        """
+        sql = f'SELECT {_COLUMNS} FROM segments WHERE 1'
+        args = []
+        if camera is not None:
+            sql += ' AND camera = ?'
+            args.append(camera)
+        if start_time is not None:
+            sql += ' AND (end_time IS NULL OR end_time >= ?)'
+            args.append(start_time)
+        if end_time is not None:
+            sql += ' AND start_time <= ?'
+            args.append(end_time)
+        return self._query(sql + ' ORDER BY start_time', args)
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(bytes), 0) FROM camera_totals').fetchone()[0]
+
+    def oldest(self, limit: int, where: str = '1', args=()) -> List[Segment]:
+        """closed segments, oldest first
+        """
+        return self._query(f'SELECT {_COLUMNS} FROM segments WHERE end_time IS NOT NULL AND {where} ORDER BY start_time LIMIT ?',
+                           (*args, limit))
+
+    def ended_before(self, end_time: float, limit: int) -> List[Segment]:
+        """closed segments that ended before end_time, the earliest end first, a range of segments_end
+        """
+        return self._query(f'SELECT {_COLUMNS} FROM segments WHERE end_time < ? ORDER BY end_time LIMIT ?', (end_time, limit))
+
+    def over_count(self, max_count: int, limit: int) -> List[Segment]:
+        """the oldest closed segments of the cameras with more than max_count, oldest first
+        """
+        with self._lock:
+            cameras = self._db.execute('SELECT camera, segments - ? FROM camera_totals WHERE segments > ?',
+                                       (max_count, max_count)).fetchall()
+        found = []
+        for camera, excess in cameras:
+            found += self.oldest(min(excess, limit), 'camera = ?', (camera,))
+        return sorted(found, key=lambda segment: segment.start_time)[:limit]
+
+    def delete(self, segment: Segment) -> None:
+        """remove the files of a segment and its row
+        """
+        for path in (segment.path,) + tuple(segment.path + suffix for suffix in self.sidecar_suffixes):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._execute('DELETE FROM segments WHERE id = ?', (segment.id,))
+        print(f'Delete: {segment.path}')
+
+    def set_live(self, camera: str, port: int, pid: int) -> None:
+        self._execute('INSERT OR REPLACE INTO live_streams (camera, port, pid) VALUES (?, ?, ?)', (camera, port, pid))
+
+    def clear_live(self, pid: int, camera: str = None) -> None:
+        """forget the cameras of a worker process, or one of them
+        """
+        if camera is None:
+            self._execute('DELETE FROM live_streams WHERE pid = ?', (pid,))
+        else:
+            self._execute('DELETE FROM live_streams WHERE pid = ? AND camera = ?', (pid, camera))
+
+    def live_port(self, camera: str) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute('SELECT port FROM live_streams WHERE camera = ?', (camera,)).fetchone()
+        return row[0] if row is not None else None
+
+    def recover(self) -> None:
+        """close segments left open by a crash, only call it while no worker is recording
+        """
+        self._execute('DELETE FROM live_streams')
+        for segment in self._query(f'SELECT {_COLUMNS} FROM segments WHERE end_time IS NULL'):
+            try:
+                stat = os.stat(segment.path)
+            except FileNotFoundError:
+                self._execute('DELETE FROM segments WHERE id = ?', (segment.id,))
+                continue
+            self.close_segment(segment.id, stat.st_mtime, stat.st_size, segment.frames)
+
+    def adopt(self, root: str, suffix: str = '.avi') -> int:
+        """add files below root/<camera>/ that are not in the catalog yet, e.g. recorded before it existed
+
+        a one-off directory walk for startup, never called while recording
+        """
+        known = {segment.path for segment in self._query(f'SELECT {_COLUMNS} FROM segments')}
+        adopted = 0
+
+        def adopt_dir(path, camera):
+            nonlocal adopted
+            for entry in os.scandir(path):
+                if entry.is_file() and entry.name.endswith(suffix) and entry.path not in known:
+                    stat = entry.stat()
+                    segment_id = self.open_segment(camera, entry.path, stat.st_mtime)
+                    self.close_segment(segment_id, stat.st_mtime, stat.st_size, 0)
+                    adopted += 1
+
+        if not os.path.isdir(root):
+            return 0
+        adopt_dir(root, 'unknown')  # flat layout from before camera ids
+        for entry in os.scandir(root):
+            if entry.is_dir():
+                adopt_dir(entry.path, entry.name)
+        return adopted
+
+
+class RetentionPolicy:
+    """limits for the recorded segments, None switches a limit off
+    """
+
+    def __init__(self,
+                 quota_high_bytes: int = None,
+                 quota_low_bytes: int = None,
+                 min_free_bytes: int = None,
+                 max_age_seconds: float = None,
+                 max_count: int = None,
+                 batch: int = 20):
+        self.quota_high_bytes = quota_high_bytes
+        self.quota_low_bytes = quota_low_bytes if quota_low_bytes is not None else quota_high_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_count = max_count
+        self.batch = batch
+        self._over_quota = False
+
+    def enforce(self, catalog: SegmentCatalog, disk_path: str) -> int:
+        """delete at most `batch` segments, returns how many were deleted
+
+        called repeatedly, each call only looks at the few oldest rows through the indexes: the max age
+        is a range of segments_end, the others stop at the first closed rows of segments_start or
+        segments_camera_start, the totals come from camera_totals
+        """
+        deleted = 0
+        if self.max_age_seconds is not None:
+            for segment in catalog.ended_before(time.time() - self.max_age_seconds, self.batch):
+                catalog.delete(segment)
+                deleted += 1
+        if self.max_count is not None and deleted < self.batch:
+            for segment in catalog.over_count(self.max_count, self.batch - deleted):
+                catalog.delete(segment)
+                deleted += 1
+        if self.quota_high_bytes is not None:
+            total = catalog.total_bytes()
+            if total > self.quota_high_bytes:
+                self._over_quota = True
+            while self._over_quota and deleted < self.batch:
+                if total <= self.quota_low_bytes:
+                    self._over_quota = False
+                    break
+                oldest = catalog.oldest(1)
+                if not oldest:
+                    break
+                catalog.delete(oldest[0])
+                total -= oldest[0].bytes
+                deleted += 1
+        if self.min_free_bytes is not None:
+            while deleted < self.batch and shutil.disk_usage(disk_path).free < self.min_free_bytes:
+                oldest = catalog.oldest(1)
+                if not oldest:
+                    break
+                catalog.delete(oldest[0])
+                deleted += 1
+        return deleted
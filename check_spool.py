@@ -0,0 +1,148 @@
+"""
+loopback check of the backlog upload (spool.py), no camera needed
+
+pi_cam_stream_server.py runs in this process, its backlog session refuses one frame in the middle of
+the first upload like a full DROP_NEWEST queue does (no FRAME_ACK). the client side is a spool.FrameSpool
+uploaded by pi_cam_stream_client.upload_backlog with the acks of read_server going through a
+spool.UploadWindow, as client_camera does. expected:
+- after the first connection the spool cursor stays in front of the refused frame
+- the second connection uploads the refused frame (and the ones after it) again, then nothing is pending
+
+python check_spool.py --frames 40 --refuse 17 --fps 50
+"""
+import argparse
+import asyncio
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import cv2
+
+import frame_protocol
+import pi_cam_stream_client
+import pi_cam_stream_server
+import spool
+
+HOST = '127.0.0.1'
+
+
+def start_server(args, save_path, received):
+    """received[connection] gets the timestamps of the backlog frames that arrived on it
+    """
+    server = pi_cam_stream_server
+    server.SERVER_IP = HOST
+    server.SERVER_PORT = args.port
+    server.LIVE_HTTP_PORT = None
+    server.WRITE_VIDEO_TO_FILE = False
+    server.VIDEO_SAVE_PATH = save_path
+    server.CATALOG_PATH = save_path + '/catalog.sqlite3'
+    server.PIPELINE_STATS_INTERVAL = float('inf')
+    refused = []
+
+    class RefusingSession(server.CameraSession):
+
+        def queue_frame(self, header, payload):
+            if self.backlog:
+                received[-1].append(header.timestamp)
+                if len(received) == 1 and len(received[-1]) == args.refuse + 1:
+                    refused.append(header.timestamp)
+                    return False  # like a full queue, the frame is not acknowledged
+            return super().queue_frame(header, payload)
+
+    server.CameraSession = RefusingSession
+    return server.start_server(), refused
+
+
+async def upload(frame_spool: spool.FrameSpool, refused: int) -> int:
+    """one connection like client_camera's, returns the frames the server acknowledged
+    """
+    reader, writer, version = await pi_cam_stream_client.connect_server()
+    assert version >= frame_protocol.PROTOCOL_BACKLOG, version
+    backlog = spool.UploadWindow()
+    seq = 0
+    acked = 0
+
+    async def send(timestamp, data, video_w, video_h, spooled: spool.Position = None):
+        nonlocal seq
+        header = frame_protocol.make_header(seq, timestamp, len(data), video_w, video_h, flags=frame_protocol.FLAG_BACKLOG)
+        frame_protocol.write_frame(writer, header, data)
+        backlog.sent(seq, spooled)
+        seq += 1
+        await writer.drain()
+
+    def on_ack(frame_seq):
+        nonlocal acked
+        acked += 1
+        committed = backlog.ack(frame_seq)
+        if committed is not None:
+            frame_spool.commit(committed)
+
+    acks = asyncio.ensure_future(pi_cam_stream_client.read_server(reader, on_ack))
+    await pi_cam_stream_client.upload_backlog(frame_spool, send)
+    for _ in range(100):  # the acks of the last frames
+        if acked >= seq - refused:
+            break
+        await asyncio.sleep(0.05)
+    acks.cancel()
+    writer.close()
+    backlog.clear()
+    return acked
+
+
+async def check(args, save_path, spool_path) -> bool:
+    received = []
+    tcp_server, refused = start_server(args, save_path, received)
+    tcp_server = await tcp_server
+    pi_cam_stream_client.SERVER_IP = HOST
+    pi_cam_stream_client.SERVER_PORT = args.port
+    pi_cam_stream_client.UDP_TRANSPORT = False
+    pi_cam_stream_client.CAMERA_ID = 'check-spool'
+
+    _, jpeg = cv2.imencode('.jpg', np.full((48, 64, 3), 128, np.uint8))
+    # slow enough for the backlog queue, unpaced the server refuses frames of its own
+    pi_cam_stream_client.SPOOL_UPLOAD_BYTES_PER_SECOND = args.fps * len(jpeg)
+    frame_spool = spool.FrameSpool(spool_path, file_bytes=4 * len(jpeg))  # a few files, commit deletes some
+    timestamps = [1_000_000.0 + index for index in range(args.frames)]
+    for timestamp in timestamps:
+        frame_spool.append(timestamp, jpeg.tobytes(), 64, 48)
+
+    ok = True
+    for connection in range(2):
+        received.append([])
+        acked = await upload(frame_spool, refused=1 if connection == 0 else 0)
+        pending = frame_spool.pending_bytes()
+        print(f'connection {connection + 1}: {len(received[-1])} backlog frames arrived, {acked} acknowledged, {pending} bytes pending')
+        if connection == 0:
+            if received[0] != timestamps or refused != timestamps[args.refuse:args.refuse + 1]:
+                print('FAIL: the first upload did not send every frame once')
+                ok = False
+            if pending != (args.frames - args.refuse) * (spool.RECORD.size + len(jpeg)):
+                print(f'FAIL: the cursor is not in front of the refused frame #{args.refuse}')
+                ok = False
+        elif received[1] != timestamps[args.refuse:] or pending:
+            print(f'FAIL: the second upload did not start at the refused frame #{args.refuse}')
+            ok = False
+    frame_spool.close()
+    tcp_server.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=40)
+    parser.add_argument('--refuse', type=int, default=17, help='index of the backlog frame the server refuses')
+    parser.add_argument('--fps', type=float, default=50, help='backlog frames per second')
+    parser.add_argument('--port', type=int, default=18891)
+    args = parser.parse_args()
+    save_path = tempfile.mkdtemp(prefix='check_spool_')
+    try:
+        ok = asyncio.run(check(args, save_path, save_path + '/spool'))
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
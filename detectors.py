@@ -0,0 +1,186 @@
+"""
+face detector backends for face.py, a backend imports its library only when it is created
+
+    detector = detectors.create('haar', min_neighbors=4)
+    detector.detect(images) -> [(boxes, scores), ...]    one per image, boxes N x 4 int32 x1, y1, x2, y2,
+                                                         scores N float32, higher is more certain
+
+    haar              opencv's frontal face Haar cascade, plain opencv-python (cv2.data.haarcascades)
+    lbp               opencv's LBP cascade, faster and less accurate. pip's opencv does not ship it,
+                      LBP_CASCADE points to lbpcascade_frontalface_improved.xml from opencv/data/lbpcascades
+    dlib              dlib's HOG + SVM detector                   ~60 ms per 320x240 frame
+    face_recognition  face_recognition.face_locations, HOG model   ~50 ms, batched with model='cnn'
+    mtcnn             the mtcnn package (tensorflow)               ~100 ms
+
+available() says which ones this machine can run and why not, `python bench_detectors.py` compares
+their speed and how much their boxes agree. register() adds a backend.
+"""
+import importlib
+import importlib.util
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import cv2
+
+LBP_CASCADE = 'lbpcascade_frontalface_improved.xml'  # a path, or a name in cv2.data.haarcascades
+
+EMPTY_BOXES = np.zeros((0, 4), np.int32)
+EMPTY_SCORES = np.zeros(0, np.float32)
+
+BACKENDS: Dict[str, type] = {}
+
+
+def register(backend: type) -> type:
+    """class decorator, the backend is created by its name
+    """
+    BACKENDS[backend.name] = backend
+    return backend
+
+
+def check(name: str, **options) -> type:
+    """the backend class, ValueError / RuntimeError when it is unknown or cannot run here
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'unknown detector {name}, known: {", ".join(BACKENDS)}')
+    missing = BACKENDS[name].missing(**options)
+    if missing:
+        raise RuntimeError(f'detector {name} is not available: {missing}')
+    return BACKENDS[name]
+
+
+def create(name: str, **options) -> 'Detector':
+    return check(name, **options)(**options)
+
+
+def available() -> Dict[str, str]:
+    """name -> '' when the backend can run here, else what is missing
+    """
+    return {name: backend.missing() for name, backend in BACKENDS.items()}
+
+
+def to_boxes(rects, scores=None) -> Tuple[np.ndarray, np.ndarray]:
+    """x, y, width, height rectangles to (boxes, scores)
+    """
+    if len(rects) == 0:
+        return EMPTY_BOXES, EMPTY_SCORES
+    boxes = np.asarray(rects, np.int32).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    scores = np.ones(len(boxes), np.float32) if scores is None else np.asarray(scores, np.float32).reshape(-1)
+    return boxes, scores
+
+
+class Detector:
+    """detect() a batch, backends without a batch API implement detect_one()
+    """
+    name = ''
+    requires = ()  # modules that must be importable
+
+    @classmethod
+    def missing(cls, **options) -> str:
+        for module in cls.requires:
+            if importlib.util.find_spec(module) is None:
+                return f'pip install {module}'
+        return ''
+
+    def detect(self, images) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.detect_one(image) for image in images]
+
+    def detect_one(self, image) -> Tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+
+@register
+class HaarDetector(Detector):
+    name = 'haar'
+    cascade = 'haarcascade_frontalface_default.xml'
+
+    def __init__(self, cascade: str = None, scale_factor: float = 1.1, min_neighbors: int = 5, min_size=(24, 24)):
+        self.classifier = cv2.CascadeClassifier(self.cascade_path(cascade))
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = tuple(min_size)
+
+    @classmethod
+    def cascade_path(cls, cascade: str = None) -> str:
+        cascade = cascade or cls.cascade
+        if os.path.exists(cascade) or not hasattr(cv2, 'data'):
+            return cascade
+        return os.path.join(cv2.data.haarcascades, cascade)
+
+    @classmethod
+    def missing(cls, cascade: str = None, **options) -> str:
+        if not hasattr(cv2, 'CascadeClassifier'):
+            return f'cv2 {cv2.__version__} has no CascadeClassifier'
+        if not os.path.exists(cls.cascade_path(cascade)):
+            return f'{cls.cascade_path(cascade)} not found'
+        return ''
+
+    def detect_one(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        rects, _, weights = self.classifier.detectMultiScale3(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+                                                              minSize=self.min_size, outputRejectLevels=True)
+        return to_boxes(rects, weights)
+
+
+@register
+class LbpDetector(HaarDetector):
+    name = 'lbp'
+
+    @classmethod
+    def cascade_path(cls, cascade: str = None) -> str:
+        return super().cascade_path(cascade or LBP_CASCADE)
+
+
+@register
+class DlibDetector(Detector):
+    name = 'dlib'
+    requires = ('dlib',)
+
+    def __init__(self, upsample: int = 1, threshold: float = 0.0):
+        dlib = importlib.import_module('dlib')
+        self.detector = dlib.get_frontal_face_detector()
+        self.upsample = upsample
+        self.threshold = threshold
+
+    def detect_one(self, image):
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image
+        rects, scores, _ = self.detector.run(rgb, self.upsample, self.threshold)
+        return to_boxes([(rect.left(), rect.top(), rect.width(), rect.height()) for rect in rects], scores)
+
+
+@register
+class FaceRecognitionDetector(Detector):
+    name = 'face_recognition'
+    requires = ('face_recognition',)
+
+    def __init__(self, model: str = 'hog', upsample: int = 1):
+        self.face_recognition = importlib.import_module('face_recognition')
+        self.model = model
+        self.upsample = upsample
+
+    @staticmethod
+    def _result(locations):
+        return to_boxes([(left, top, right - left, bottom - top) for top, right, bottom, left in locations])
+
+    def detect(self, images):
+        rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image for image in images]
+        if self.model == 'cnn' and len({image.shape for image in rgb}) == 1:
+            return [self._result(locations) for locations in
+                    self.face_recognition.batch_face_locations(rgb, self.upsample, batch_size=len(rgb))]
+        return [self._result(self.face_recognition.face_locations(image, self.upsample, self.model)) for image in rgb]
+
+
+@register
+class MtcnnDetector(Detector):
+    name = 'mtcnn'
+    requires = ('mtcnn',)
+
+    def __init__(self):
+        self.detector = importlib.import_module('mtcnn.mtcnn').MTCNN()
+
+    def detect_one(self, image):
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        faces = self.detector.detect_faces(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return to_boxes([face['box'] for face in faces], [face['confidence'] for face in faces])
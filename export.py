@@ -0,0 +1,184 @@
+"""
+export recorded segments as a regular video
+
+a whole passthrough segment (recorder.MjpegAviWriter), the timestamp is burned in here, once
+per exported frame, instead of for every recorded frame:
+
+python export.py /home/pi/Desktop/videos/cam1/2022_03_01_20_00_00.avi clip.avi
+python export.py /home/pi/Desktop/videos/cam1/2022_03_01_20_00_00.avi clip.avi --no-burn-in --fourcc MJPG
+
+a time range of one camera, the segments come from the catalog and the frames from a binary
+search over their seek index. passthrough JPEGs are copied into an MJPEG AVI without decoding,
+transcoded segments are seeked by frame number and only the clip is decoded:
+
+python export.py --camera cam1 --start '2022-03-01 02:13:00' --duration 10 clip.avi
+python export.py --camera cam1 --start 1646129580 --end 1646129590 clip.avi --burn-in
+"""
+import argparse
+import datetime
+import heapq
+
+import numpy as np
+import pytz
+import cv2
+
+import catalog
+import recorder
+
+
+def export_segment(path: str, output: str, burn_in: bool = True, fourcc: str = 'XVID', fps: float = None) -> int:
+    """decode every frame of a segment, optionally burn in its capture time, encode to output
+
+    returns the number of frames written
+    """
+    timestamps = recorder.read_timestamps(path)
+    if fps is None:
+        fps = recorder.segment_fps(timestamps)
+    video_writer = None
+    frames = 0
+    for index, jpeg in enumerate(recorder.read_avi_frames(path)):
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), -1)
+        if frame is None:
+            continue
+        if burn_in and index < len(timestamps):
+            recorder.burn_in_timestamp(frame, timestamps[index])
+        if video_writer is None:
+            (video_height, video_width) = frame.shape[:2]
+            video_writer = cv2.VideoWriter(output,
+                                           cv2.VideoWriter_fourcc(*fourcc),
+                                           fps,
+                                           (video_width, video_height),
+                                           isColor=frame.ndim == 3)
+        video_writer.write(frame)
+        frames += 1
+    if video_writer is not None:
+        video_writer.release()
+    return frames
+
+
+def clip_frames(path: str, start_time: float, end_time: float, burn_in: bool = False):
+    """yield (timestamp, jpeg) of the frames of one segment captured in [start_time, end_time]
+    """
+    with recorder.SegmentIndex(path) as index:
+        entries = index.entries(index.bisect(start_time), index.bisect(end_time, right=True))
+    if not entries:
+        return
+    if entries[0].flags & recorder.INDEX_JPEG:
+        with open(path, 'rb') as segment:
+            for entry in entries:
+                segment.seek(entry.offset)
+                jpeg = segment.read(entry.length)
+                if len(jpeg) < entry.length:
+                    return  # not on disk yet, the segment is still recording
+                if burn_in:
+                    frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), -1)
+                    if frame is None:
+                        continue
+                    recorder.burn_in_timestamp(frame, entry.timestamp)
+                    jpeg = cv2.imencode('.jpg', frame)[1].tobytes()
+                yield entry.timestamp, jpeg
+    else:
+        # transcoded frames already show the capture time
+        capture = cv2.VideoCapture(path)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, entries[0].frame)
+        try:
+            for entry in entries:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield entry.timestamp, cv2.imencode('.jpg', frame)[1].tobytes()
+        finally:
+            capture.release()
+
+
+def _segment_clip(path: str, start_time: float, end_time: float, burn_in: bool):
+    """clip_frames, a segment without a readable seek index yields nothing
+    """
+    try:
+        yield from clip_frames(path, start_time, end_time, burn_in)
+    except (FileNotFoundError, ValueError) as err:
+        print(f'Skip {path}: no seek index ({err})')
+
+
+def export_range(segments, start_time: float, end_time: float, output: str, burn_in: bool = False) -> int:
+    """write the frames of `segments` (catalog.Segment) captured in [start_time, end_time] to an MJPEG
+    AVI, it plays at the rate the frames were captured
+
+    the segments may overlap, a _backlog segment covers the outage of a live one, their frames are
+    merged by capture time. the output is single channel when the first segment was recorded so.
+    returns the number of frames written
+    """
+    segments = list(segments)
+    clips = [_segment_clip(segment.path, start_time, end_time, burn_in) for segment in segments]
+    color = True
+    for segment in segments:
+        try:
+            color = recorder.avi_color(segment.path) is not False  # transcoded frames come back as BGR
+            break
+        except OSError:
+            continue
+    video_writer = None
+    unreadable = 0
+    for timestamp, jpeg in heapq.merge(*clips, key=lambda frame: frame[0]):
+        size = recorder.jpeg_size(jpeg)
+        if size is None:
+            unreadable += 1  # not a JPEG, e.g. a chunk cut off by a crash
+            continue
+        if video_writer is None:
+            video_writer = recorder.MjpegAviWriter(output, *size, fps=10, color=color)
+        video_writer.write(jpeg, timestamp)
+    if unreadable:
+        print(f'Skipped {unreadable} frames that are not JPEGs')
+    if video_writer is None:
+        return 0
+    video_writer.close()
+    return video_writer.frames
+
+
+def parse_time(value: str) -> float:
+    """unix time, or local time 'YYYY-mm-dd HH:MM:SS' in recorder.TIMEZONE like the file names
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    local_time = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return pytz.timezone(recorder.TIMEZONE).localize(local_time).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('segment', nargs='?', help='passthrough AVI written by pi_cam_stream_server.py')
+    parser.add_argument('output')
+    parser.add_argument('--no-burn-in', dest='burn_in', action='store_false', default=None,
+                        help='do not print the capture time')
+    parser.add_argument('--burn-in', dest='burn_in', action='store_true',
+                        help='print the capture time on a time range export, it re-encodes the clip')
+    parser.add_argument('--fourcc', default='XVID')
+    parser.add_argument('--fps', type=float, help='default: the rate the frames were captured at')
+    parser.add_argument('--camera', help='export a time range of this camera instead of a segment')
+    parser.add_argument('--start', type=parse_time)
+    parser.add_argument('--end', type=parse_time)
+    parser.add_argument('--duration', type=float, help='seconds, instead of --end')
+    parser.add_argument('--catalog', help='default: CATALOG_PATH of pi_cam_stream_server.py')
+    args = parser.parse_args()
+
+    if args.camera is None:
+        if args.segment is None:
+            parser.error('either a segment or --camera is required')
+        burn_in = args.burn_in if args.burn_in is not None else True
+        frames = export_segment(args.segment, args.output, burn_in, args.fourcc, args.fps)
+    else:
+        if args.start is None or (args.end is None and args.duration is None):
+            parser.error('--camera needs --start and --end or --duration')
+        end = args.end if args.end is not None else args.start + args.duration
+        if args.catalog is None:
+            import pi_cam_stream_server
+            args.catalog = pi_cam_stream_server.CATALOG_PATH
+        segments = catalog.SegmentCatalog(args.catalog).segments(args.camera, args.start, end)
+        frames = export_range(segments, args.start, end, args.output, bool(args.burn_in))
+    print(f'Output File: {args.output}, {frames} frames')
+
+
+if __name__ == '__main__':
+    main()
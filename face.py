@@ -1,154 +1,341 @@
-"""
-https://github.com/home9464/selfdrivingcar/blob/master/cam/camera_async_server.py
-
-pip install opencv-python==3.4.10.37
-
-"""
-import sys
-import time
-import socket
-import asyncio
-import multiprocessing
-import numpy as np
-import cv2
-"""
-#import dlib
-#from mtcnn.mtcnn import MTCNN
-#import face_recognition
-
-# conda install cmake
-# pip install dlib
-# pip install mtcnn
-# pip install face_recognition
-
-import face_recognition
-face_locations = face_recognition.face_locations(frame)
-for (y1, x2, y2, x1) in face_locations:
-    cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
-
-
-
-import dlib
-detector = dlib.get_frontal_face_detector()
-faceRects = detector(frame, 1)
-for faceRect in faceRects:
-    x1 = faceRect.left()
-    y1 = faceRect.top()
-    x2 = faceRect.right()
-    y2 = faceRect.bottom()
-    #cv2.putText(frame, str(x1), (10, 20))
-    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-
-
-from mtcnn.mtcnn import MTCNN
-detector = MTCNN()
-results = detector.detect_faces(pixels)
-# extract the bounding box from the first face
-x1, y1, width, height = results[0]['box']
-x2, y2 = x1 + width, y1 + height
-
-
-import face_recognition
-face_locations = face_recognition.face_locations(frame)
-for (y1, x2, y2, x1) in face_locations:
-    cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
-
-"""
-
-assert sys.version_info >= (3, 5, 2)  # for reader.readuntil
-
-#FRAME_SEPARATOR = b'\xE2\x82\xAC\xE2\x82\xAC'
-# (chr(255)+chr(0)+chr(0)+chr(0)+chr(255)+chr(0)+chr(0)+chr(0)+chr(255)).encode('utf-8')
-FRAME_SEPARATOR = b'\xc3\xbf\x00\x00\x00\xc3\xbf\x00\x00\x00\xc3\xbf'
-#LOCAL_IP = socket.gethostbyname(socket.gethostname())  # 10.0.0.3
-LOCAL_IP = '10.0.0.3'
-LOCAL_PORT = 8888
-
-
-#hog_face_detector = dlib.get_frontal_face_detector()
-#mtcnn_detector = MTCNN()
-
-P = multiprocessing.Pool(4)
-
-def _process_image(image):
-    resized = cv2.resize(image, (320, 240), interpolation=cv2.INTER_AREA)
-
-    def _dlib(image):  # 0.06
-        box = hog_face_detector(image, 1)[0]
-        x1 = box.left()
-        y1 = box.top()
-        x2 = box.right()
-        y2 = box.bottom()
-        return [(x1, y1, x2, y2)]
-
-    def _mtcnn(image):  # 0.10
-        results = mtcnn_detector.detect_faces(image)
-        # extract the bounding box from the first face
-        x1, y1, width, height = results[0]['box']
-        x2, y2 = x1 + width, y1 + height
-        return [(x1, y1, x2, y2)]
-
-    def _face_recog(image):  # 0.05
-        face_locations = face_recognition.face_locations(image)
-        box = face_locations[0]
-        (y1, x2, y2, x1) = box
-        return [(x1, y1, x2, y2)]
-
-    return _face_recog(resized)
-
-
-async def _handle_cam(reader, writer):
-    sep_len = len(FRAME_SEPARATOR)
-    while True:
-        img = None
-        frame = await reader.readuntil(separator=FRAME_SEPARATOR)  # blocked until read something
-        # truncate the separator
-        frame = frame[:-sep_len]
-        frame = np.asarray(bytearray(frame), dtype=np.uint8)
-        img = cv2.imdecode(frame, -1)
-        if img is not None:
-            #gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            start = time.time()
-            # P.map(_process_image, [img])
-            #face_boxes = _process_image(img)
-            #print(time.time()-start)
-            #for x1, y1, x2, y2 in face_boxes:
-                #cv2.putText(frame, str(x1), (10, 20))
-            #    cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.imshow('jpg', img)
-            cv2.waitKey(1)
-        # some time-consuming operations
-        #addr = writer.get_extra_info('peername')
-        #ack = await _process_image(img)
-        data = str.encode("hello"+'\n')
-        writer.write(data)
-        await writer.drain()
-        #await asyncio.sleep(0)
-
-
-async def camera_cb(reader, writer):
-    """called whenever a new client connection is established
-    """
-    try:
-        await _handle_cam(reader, writer)
-    except (asyncio.IncompleteReadError, ConnectionResetError, ConnectionAbortedError):
-        print('Lost client connection')
-        cv2.destroyAllWindows()
-
-
-async def main():
-    server = await asyncio.start_server(camera_cb,
-                                        LOCAL_IP,
-                                        LOCAL_PORT,
-                                        limit=1024*1204*8)
-    print('Serving on {}:{}'.format(LOCAL_IP, LOCAL_PORT))
-    #async with server:
-    #    await server.serve_forever()
-    #print(dir(server))
-    await asyncio.sleep(60)
-    server.close()
-    await server.wait_closed()
-
-
-if __name__ == '__main__':
+"""
+https://github.com/home9464/selfdrivingcar/blob/master/cam/camera_async_server.py
+
+pip install opencv-python==3.4.10.37
+
+face detection runs in DETECT_WORKERS processes next to the event loop. a multiprocessing.Pool call
+pickles the decoded frame and pushes it through a pipe, so DetectionPool copies it into a slot of a
+shared memory ring instead and only the slot index travels to a worker:
+
+    submit(image, callback)    copy into a free slot, (seq, slot, shape) to the task queue, returns seq,
+                               None without a free slot: the frame is skipped, the caller never waits
+    worker                     runs DETECTOR (detectors.py) on up to DETECT_BATCH queued slots in place,
+                               (seq, slot, boxes, scores) to the result queue
+    collector thread           frees the slot, callback(Detection) matched by seq
+
+results of different workers arrive out of order, compare Detection.seq to keep the newest.
+
+cameras connect with frame_protocol.py like to pi_cam_stream_server.py, a v2+ client gets a FRAME_ACK
+per frame and a v8+ client a RESULTS message with the tracked boxes, scores, track ids and names of
+every frame that has faces (one empty message when they are gone). both are written without waiting
+for the socket to drain, the frame loop never stops for the client, RESULTS are dropped while more
+than RESULTS_MAX_BUFFER bytes wait to be sent. CODEC_TILES deltas are pasted on a tiles.TileCanvas and
+detected on like full frames. FLAG_BACKLOG frames are old and nothing here records them: they get no
+FRAME_ACK, the client keeps them in its spool for the recording server, and they never reach the tracker.
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import queue
+import threading
+from multiprocessing import shared_memory
+from typing import Callable, NamedTuple
+import numpy as np
+import cv2
+
+import detectors
+import frame_protocol
+import identity
+import overlay
+import tiles
+import tracking
+
+assert sys.version_info >= (3, 5, 2)  # for reader.readuntil
+
+#FRAME_SEPARATOR = b'\xE2\x82\xAC\xE2\x82\xAC'
+# (chr(255)+chr(0)+chr(0)+chr(0)+chr(255)+chr(0)+chr(0)+chr(0)+chr(255)).encode('utf-8')
+FRAME_SEPARATOR = b'\xc3\xbf\x00\x00\x00\xc3\xbf\x00\x00\x00\xc3\xbf'
+#LOCAL_IP = socket.gethostbyname(socket.gethostname())  # 10.0.0.3
+LOCAL_IP = '10.0.0.3'
+LOCAL_PORT = 8888
+
+
+DETECT_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # one core stays with the event loop
+DETECT_SLOTS = 2 * DETECT_WORKERS  # frames in flight, a worker picks up the next one right away
+DETECT_SLOT_BYTES = 1920 * 1080 * 3  # the largest frame, larger ones are not detected
+DETECT_SIZE = (320, 240)  # frames are scaled down to this for detection, boxes back up
+DETECTOR = 'haar'  # a detectors.py backend, `python bench_detectors.py` to pick one
+DETECTOR_OPTIONS = {}
+DETECT_BATCH = 4  # a worker hands up to this many queued frames to the detector at once
+# the detector gets every DETECT_EVERY_FRAMES-th frame (and one whenever a track's share of corners that
+# optical flow could follow drops below TRACK_MIN_CONFIDENCE), tracking.py moves the boxes in between
+DETECT_EVERY_FRAMES = 5
+TRACK_MIN_CONFIDENCE = 0.5
+# who it is (identity.py): None for boxes without names, enroll with `python identity.py --path ... enroll`.
+# a track is embedded once, an unknown one again after IDENTITY_RETRY_FRAMES
+IDENTITY_PATH = None
+EMBEDDER = 'face_recognition'
+IDENTITY_MIN_SIMILARITY = 0.8  # cosine, face_recognition's usual L2 distance of 0.6 is about 0.82
+IDENTITY_RETRY_FRAMES = 30
+RESULTS_MAX_BUFFER = 64 * 1024  # bytes unsent to a camera before its RESULTS are dropped
+
+
+class Detection(NamedTuple):
+    seq: int
+    boxes: np.ndarray  # N x 4 int32, x1, y1, x2, y2 in frame pixels
+    scores: np.ndarray  # N float32
+    seconds: float  # detection time in the worker
+    error: str = ''
+
+
+def _detect_slots(shm, slot_bytes: int, batch, detector, size):
+    """detect on the slots of a batch of tasks in place, no view of them outlives the call, the slots are reused
+    """
+    images, scales = [], []
+    for _, slot, shape in batch:
+        image = np.ndarray(shape, np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+        height, width = shape[:2]
+        scale = min(1.0, size[0] / width, size[1] / height)
+        if scale < 1.0:
+            image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        images.append(image)
+        scales.append(scale)
+    return [(np.round(boxes / scale).astype(np.int32) if scale < 1.0 else boxes, scores)
+            for (boxes, scores), scale in zip(detector.detect(images), scales)]
+
+
+def _detect_worker(shm_name: str, slot_bytes: int, tasks, results, detector_factory, size, batch_size: int):
+    """process main: detect on the slots named by tasks until a None
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)  # the parent's, it unlinks it
+    detector = detector_factory()
+    try:
+        stop = False
+        while not stop:
+            batch = [tasks.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(tasks.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                for _ in range(batch.count(None) - 1):
+                    tasks.put(None)  # for the other workers
+                batch = [task for task in batch if task is not None]
+            if not batch:
+                break
+            start = time.perf_counter()
+            try:
+                found = _detect_slots(shm, slot_bytes, batch, detector, size)
+                seconds = (time.perf_counter() - start) / len(batch)
+                for (seq, slot, _), (boxes, scores) in zip(batch, found):
+                    results.put((seq, slot, Detection(seq, boxes, scores, seconds)))
+            except Exception as err:
+                seconds = (time.perf_counter() - start) / len(batch)
+                for seq, slot, _ in batch:
+                    results.put((seq, slot, Detection(seq, detectors.EMPTY_BOXES, detectors.EMPTY_SCORES, seconds, repr(err))))
+    finally:
+        shm.close()
+
+
+class DetectionPool:
+    """detector processes fed through a shared memory ring of frame slots, see the module docstring
+    """
+
+    def __init__(self,
+                 workers: int = DETECT_WORKERS,
+                 slots: int = DETECT_SLOTS,
+                 slot_bytes: int = DETECT_SLOT_BYTES,
+                 detector_factory: Callable = None,
+                 size=DETECT_SIZE,
+                 batch: int = DETECT_BATCH):
+        """detector_factory() -> detectors.Detector, called in every worker, DETECTOR by default
+        """
+        if detector_factory is None:
+            detectors.check(DETECTOR, **DETECTOR_OPTIONS)  # here, not in every worker
+            detector_factory = functools.partial(detectors.create, DETECTOR, **DETECTOR_OPTIONS)
+        self.slot_bytes = slot_bytes
+        self.submitted = 0
+        self.skipped = 0  # no free slot or too large
+        self.completed = 0
+        self.errors = 0
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self._free = list(range(slots))
+        self._pending = {}  # seq -> callback
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(target=_detect_worker,
+                                                 args=(self._shm.name, slot_bytes, self._tasks, self._results,
+                                                       detector_factory, size, batch),
+                                                 daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, name='detect-results', daemon=True)
+        self._collector.start()
+
+    def submit(self, image, callback: Callable):
+        """queue image for detection, callback(Detection) runs on the collector thread.
+        returns the seq, None when the frame is skipped
+        """
+        if image.nbytes > self.slot_bytes:
+            self.skipped += 1
+            return None
+        with self._lock:
+            if not self._free:
+                self.skipped += 1
+                return None
+            slot = self._free.pop()
+            self._seq += 1
+            seq = self._seq
+            self._pending[seq] = callback
+        view = np.ndarray(image.shape, np.uint8, buffer=self._shm.buf, offset=slot * self.slot_bytes)
+        view[...] = image
+        del view
+        self.submitted += 1
+        self._tasks.put((seq, slot, image.shape))
+        return seq
+
+    def _collect(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            seq, slot, detection = result
+            with self._lock:
+                self._free.append(slot)
+                callback = self._pending.pop(seq, None)
+            self.completed += 1
+            if detection.error:
+                self.errors += 1
+                print(f'Detection {seq} failed: {detection.error}')
+            if callback is not None:
+                try:
+                    callback(detection)
+                except Exception as err:
+                    print(f'Detection callback failed: {err!r}')
+
+    def stats(self) -> str:
+        return (f'submitted {self.submitted} skipped {self.skipped} completed {self.completed} '
+                f'errors {self.errors} free slots {len(self._free)}')
+
+    def close(self) -> None:
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._results.put(None)
+        self._collector.join(timeout=5)
+        self._shm.close()
+        self._shm.unlink()
+
+async def _handle_cam(reader, writer, pool: DetectionPool, identities=None, executor=None):
+    """identities() -> identity.TrackIdentities of this camera, identify() runs on executor
+    """
+    version, camera_id, pending = await frame_protocol.accept(reader, writer)
+    print(f'Camera {camera_id}: {frame_protocol.describe(version)} framing')
+    scheduler = tracking.DetectionScheduler(DETECT_EVERY_FRAMES, TRACK_MIN_CONFIDENCE)
+    boxes_layer = overlay.BoxesLayer()
+    identities = identities() if identities is not None else None
+    embedding = None  # the identify() in flight
+    had_faces = False  # the last RESULTS sent had boxes
+    canvas = tiles.TileCanvas()  # CODEC_TILES deltas are pasted on the last frame
+
+    def label(track):
+        name = identities.name(track.id) if identities is not None else None
+        return f'{name} {track.id}' if name else str(track.id)
+
+    def detected(frame_number):
+        return lambda detection: scheduler.add_detection(frame_number, detection.boxes, detection.scores)
+
+    while True:
+        if version == frame_protocol.PROTOCOL_LEGACY:
+            header = None
+            frame = await frame_protocol.read_legacy_frame(reader, pending)
+            pending = b''
+        else:
+            header, frame = await frame_protocol.read_frame(reader)
+            if header.flags & frame_protocol.FLAG_BACKLOG:
+                continue  # not recorded here, an ack would make the client drop it from its spool
+            if version >= frame_protocol.PROTOCOL_ACKS:
+                writer.write(frame_protocol.pack_frame_ack(header.seq))  # no drain, the client reads them as they come
+            if header.flags & frame_protocol.FLAG_HEARTBEAT:
+                continue
+        if header is not None and header.codec == frame_protocol.CODEC_TILES:
+            try:
+                img = canvas.apply(tiles.decode(frame))
+            except (ValueError, struct.error) as err:
+                print(f'Bad tile update {header.seq}: {err}')
+                continue
+            img = img.copy() if img is not None else None  # the boxes are drawn on it, the next delta builds on the canvas
+        elif header is None or header.codec == frame_protocol.CODEC_JPEG:
+            img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_UNCHANGED)
+        else:
+            continue
+        if img is None:
+            continue
+        # boxes on every frame, detections arrive later and correct the tracks, the loop never waits for them
+        tracks = scheduler.track(img)
+        if scheduler.detection_due() and pool.submit(img, detected(scheduler.frame)) is not None:
+            scheduler.submitted()
+        if embedding is not None and embedding.done():
+            if embedding.exception() is not None:
+                print(f'Identify failed: {embedding.exception()!r}')
+            embedding = None
+        if identities is not None and embedding is None:
+            due = identities.due(tracks, scheduler.frame)
+            if due:
+                embedding = asyncio.get_event_loop().run_in_executor(executor, identities.identify, img.copy(), due,
+                                                                     scheduler.frame)
+        boxes = [track.box.round().astype(int).tolist() for track in tracks]
+        if (version >= frame_protocol.PROTOCOL_RESULTS and (tracks or had_faces)
+                and writer.transport.get_write_buffer_size() <= RESULTS_MAX_BUFFER):
+            names = [(identities.name(track.id) if identities is not None else None) or '' for track in tracks]
+            writer.write(frame_protocol.pack_results(header.seq, header.timestamp, boxes,
+                                                     [track.score for track in tracks], [track.id for track in tracks], names))
+            had_faces = bool(tracks)
+        boxes_layer.set([(*box, label(track)) for box, track in zip(boxes, tracks)])
+        boxes_layer.apply(img, time.time())
+        cv2.imshow('jpg', img)
+        cv2.waitKey(1)
+        await asyncio.sleep(0)  # the other cameras' turn, a buffered frame is read without yielding
+
+
+async def camera_cb(reader, writer, pool: DetectionPool, identities=None, executor=None):
+    """called whenever a new client connection is established
+    """
+    try:
+        await _handle_cam(reader, writer, pool, identities, executor)
+    except (asyncio.IncompleteReadError, ConnectionResetError, ConnectionAbortedError, frame_protocol.ProtocolError):
+        print('Lost client connection')
+        cv2.destroyAllWindows()
+
+
+async def main():
+    pool = DetectionPool()
+    identities = None
+    if IDENTITY_PATH is not None:
+        embedder = identity.create_embedder(EMBEDDER)
+        index = identity.IdentityIndex(IDENTITY_PATH, embedder.dim, min_similarity=IDENTITY_MIN_SIMILARITY)
+        print(f'Identities: {index.names()}')
+        identities = functools.partial(identity.TrackIdentities, index, embedder, IDENTITY_RETRY_FRAMES)
+    executor = concurrent.futures.ThreadPoolExecutor(1, 'embed')  # one embedder for every camera
+    server = await asyncio.start_server(functools.partial(camera_cb, pool=pool, identities=identities, executor=executor),
+                                        LOCAL_IP,
+                                        LOCAL_PORT,
+                                        limit=1024*1204*8)
+    print('Serving on {}:{}'.format(LOCAL_IP, LOCAL_PORT))
+    #async with server:
+    #    await server.serve_forever()
+    #print(dir(server))
+    await asyncio.sleep(60)
+    server.close()
+    await server.wait_closed()
+    print(f'Detection: {pool.stats()}')
+    pool.close()
+    executor.shutdown()
+
+
+if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,319 @@
+"""
+wire format shared by pi_cam_stream_client.py and pi_cam_stream_server.py
+
+# legacy (version 0)
+every JPEG is followed by FRAME_SEPARATOR, the receiver scans for it with reader.readuntil
+
+# version 1
+client                                    server
+  HELLO  magic(4) version(1) id_length(1) camera_id(id_length)  ->
+                                    <-    ACK  magic(4) version(1)
+  FRAME  header(28) payload(length) ->
+  FRAME  ...                        ->
+
+# version 2
+same as version 1, the server also answers every frame it received with
+
+  FRAME_ACK  magic(4) seq(4)        <-    server
+
+the client measures how long its frames take to arrive (pi_cam_stream_client.py rate control).
+
+# version 3
+same as version 2, a FRAME with FLAG_HEARTBEAT has no payload (length 0): the scene did not change
+since the previous frame, the client skipped it and the camera is still alive at `timestamp`.
+
+# version 4
+same as version 3, the codec can also be CODEC_TILES: a keyframe or the changed tiles since the
+previous frame (tiles.py).
+
+# version 5
+same as version 4, a FRAME with FLAG_BACKLOG was captured while the server was unreachable and
+uploaded later from the client's spool (spool.py), it is recorded by its capture time and not
+shown live. backlog frames share the sequence numbers and acks with the live frames.
+
+# version 6
+same as version 5, a FRAME with FLAG_PREVIEW belongs to a low resolution live substream, it is
+shown live and not recorded. the client sends the preview on a second connection named
+<camera id>-preview, so it never queues behind the full resolution frames.
+
+# version 7
+same as version 6, FLAG_GRAY marks a single channel JPEG (VIDEO_COLOR_GRAY on the client), the
+server decodes it with IMREAD_GRAYSCALE and records it with a single channel writer.
+
+# version 8
+same as version 7, a server that analyses the frames (face.py) may also send RESULTS, between the
+FRAME_ACKs, whenever they are ready and in any order. the client tells the two apart by their magic:
+
+  RESULTS  magic(4) seq(4) timestamp(8) count(2) names_length(2)     <-    server
+           boxes    count x 4 int16     x1, y1, x2, y2 in pixels of the frame as sent
+           scores   count float32
+           tracks   count uint32        the same id for the same face across frames
+           names    names_length bytes  UTF-8, one per box joined by newlines, empty when unknown
+
+seq and timestamp are those of the frame the boxes were found on, a RESULTS with count 0 says the
+faces of the previous one are gone.
+
+the frame header is fixed size, the receiver reads exactly `length` bytes of payload
+without looking into the JPEG data:
+
+    magic      4s  b'PCFR'
+    version    B
+    codec      B   CODEC_*
+    flags      H   FLAG_* bits
+    width      H
+    height     H
+    seq        I   sequence number, +1 per frame, wraps at 2**32
+    timestamp  d   capture time, seconds since epoch
+    length     I   payload bytes
+
+the camera id names the recording directory on the server, a legacy client is named after
+its IP address.
+
+a client that never sends HELLO is treated as a legacy client, so old clients keep working
+against a new server. a new client that gets no ACK reconnects and falls back to legacy.
+
+udp_stream.py carries the same messages over UDP, a FRAME split into datagrams.
+"""
+import asyncio
+import re
+import struct
+from typing import NamedTuple, Tuple
+
+# (chr(255)+chr(0)+chr(0)+chr(0)+chr(255)+chr(0)+chr(0)+chr(0)+chr(255)).encode('utf-8')
+FRAME_SEPARATOR = b'\xc3\xbf\x00\x00\x00\xc3\xbf\x00\x00\x00\xc3\xbf'
+SEPARATOR_LENGTH = len(FRAME_SEPARATOR)
+
+PROTOCOL_LEGACY = 0
+PROTOCOL_VERSION = 8  # highest version this side speaks
+PROTOCOL_ACKS = 2  # first version with FRAME_ACK
+PROTOCOL_HEARTBEAT = 3  # first version with FLAG_HEARTBEAT
+PROTOCOL_TILES = 4  # first version with CODEC_TILES
+PROTOCOL_BACKLOG = 5  # first version with FLAG_BACKLOG
+PROTOCOL_PREVIEW = 6  # first version with FLAG_PREVIEW
+PROTOCOL_GRAY = 7  # first version with FLAG_GRAY
+PROTOCOL_RESULTS = 8  # first version with RESULTS
+
+HELLO_MAGIC = b'PCHI'
+ACK_MAGIC = b'PCOK'
+FRAME_MAGIC = b'PCFR'
+FRAME_ACK_MAGIC = b'PCAK'
+RESULTS_MAGIC = b'PCRS'
+
+HELLO_STRUCT = struct.Struct('!4sBB')  # + camera id
+ACK_STRUCT = struct.Struct('!4sB')
+HEADER_STRUCT = struct.Struct('!4sBBHHHIdI')
+HEADER_SIZE = HEADER_STRUCT.size
+FRAME_ACK_STRUCT = struct.Struct('!4sI')
+RESULTS_STRUCT = struct.Struct('!4sIdHH')  # + boxes, scores, tracks, names
+
+CODEC_JPEG = 1
+CODEC_TILES = 2  # tiles.py
+
+FLAG_HEARTBEAT = 0x0001  # no payload, the scene is unchanged
+FLAG_BACKLOG = 0x0002  # captured during an outage, uploaded from the spool
+FLAG_PREVIEW = 0x0004  # live only substream, not recorded
+FLAG_GRAY = 0x0008  # single channel JPEG
+
+SEQ_MODULO = 1 << 32
+
+# refuse absurd lengths instead of trying to buffer them
+MAX_PAYLOAD_SIZE = 1 << 26  # 64MB
+
+NEGOTIATE_TIMEOUT = 3  # seconds a client waits for the ACK
+
+MAX_CAMERA_ID_LENGTH = 64
+
+
+class ProtocolError(Exception):
+    """the peer sent something that is not a valid message"""
+
+
+class Results(NamedTuple):
+    seq: int
+    timestamp: float
+    boxes: Tuple[Tuple[int, int, int, int], ...]
+    scores: Tuple[float, ...]
+    tracks: Tuple[int, ...]
+    names: Tuple[str, ...]
+
+
+class FrameHeader(NamedTuple):
+    version: int
+    codec: int
+    flags: int
+    width: int
+    height: int
+    seq: int
+    timestamp: float
+    length: int
+
+
+def pack_header(header: FrameHeader) -> bytes:
+    return HEADER_STRUCT.pack(FRAME_MAGIC, *header)
+
+
+def unpack_header(data) -> FrameHeader:
+    """parse HEADER_SIZE bytes (bytes, bytearray or memoryview)
+    """
+    magic, *fields = HEADER_STRUCT.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ProtocolError(f'bad frame magic {bytes(magic)!r}')
+    header = FrameHeader(*fields)
+    if header.length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f'frame too large: {header.length} bytes')
+    return header
+
+
+def make_header(seq: int,
+                timestamp: float,
+                length: int,
+                width: int = 0,
+                height: int = 0,
+                codec: int = CODEC_JPEG,
+                flags: int = 0) -> FrameHeader:
+    return FrameHeader(PROTOCOL_VERSION, codec, flags, width, height,
+                       seq % SEQ_MODULO, timestamp, length)
+
+
+def seq_gap(expected: int, seq: int) -> int:
+    """number of frames missing between the expected and the received sequence number
+    """
+    return (seq - expected) % SEQ_MODULO
+
+
+def sanitize_camera_id(camera_id: str) -> str:
+    """the camera id becomes a directory name, keep it to a safe subset
+    """
+    camera_id = re.sub(r'[^A-Za-z0-9_.-]', '_', camera_id)[:MAX_CAMERA_ID_LENGTH].strip('.')
+    return camera_id or 'camera'
+
+
+def legacy_camera_id(peername) -> str:
+    """name of a client that did not send a HELLO, its IP address
+    """
+    return sanitize_camera_id(str(peername[0]) if peername else 'legacy')
+
+
+def pack_hello(version: int, camera_id: str) -> bytes:
+    name = camera_id.encode('utf-8')[:MAX_CAMERA_ID_LENGTH]
+    return HELLO_STRUCT.pack(HELLO_MAGIC, version, len(name)) + name
+
+
+def unpack_hello(data):
+    """(version, camera id) from a complete HELLO
+    """
+    _, version, id_length = HELLO_STRUCT.unpack_from(data)
+    name = bytes(data[HELLO_STRUCT.size:HELLO_STRUCT.size + id_length])
+    return version, sanitize_camera_id(name.decode('utf-8', 'replace'))
+
+
+async def negotiate(reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter,
+                    version: int = PROTOCOL_VERSION,
+                    timeout: float = NEGOTIATE_TIMEOUT,
+                    camera_id: str = '',
+                    legacy_fallback: bool = True) -> int:
+    """client side, send HELLO and wait for the ACK
+
+    returns the agreed version, PROTOCOL_LEGACY if the server did not answer in time.
+    the connection must not be used for legacy framing after a failed negotiation,
+    the server already consumed the HELLO bytes as frame data.
+    without legacy_fallback no answer raises ProtocolError instead, a busy or restarting server
+    looks the same as an old one.
+    """
+    writer.write(pack_hello(version, camera_id))
+    await writer.drain()
+    try:
+        data = await asyncio.wait_for(reader.readexactly(ACK_STRUCT.size), timeout)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+        if legacy_fallback:
+            return PROTOCOL_LEGACY
+        raise ProtocolError(f'no ACK -> {err!r}') from err
+    magic, agreed = ACK_STRUCT.unpack(data)
+    if magic != ACK_MAGIC:
+        if legacy_fallback:
+            return PROTOCOL_LEGACY
+        raise ProtocolError(f'bad ACK magic {magic!r}')
+    return agreed
+
+
+async def accept(reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> Tuple[int, str, bytes]:
+    """server side, detect whether the client speaks a versioned protocol
+
+    returns (version, camera id, pending), pending are bytes already read from a legacy
+    client which belong to its first frame.
+    """
+    data = await reader.readexactly(len(HELLO_MAGIC))
+    if data != HELLO_MAGIC:
+        return PROTOCOL_LEGACY, legacy_camera_id(writer.get_extra_info('peername')), data
+    data += await reader.readexactly(HELLO_STRUCT.size - len(HELLO_MAGIC))
+    data += await reader.readexactly(data[-1])
+    client_version, camera_id = unpack_hello(data)
+    version = min(client_version, PROTOCOL_VERSION)
+    writer.write(ACK_STRUCT.pack(ACK_MAGIC, version))
+    await writer.drain()
+    return version, camera_id, b''
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[FrameHeader, bytes]:
+    header = unpack_header(await reader.readexactly(HEADER_SIZE))
+    payload = await reader.readexactly(header.length)
+    return header, payload
+
+
+async def read_legacy_frame(reader: asyncio.StreamReader, pending: bytes = b'') -> bytes:
+    raw_data = await reader.readuntil(separator=FRAME_SEPARATOR)  # blocked until read something
+    # truncate the separator
+    return pending + raw_data[:-SEPARATOR_LENGTH]
+
+
+def write_frame(writer: asyncio.StreamWriter, header: FrameHeader, payload) -> None:
+    writer.write(pack_header(header))
+    writer.write(payload)
+
+
+def pack_frame_ack(seq: int) -> bytes:
+    return FRAME_ACK_STRUCT.pack(FRAME_ACK_MAGIC, seq)
+
+
+async def read_frame_ack(reader: asyncio.StreamReader) -> int:
+    """client side, the seq of the next acknowledged frame
+    """
+    magic, seq = FRAME_ACK_STRUCT.unpack(await reader.readexactly(FRAME_ACK_STRUCT.size))
+    if magic != FRAME_ACK_MAGIC:
+        raise ProtocolError(f'bad ack magic {magic!r}')
+    return seq
+
+
+def pack_results(seq: int, timestamp: float, boxes=(), scores=(), tracks=(), names=()) -> bytes:
+    count = len(boxes)
+    names = '\n'.join(names or [''] * count).encode('utf-8') if count else b''
+    body = struct.pack(f'!{4 * count}h{count}f{count}I',
+                       *(max(-32768, min(32767, int(value))) for box in boxes for value in box), *scores, *tracks)
+    return RESULTS_STRUCT.pack(RESULTS_MAGIC, seq % SEQ_MODULO, timestamp, count, len(names)) + body + names
+
+
+async def read_server_message(reader: asyncio.StreamReader):
+    """client side, the seq of a FRAME_ACK or a Results (v8)
+    """
+    magic = await reader.readexactly(4)
+    if magic == FRAME_ACK_MAGIC:
+        return FRAME_ACK_STRUCT.unpack(magic + await reader.readexactly(FRAME_ACK_STRUCT.size - 4))[1]
+    if magic != RESULTS_MAGIC:
+        raise ProtocolError(f'bad message magic {magic!r}')
+    _, seq, timestamp, count, names_length = RESULTS_STRUCT.unpack(magic + await reader.readexactly(RESULTS_STRUCT.size - 4))
+    values = struct.unpack(f'!{4 * count}h{count}f{count}I', await reader.readexactly(16 * count))
+    names = (await reader.readexactly(names_length)).decode('utf-8', 'replace').split('\n') if count else []
+    boxes = tuple(tuple(values[index:index + 4]) for index in range(0, 4 * count, 4))
+    return Results(seq, timestamp, boxes, values[4 * count:5 * count], values[5 * count:], tuple(names))
+
+
+def write_legacy_frame(writer: asyncio.StreamWriter, payload) -> None:
+    writer.write(payload)
+    writer.write(FRAME_SEPARATOR)
+
+
+def describe(version: int) -> str:
+    return 'legacy separator' if version == PROTOCOL_LEGACY else f'v{version} length-prefixed'
+
@@ -0,0 +1,114 @@
+"""
+connectivity watchdog for pi_cam_stream_client.py, runs as a task on the event loop and never blocks it
+
+the stream itself is the health signal: every drained frame and every FRAME_ACK calls ok().
+only after `interval` seconds without one the watchdog probes the stream server with a TCP connect,
+every `interval` seconds while it answers, failing probes are repeated with exponential backoff
+(retry, 2*retry, ... max_backoff seconds). a probe only tells whether the server is reachable, the
+outage lasts until the stream makes progress again: a half open connection to a server that answers
+probes still stalls the stream.
+
+the longer the outage the stronger the remedy, every stage runs once per outage:
+
+    Stage(60, 'reconnect', drop_connection)                  the connection may be half open, start over
+    Stage(600, 'restart camera', camera.restart)             a wedged camera driver stops the stream too
+    Stage(3600, 'reboot', reboot, unreachable_only=True)     last resort, only while the probes fail too
+
+`connected` caches the result of the last probe for the rest of the client.
+"""
+import asyncio
+import inspect
+import logging
+import time
+from typing import Callable, NamedTuple
+
+LOG = logging.getLogger('pi_cam_client')
+
+
+class Stage(NamedTuple):
+    after: float  # seconds since the stream last made progress
+    name: str
+    action: Callable  # no arguments, may return an awaitable
+    unreachable_only: bool = False  # wait for a failed probe, not for a stalled stream alone
+
+
+class ConnectivityWatchdog:
+    """run() as a task, call ok() whenever the stream made progress
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 stages=(),
+                 interval: float = 60,
+                 timeout: float = 3,
+                 retry: float = 5,
+                 max_backoff: float = 300):
+        self.host = host
+        self.port = port
+        self.stages = sorted(stages, key=lambda stage: stage.after)
+        self.interval = interval
+        self.timeout = timeout
+        self.retry = retry
+        self.max_backoff = max_backoff
+        self.failures = 0  # consecutive failed probes
+        self.last_ok = time.monotonic()
+        self._connected = True
+        self._fired = set()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def ok(self) -> None:
+        """the stream made progress, the outage is over
+        """
+        self.last_ok = time.monotonic()
+        self._reachable()
+        self._fired.clear()
+
+    def _reachable(self) -> None:
+        if not self._connected:
+            LOG.info(f'watchdog -> server reachable again after {self.failures} failed probes')
+        self._connected = True
+        self.failures = 0
+
+    async def probe(self) -> bool:
+        """TCP connect to the stream server, closed right away
+        """
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            LOG.error(f'watchdog -> probe {self.host}:{self.port} failed -> {err!r}')
+            return False
+        writer.close()
+        return True
+
+    async def run(self) -> None:
+        while True:
+            idle = time.monotonic() - self.last_ok
+            if idle < self.interval:
+                await asyncio.sleep(self.interval - idle)
+                continue
+            if await self.probe():
+                self._reachable()  # not ok(), the stream itself has to move again
+                delay = self.interval
+            else:
+                self.failures += 1
+                self._connected = False
+                delay = min(self.max_backoff, self.retry * 2 ** (self.failures - 1))
+            outage = time.monotonic() - self.last_ok
+            for stage in self.stages:
+                if stage.unreachable_only and self._connected:
+                    continue
+                if outage >= stage.after and stage.name not in self._fired:
+                    self._fired.add(stage.name)
+                    state = 'server reachable' if self._connected else f'{self.failures} failed probes'
+                    LOG.warning(f'watchdog -> no stream progress for {outage:.0f}s ({state}), {stage.name}')
+                    try:
+                        result = stage.action()
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as err:
+                        LOG.error(f'watchdog -> {stage.name} failed -> {err}')
+            await asyncio.sleep(delay)
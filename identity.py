@@ -0,0 +1,285 @@
+"""
+who is at the door: enrolled face embeddings, matched a batch at a time
+
+    <directory>/embeddings.npy   float32 capacity x dim, one unit length embedding per row, opened with
+                                 np.load(mmap_mode='r+'): loading takes no time, pages are read on use
+    <directory>/names.json       the name of every row, null for a free row
+
+IdentityIndex.match(queries) is one matrix product for the whole batch, queries @ rows.T, and the best
+row per query. embeddings are unit length, so the cosine similarity ranks the rows in the same order as
+the L2 distance (|a - b|^2 = 2 - 2 cos). enroll() writes into free rows (the file doubles when there
+are none) and remove() frees the rows of a name, nothing is rebuilt.
+
+TrackIdentities keeps the name per tracking.py track id: a track is embedded once, an unknown one
+again after retry_frames, not on every frame.
+
+    dummy             deterministic, a fixed random projection of the middle of the box at 16x16 gray, for tests
+    face_recognition  dlib's 128-d face embeddings (face_recognition.face_encodings)
+
+python identity.py --path faces enroll alice alice1.jpg alice2.jpg
+python identity.py --path faces remove alice
+python identity.py --path faces list
+"""
+import argparse
+import collections
+import importlib
+import json
+import os
+import threading
+from typing import Dict, List
+
+import numpy as np
+import cv2
+
+import detectors
+
+EMBEDDINGS = 'embeddings.npy'
+NAMES = 'names.json'
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, np.float32).reshape(len(vectors), -1)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class Embedder:
+    """embed(image, boxes) -> len(boxes) x dim, all faces of a frame in one call
+    """
+    name = ''
+    dim = 0
+
+    def embed(self, image, boxes) -> np.ndarray:
+        raise NotImplementedError
+
+
+class DummyEmbedder(Embedder):
+    name = 'dummy'
+
+    def __init__(self, dim: int = 128, seed: int = 0):
+        self.dim = dim
+        self.projection = np.random.default_rng(seed).standard_normal((16 * 16, dim)).astype(np.float32)
+
+    def embed(self, image, boxes):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        height, width = gray.shape
+        crops = []
+        for x1, y1, x2, y2 in np.asarray(boxes, int).reshape(-1, 4):
+            # the middle of the box, a box a few pixels off does not bring in the background
+            margin_x, margin_y = (x2 - x1) // 6, (y2 - y1) // 6
+            x1, y1, x2, y2 = x1 + margin_x, y1 + margin_y, x2 - margin_x, y2 - margin_y
+            crop = gray[max(y1, 0):min(y2, height), max(x1, 0):min(x2, width)]
+            crop = cv2.resize(crop, (16, 16), interpolation=cv2.INTER_AREA) if crop.size else np.zeros((16, 16), np.uint8)
+            crop = crop.astype(np.float32).reshape(-1)
+            crops.append(crop - crop.mean())  # brightness does not change who it is
+        if not crops:
+            return np.zeros((0, self.dim), np.float32)
+        return normalize(np.stack(crops) @ self.projection)
+
+
+class FaceRecognitionEmbedder(Embedder):
+    name = 'face_recognition'
+    dim = 128
+
+    def __init__(self, jitters: int = 1):
+        self.face_recognition = importlib.import_module('face_recognition')
+        self.jitters = jitters
+
+    def embed(self, image, boxes):
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        locations = [(int(y1), int(x2), int(y2), int(x1)) for x1, y1, x2, y2 in np.asarray(boxes).reshape(-1, 4)]
+        if not locations:
+            return np.zeros((0, self.dim), np.float32)
+        return normalize(self.face_recognition.face_encodings(rgb, locations, self.jitters))
+
+
+EMBEDDERS = {embedder.name: embedder for embedder in (DummyEmbedder, FaceRecognitionEmbedder)}
+
+
+def create_embedder(name: str, **options) -> Embedder:
+    if name not in EMBEDDERS:
+        raise ValueError(f'unknown embedder {name}, known: {", ".join(EMBEDDERS)}')
+    return EMBEDDERS[name](**options)
+
+
+class IdentityIndex:
+    """the enrolled embeddings of one directory, thread safe
+    """
+
+    def __init__(self, directory: str, dim: int = 128, capacity: int = 1024, min_similarity: float = 0.8):
+        self.directory = directory
+        self.min_similarity = min_similarity  # best match below this is unknown (None)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, EMBEDDINGS)
+        if os.path.exists(path):
+            self._matrix = np.load(path, mmap_mode='r+')
+            if self._matrix.shape[1] != dim:
+                raise ValueError(f'{path} holds {self._matrix.shape[1]}-d embeddings, not {dim}-d')
+            with open(os.path.join(directory, NAMES)) as names:
+                self._names = json.load(names)
+        else:
+            self._matrix = np.lib.format.open_memmap(path, 'w+', np.float32, (capacity, dim))
+            self._names = [None] * capacity
+            self._save_names()
+        self._valid = np.array([name is not None for name in self._names], bool)
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1]
+
+    def __len__(self):
+        return int(self._valid.sum())
+
+    def names(self) -> Dict[str, int]:
+        """name -> enrolled embeddings
+        """
+        return dict(collections.Counter(name for name in self._names if name is not None))
+
+    def _save_names(self):
+        path = os.path.join(self.directory, NAMES)
+        with open(path + '.tmp', 'w') as names:
+            json.dump(self._names, names)
+        os.replace(path + '.tmp', path)
+
+    def _grow(self, rows: int):
+        capacity = len(self._names)
+        while capacity - len(self) < rows:
+            capacity *= 2
+        path = os.path.join(self.directory, EMBEDDINGS)
+        grown = np.lib.format.open_memmap(path + '.tmp', 'w+', np.float32, (capacity, self.dim))
+        grown[:len(self._names)] = self._matrix
+        grown.flush()
+        del grown
+        self._matrix = None  # the old mapping, before it is replaced
+        os.replace(path + '.tmp', path)
+        self._matrix = np.load(path, mmap_mode='r+')
+        self._names.extend([None] * (capacity - len(self._names)))
+        self._valid = np.concatenate([self._valid, np.zeros(capacity - len(self._valid), bool)])
+
+    def enroll(self, name: str, embeddings) -> List[int]:
+        """add embeddings of name into free rows, returns the rows
+        """
+        embeddings = normalize(embeddings)
+        with self._lock:
+            free = np.flatnonzero(~self._valid)
+            if len(free) < len(embeddings):
+                self._grow(len(embeddings))
+                free = np.flatnonzero(~self._valid)
+            rows = free[:len(embeddings)]
+            self._matrix[rows] = embeddings
+            self._matrix.flush()
+            for row in rows:
+                self._names[row] = name
+            self._valid[rows] = True
+            self._save_names()
+            return rows.tolist()
+
+    def remove(self, name: str) -> int:
+        """free every row of name, returns how many
+        """
+        with self._lock:
+            rows = [row for row, enrolled in enumerate(self._names) if enrolled == name]
+            if not rows:
+                return 0
+            self._matrix[rows] = 0
+            self._matrix.flush()
+            for row in rows:
+                self._names[row] = None
+            self._valid[rows] = False
+            self._save_names()
+            return len(rows)
+
+    def match(self, queries):
+        """(names, similarities) of the best enrolled row per query, the name is None below min_similarity
+        """
+        queries = normalize(queries)
+        with self._lock:
+            if not len(queries) or not self._valid.any():
+                return [None] * len(queries), np.zeros(len(queries), np.float32)
+            used = int(np.flatnonzero(self._valid)[-1]) + 1  # rows after the last enrolled one are all free
+            similarities = queries @ self._matrix[:used].T
+            similarities[:, ~self._valid[:used]] = -np.inf
+            best = np.argmax(similarities, axis=1)
+            scores = similarities[np.arange(len(queries)), best]
+            names = [self._names[row] if score >= self.min_similarity else None for row, score in zip(best, scores)]
+        return names, scores
+
+
+class TrackIdentities:
+    """name per track id, identify() the tracks due() returns, from any one thread at a time
+    """
+
+    def __init__(self, index: IdentityIndex, embedder: Embedder, retry_frames: int = 30):
+        self.index = index
+        self.embedder = embedder
+        self.retry_frames = retry_frames
+        self.embedded = 0  # faces embedded
+        self._known = {}  # track id -> (name, similarity, frame)
+
+    def due(self, tracks, frame: int) -> list:
+        """tracks never embedded, and unknown ones not tried for retry_frames. forgets tracks that are gone
+        """
+        live = {track.id for track in tracks}
+        for track_id in [track_id for track_id in self._known if track_id not in live]:
+            del self._known[track_id]
+        due = []
+        for track in tracks:
+            known = self._known.get(track.id)
+            if known is None or (known[0] is None and frame - known[2] >= self.retry_frames):
+                due.append(track)
+        return due
+
+    def identify(self, image, tracks, frame: int) -> None:
+        """embed the tracks' faces in one call and match them in one call
+        """
+        if not tracks:
+            return
+        embeddings = self.embedder.embed(image, np.stack([track.box for track in tracks]))
+        names, similarities = self.index.match(embeddings)
+        self.embedded += len(tracks)
+        for track, name, similarity in zip(tracks, names, similarities):
+            self._known[track.id] = (name, float(similarity), frame)
+
+    def name(self, track_id: int):
+        known = self._known.get(track_id)
+        return known[0] if known else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', required=True, help='index directory, IDENTITY_PATH of face.py')
+    parser.add_argument('--embedder', choices=list(EMBEDDERS), default='face_recognition')
+    parser.add_argument('--detector', default='haar', help='finds the face in the enrollment images')
+    commands = parser.add_subparsers(dest='command', required=True)
+    enroll = commands.add_parser('enroll', help='the largest face of every image')
+    enroll.add_argument('name')
+    enroll.add_argument('images', nargs='+')
+    remove = commands.add_parser('remove')
+    remove.add_argument('name')
+    commands.add_parser('list')
+    args = parser.parse_args()
+
+    embedder = create_embedder(args.embedder)
+    index = IdentityIndex(args.path, embedder.dim)
+    if args.command == 'enroll':
+        detector = detectors.create(args.detector)
+        embeddings = []
+        for path in args.images:
+            image = cv2.imread(path)
+            boxes, _ = detector.detect([image])[0] if image is not None else (detectors.EMPTY_BOXES, None)
+            if not len(boxes):
+                print(f'{path}: no face')
+                continue
+            largest = boxes[np.argmax((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))]
+            embeddings.append(embedder.embed(image, largest[None])[0])
+        if embeddings:
+            index.enroll(args.name, np.stack(embeddings))
+        print(f'{args.name}: {len(embeddings)} embeddings enrolled')
+    elif args.command == 'remove':
+        print(f'{args.name}: {index.remove(args.name)} embeddings removed')
+    for name, count in sorted(index.names().items()):
+        print(f'{name:20} {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+zero-copy ingest for pi_cam_stream_server.py
+
+asyncio.StreamReader copies every frame several times before it reaches cv2.imdecode:
+the transport hands over a new bytes object per recv, feed_data appends it to the reader's
+bytearray, readuntil slices it out and converts it to bytes, and the caller slices off the
+separator and copies it once more into a numpy array.
+
+FrameIngestProtocol lets the event loop recv_into a preallocated per-connection buffer and
+hands the payload of every complete frame to the session as a memoryview of that buffer,
+np.frombuffer on it gives cv2.imdecode the pixels without any further copy.
+
+the buffer is used as a ring: consumed bytes are not moved, reading continues at the tail,
+and only when the tail runs out of room the unread bytes (a partial frame at most) are
+moved back to the front. a frame larger than the buffer grows it to the next power of two.
+
+the memoryview passed to session.on_frame is only valid during the call, it is overwritten
+by the next frames. copy it with bytes() to keep it.
+"""
+import asyncio
+
+import frame_protocol
+
+INITIAL_BUFFER_SIZE = 1 << 20  # 1MB, a 1280x720 JPEG is ~100KB
+MIN_READ_SIZE = 1 << 16  # never offer the transport less room than this
+
+
+class FrameIngestProtocol(asyncio.BufferedProtocol):
+    """parse frames straight out of a preallocated receive buffer
+
+    session_factory(transport, camera_id, version) is called once the HELLO (or the first bytes of a
+    legacy client) arrived, and returns an object with
+        on_frame(header, payload): header is None for legacy clients, payload a memoryview
+        close(): called once when the connection is gone
+    """
+
+    def __init__(self, session_factory, buffer_size: int = INITIAL_BUFFER_SIZE):
+        self._session_factory = session_factory
+        self._session = None
+        self._transport = None
+        self._peername = None
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first unread byte
+        self._end = 0  # first free byte
+        self._scan = 0  # legacy framing: separator search resumes here
+        self._need = len(frame_protocol.HELLO_MAGIC)  # bytes wanted before _parse can progress
+        self._state = self._parse_hello
+        self._header = None
+        self.version = None
+        self.grow_count = 0
+        self.compact_bytes = 0  # bytes moved to the front, should stay far below bytes received
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._peername = transport.get_extra_info('peername')
+
+    def get_buffer(self, sizehint):
+        if len(self._buffer) - self._end < max(MIN_READ_SIZE, self._need - (self._end - self._start)):
+            self._make_room()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        try:
+            while self._state():
+                pass
+        except frame_protocol.ProtocolError as err:
+            print(f'Protocol error: {err}')
+            self._transport.close()
+
+    def eof_received(self):
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    # buffer management
+
+    def _make_room(self):
+        unread = self._end - self._start
+        wanted = max(self._need, unread) + MIN_READ_SIZE
+        if wanted > len(self._buffer):  # oversize frame, grow
+            size = len(self._buffer)
+            while size < wanted:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:unread] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self.grow_count += 1
+            print(f'Receive buffer grown to {size} bytes')
+        elif unread:
+            self._view[:unread] = self._view[self._start:self._end]
+            self.compact_bytes += unread
+        self._scan -= self._start
+        self._start = 0
+        self._end = unread
+
+    def _consume(self, nbytes):
+        self._start += nbytes
+        if self._start == self._end:  # nothing pending, restart at the front for free
+            self._start = self._end = self._scan = 0
+
+    def _start_session(self, camera_id):
+        print(f'Client {self._peername}: camera {camera_id}, {frame_protocol.describe(self.version)} framing')
+        self._session = self._session_factory(self._transport, camera_id, self.version)
+
+    # parser states, return True while progress is possible
+
+    def _parse_hello(self):
+        magic_size = len(frame_protocol.HELLO_MAGIC)
+        if self._end - self._start < magic_size:
+            return False
+        if self._view[self._start:self._start + magic_size] != frame_protocol.HELLO_MAGIC:
+            # legacy client, these bytes are already the first JPEG
+            self.version = frame_protocol.PROTOCOL_LEGACY
+            self._scan = self._start
+            self._need = 0
+            self._state = self._parse_legacy
+            self._start_session(frame_protocol.legacy_camera_id(self._peername))
+            return True
+        if self._end - self._start < frame_protocol.HELLO_STRUCT.size:
+            self._need = frame_protocol.HELLO_STRUCT.size
+            return False
+        hello_size = frame_protocol.HELLO_STRUCT.size + self._buffer[self._start + frame_protocol.HELLO_STRUCT.size - 1]
+        if self._end - self._start < hello_size:
+            self._need = hello_size
+            return False
+        client_version, camera_id = frame_protocol.unpack_hello(self._view[self._start:self._start + hello_size])
+        self._consume(hello_size)
+        self.version = min(client_version, frame_protocol.PROTOCOL_VERSION)
+        self._transport.write(frame_protocol.ACK_STRUCT.pack(frame_protocol.ACK_MAGIC, self.version))
+        self._start_session(camera_id)
+        self._need = frame_protocol.HEADER_SIZE
+        self._state = self._parse_header
+        return True
+
+    def _parse_header(self):
+        if self._end - self._start < frame_protocol.HEADER_SIZE:
+            return False
+        self._header = frame_protocol.unpack_header(self._view[self._start:self._start + frame_protocol.HEADER_SIZE])
+        self._consume(frame_protocol.HEADER_SIZE)
+        self._need = self._header.length
+        self._state = self._parse_payload
+        return True
+
+    def _parse_payload(self):
+        length = self._header.length
+        if self._end - self._start < length:
+            return False
+        payload = self._view[self._start:self._start + length]
+        self._session.on_frame(self._header, payload)
+        self._consume(length)
+        self._need = frame_protocol.HEADER_SIZE
+        self._state = self._parse_header
+        return True
+
+    def _parse_legacy(self):
+        sep = frame_protocol.FRAME_SEPARATOR
+        pos = self._buffer.find(sep, self._scan, self._end)
+        if pos < 0:
+            # only the last few bytes can still be the start of a separator
+            self._scan = max(self._start, self._end - len(sep) + 1)
+            return False
+        payload = self._view[self._start:pos]
+        self._session.on_frame(None, payload)
+        self._consume(pos + len(sep) - self._start)
+        self._scan = self._start
+        return True
@@ -0,0 +1,205 @@
+"""
+live view of the incoming camera streams over HTTP, MJPEG as multipart/x-mixed-replace
+
+the server publishes the received JPEG bytes as they are, every viewer of a camera gets the
+same bytes object, nothing is decoded or encoded for the live view.
+
+    GET /                 camera list
+    GET /camera/<id>      MJPEG stream, plays in a browser <img> tag, VLC, ffplay
+    GET /stats            viewer counters as JSON
+
+every viewer holds at most one frame: a new frame replaces the one it has not sent yet, so a
+slow viewer skips to the latest frame and only its own socket waits. publish() never blocks.
+"""
+import asyncio
+import functools
+import json
+
+BOUNDARY = b'frame'
+REQUEST_TIMEOUT = 10  # seconds to send the request line and headers
+MAX_HEADER_LINES = 100
+
+
+class Viewer:
+    """the frame slot of one HTTP connection
+    """
+
+    def __init__(self, peername):
+        self.peername = peername
+        self.sent = 0
+        self.skipped = 0
+        self._frame = None
+        self._closed = False
+        self._ready = asyncio.Event()
+
+    def offer(self, jpeg) -> None:
+        if self._frame is not None:
+            self.skipped += 1
+        self._frame = jpeg
+        self._ready.set()
+
+    def end(self) -> None:
+        self._closed = True
+        self._ready.set()
+
+    async def next_frame(self):
+        """the latest frame, None once the camera is gone
+        """
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        if frame is None and self._closed:
+            return None
+        return frame
+
+
+class LiveHub:
+    """cameras of this process and their viewers, only used from the event loop
+    """
+
+    def __init__(self):
+        self._viewers = {}  # camera id -> set of Viewer
+        self._published = {}  # camera id -> frames
+        self._owners = {}  # camera id -> the session that added it last
+
+    def add_camera(self, camera_id: str, owner=None) -> None:
+        """a reconnecting camera takes over the entry and its viewers from its old connection
+        """
+        self._viewers.setdefault(camera_id, set())
+        self._published.setdefault(camera_id, 0)
+        self._owners[camera_id] = owner
+
+    def remove_camera(self, camera_id: str, owner=None) -> bool:
+        """False when owner is not the one that added the camera last, e.g. a half open connection
+        closed after the camera reconnected
+        """
+        if camera_id not in self._viewers or self._owners.get(camera_id) is not owner:
+            return False
+        for viewer in self._viewers.pop(camera_id):
+            viewer.end()
+        self._published.pop(camera_id, None)
+        self._owners.pop(camera_id, None)
+        return True
+
+    def cameras(self):
+        return sorted(self._viewers)
+
+    def viewers(self, camera_id: str) -> int:
+        return len(self._viewers.get(camera_id, ()))
+
+    def publish(self, camera_id: str, jpeg) -> None:
+        """jpeg must be immutable (bytes), the viewers send it after this returns
+        """
+        viewers = self._viewers.get(camera_id)
+        if viewers is None:
+            return
+        self._published[camera_id] += 1
+        for viewer in viewers:
+            viewer.offer(jpeg)
+
+    def add_viewer(self, camera_id: str, peername) -> Viewer:
+        viewer = Viewer(peername)
+        self._viewers[camera_id].add(viewer)
+        return viewer
+
+    def remove_viewer(self, camera_id: str, viewer: Viewer) -> None:
+        viewers = self._viewers.get(camera_id)
+        if viewers is not None:
+            viewers.discard(viewer)
+
+    def stats(self) -> dict:
+        return {
+            camera_id: {
+                'frames': self._published[camera_id],
+                'viewers': len(viewers),
+                'sent': sum(viewer.sent for viewer in viewers),
+                'skipped': sum(viewer.skipped for viewer in viewers),
+            }
+            for camera_id, viewers in self._viewers.items()
+        }
+
+
+def _response(writer, status: str, content_type: str, body: bytes = b'', headers=()) -> None:
+    head = [f'HTTP/1.0 {status}', f'Content-Type: {content_type}', f'Content-Length: {len(body)}',
+            'Cache-Control: no-cache', 'Connection: close', *headers]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+
+
+async def _read_request(reader):
+    """(path, headers) of a GET request, None for anything else
+    """
+    request_line = await reader.readline()
+    parts = request_line.decode('latin-1').split()
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if len(parts) < 2 or parts[0] != 'GET':
+        return None
+    return parts[1].split('?')[0], headers
+
+
+async def _stream(hub: LiveHub, camera_id: str, reader, writer) -> None:
+    viewer = hub.add_viewer(camera_id, writer.get_extra_info('peername'))
+    writer.write(b'HTTP/1.0 200 OK\r\n'
+                 b'Content-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY + b'\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Connection: close\r\n\r\n')
+    try:
+        while True:
+            jpeg = await viewer.next_frame()
+            if jpeg is None:
+                break
+            writer.write(b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (BOUNDARY, len(jpeg)))
+            writer.write(jpeg)
+            writer.write(b'\r\n')
+            await writer.drain()  # only this viewer waits for its socket
+            viewer.sent += 1
+    finally:
+        hub.remove_viewer(camera_id, viewer)
+
+
+async def handle_http(hub: LiveHub, locate, reader, writer):
+    """one HTTP connection
+
+    locate(camera_id) -> port of the worker process that has the camera or None, used to
+    redirect viewers that landed on a worker without it
+    """
+    try:
+        request = await asyncio.wait_for(_read_request(reader), REQUEST_TIMEOUT)
+        if request is None:
+            _response(writer, '405 Method Not Allowed', 'text/plain', b'GET only\n')
+            return
+        path, headers = request
+        if path == '/':
+            links = ''.join(f'<li><a href="/camera/{camera_id}">{camera_id}</a></li>' for camera_id in hub.cameras())
+            _response(writer, '200 OK', 'text/html', f'<html><body><ul>{links}</ul></body></html>'.encode())
+        elif path == '/stats':
+            _response(writer, '200 OK', 'application/json', json.dumps(hub.stats()).encode())
+        elif path.startswith('/camera/'):
+            camera_id = path[len('/camera/'):]
+            if camera_id in hub.cameras():
+                await _stream(hub, camera_id, reader, writer)
+                return
+            port = locate(camera_id) if locate is not None else None
+            if port is None:
+                _response(writer, '404 Not Found', 'text/plain', b'no such camera\n')
+                return
+            host = headers.get('host', '').rsplit(':', 1)[0] or writer.get_extra_info('sockname')[0]
+            _response(writer, '307 Temporary Redirect', 'text/plain',
+                      headers=[f'Location: http://{host}:{port}{path}'])
+        else:
+            _response(writer, '404 Not Found', 'text/plain', b'not found\n')
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(hub: LiveHub, locate=None, **address):
+    """address: host/port/reuse_port or sock, like asyncio.start_server
+    """
+    return await asyncio.start_server(functools.partial(handle_http, hub, locate), **address)
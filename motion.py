@@ -0,0 +1,147 @@
+"""
+motion gated recording for pi_cam_stream_server.py, static scene suppression for pi_cam_stream_client.py
+
+    small_gray(jpeg)       1/4 size grayscale decode, libjpeg skips most of the work (IMREAD_REDUCED_GRAYSCALE_4)
+    MotionDetector.score   fraction of pixels that differ from a running background, numpy/cv2 only
+    MotionGate.feed        keeps the last pre_roll_seconds of frames in a bounded ring, when the score
+                           crosses the threshold it returns the pre-roll followed by every frame up to
+                           post_roll_seconds after the last motion
+
+the ring holds the compressed JPEGs, an idle scene costs one reduced decode per frame and no
+disk writes.
+
+    SceneChangeFilter      client side (pi_cam_stream_client.py), compares a captured frame with the
+                           last one sent on a small grayscale copy, unchanged frames are not encoded
+"""
+import collections
+import threading
+
+import numpy as np
+import cv2
+
+
+def small_gray(jpeg):
+    """grayscale frame at 1/4 of the width and height, None if jpeg does not decode
+    """
+    return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+
+def reduce_gray(frame):
+    """small_gray of an already decoded frame
+    """
+    small = cv2.resize(frame, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+
+class MotionDetector:
+    """compares every frame with a slowly adapting background, so light changes do not count as motion
+    """
+
+    def __init__(self, pixel_threshold: int = 25, learning_rate: float = 0.05):
+        self.pixel_threshold = pixel_threshold
+        self.learning_rate = learning_rate
+        self._background = None
+
+    def score(self, gray) -> float:
+        """fraction of pixels that changed, 0.0 for the first frame and for frames that did not decode
+        """
+        if gray is None:
+            return 0.0
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)  # sensor noise
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype(np.float32)
+            return 0.0
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self._background))
+        cv2.accumulateWeighted(gray, self._background, self.learning_rate)
+        return np.count_nonzero(diff > self.pixel_threshold) / diff.size
+
+
+class MotionGate:
+    """decides which frames get recorded, feed it every frame in capture order
+    """
+
+    def __init__(self,
+                 threshold: float = 0.01,
+                 pre_roll_seconds: float = 5,
+                 post_roll_seconds: float = 10,
+                 max_pre_roll_frames: int = 300):
+        self.threshold = threshold
+        self.pre_roll_seconds = pre_roll_seconds
+        self.post_roll_seconds = post_roll_seconds
+        self.recording = False
+        self.events = 0
+        self.skipped = 0
+        self._pre_roll = collections.deque(maxlen=max_pre_roll_frames)
+        self._last_motion = None
+
+    def feed(self, timestamp: float, item, score: float) -> list:
+        """returns the (timestamp, item) pairs to record now, oldest first, usually none or one
+        """
+        if score >= self.threshold:
+            self._last_motion = timestamp
+            if not self.recording:
+                self.recording = True
+                self.events += 1
+                frames = list(self._pre_roll)
+                self._pre_roll.clear()
+                frames.append((timestamp, item))
+                return frames
+        if self.recording:
+            if timestamp - self._last_motion <= self.post_roll_seconds:
+                return [(timestamp, item)]
+            self.recording = False
+        if len(self._pre_roll) == self._pre_roll.maxlen:
+            self.skipped += 1
+        self._pre_roll.append((timestamp, item))
+        while self._pre_roll and self._pre_roll[0][0] < timestamp - self.pre_roll_seconds:
+            self._pre_roll.popleft()
+            self.skipped += 1
+        return []
+
+
+class SceneChangeFilter:
+    """static scene suppression, called from the encoder threads before the JPEG encode
+
+    the reference is the last frame that passed, not the previous capture, so a slow drift
+    (dusk, shadows) adds up until it counts as a change
+    """
+
+    def __init__(self, threshold: float = 0.002, pixel_threshold: int = 12, width: int = 160):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.changed = 0
+        self.unchanged = 0
+        self._reference = None
+        self._lock = threading.Lock()
+
+    def small_gray(self, frame):
+        height = max(1, frame.shape[0] * self.width // frame.shape[1])
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def score(self, gray) -> float:
+        """fraction of pixels that differ from the reference, 1.0 without one
+        """
+        reference = self._reference
+        if reference is None or reference.shape != gray.shape:
+            return 1.0
+        return np.count_nonzero(cv2.absdiff(gray, reference) > self.pixel_threshold) / gray.size
+
+    def check(self, frame) -> bool:
+        """True if frame should be sent, it becomes the new reference
+        """
+        gray = self.small_gray(frame)
+        with self._lock:
+            if self.score(gray) < self.threshold:
+                self.unchanged += 1
+                return False
+            self._reference = gray
+            self.changed += 1
+            return True
+
+    def reset(self) -> None:
+        """the next frame passes, e.g. on a new connection
+        """
+        with self._lock:
+            self._reference = None
@@ -0,0 +1,217 @@
+"""
+cached overlays burned into frames: capture time, camera name, detection boxes
+
+cv2.putText over a full frame for every frame costs more than the text is worth, and the text only
+changes once per second. every layer renders its content into a small patch (color and alpha, the
+alpha is the anti-aliased text mask) and keeps it until the content changes, a frame only pays for
+blending the patches into their regions:
+
+    roi = roi * (255 - alpha) / 255 + color * alpha / 255     cv2.multiply + cv2.add over the patch only,
+                                                              the second term is part of the patch
+
+    TimestampLayer   capture time in a timezone resolved once per process, new patch every second
+    TextLayer        fixed text, e.g. the camera id, rendered once
+    BoxesLayer       detection boxes, outlines with cv2.rectangle, label patches cached by label
+    Compositor       the layers of a frame layout, apply(frame, timestamp) in place
+
+positions are (x, y) of the patch's top left corner in pixels, a negative value counts from the
+right / bottom edge of the frame. single channel frames get the patches in gray (the brightest
+channel of the color), green text would be dark on an IR image. everything is thread safe,
+the decode threads share one Compositor per camera.
+"""
+import datetime
+import functools
+import threading
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import cv2
+import pytz
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str):
+    """pytz.timezone parses the zone file on every call, once per process is enough
+    """
+    return pytz.timezone(name)
+
+
+class Patch(NamedTuple):
+    color: np.ndarray  # uint8 color * alpha / 255, h x w x channels or h x w for one channel
+    inverse: np.ndarray  # uint8 255 - alpha, the same shape
+
+
+def render_text(text: str, color=(0, 255, 0), scale: float = 0.8, thickness: int = 2):
+    """(bgr, alpha) uint8 images just large enough for text
+    """
+    (width, height), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+    pad = thickness
+    alpha = np.zeros((height + baseline + 2 * pad, width + 2 * pad), np.uint8)
+    cv2.putText(alpha, text, (pad, height + pad), FONT, scale, 255, thickness, cv2.LINE_AA)
+    bgr = np.empty(alpha.shape + (3,), np.uint8)
+    bgr[:] = color
+    return bgr, alpha
+
+
+def make_patch(bgr, alpha, channels: int = 3) -> Patch:
+    if channels == 1:
+        bgr = bgr.max(axis=2)
+    else:
+        alpha = cv2.merge([alpha] * channels)
+    return Patch(cv2.multiply(bgr, alpha, scale=1 / 255), 255 - alpha)
+
+
+def blend(frame, patch: Patch, x: int, y: int) -> None:
+    """alpha blend patch into frame at (x, y), negative counts from the right / bottom, clipped at the edges
+    """
+    frame_height, frame_width = frame.shape[:2]
+    height, width = patch.inverse.shape[:2]
+    if x < 0:
+        x += frame_width - width
+    if y < 0:
+        y += frame_height - height
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, frame_width), min(y + height, frame_height)
+    if left >= right or top >= bottom:
+        return
+    view = (slice(top - y, bottom - y), slice(left - x, right - x))
+    roi = frame[top:bottom, left:right]
+    cv2.add(cv2.multiply(roi, patch.inverse[view], scale=1 / 255), patch.color[view], dst=roi)  # in place, roi is a view
+
+
+class Layer:
+    """content(timestamp) -> hashable, render(content) -> (bgr, alpha), the patch is kept per content
+    """
+
+    def __init__(self, position: Tuple[int, int]):
+        self.position = position
+        self.renders = 0
+        self._cache = (None, {})  # content, channels -> Patch
+        self._lock = threading.Lock()
+
+    def content(self, timestamp: float):
+        raise NotImplementedError
+
+    def render(self, content):
+        raise NotImplementedError
+
+    def patch(self, timestamp: float, channels: int = 3) -> Patch:
+        content = self.content(timestamp)
+        cached, patches = self._cache
+        if cached != content or channels not in patches:
+            with self._lock:
+                cached, patches = self._cache
+                if cached != content:
+                    patches = {}
+                if channels not in patches:
+                    patches = dict(patches)
+                    patches[channels] = make_patch(*self.render(content), channels)
+                    self.renders += 1
+                self._cache = (content, patches)
+        return patches[channels]
+
+    def apply(self, frame, timestamp: float) -> None:
+        blend(frame, self.patch(timestamp, 1 if frame.ndim == 2 else frame.shape[2]), *self.position)
+
+
+class TextLayer(Layer):
+
+    def __init__(self, text: str, position=(10, -10), color=(0, 255, 0), scale: float = 0.8, thickness: int = 2):
+        super().__init__(position)
+        self.text = text
+        self.color = color
+        self.scale = scale
+        self.thickness = thickness
+
+    def content(self, timestamp):
+        return self.text
+
+    def render(self, content):
+        return render_text(content, self.color, self.scale, self.thickness)
+
+
+class TimestampLayer(TextLayer):
+    """the capture time to the second, strftime fmt in timezone
+    """
+
+    def __init__(self,
+                 timezone: str = 'US/Pacific',
+                 fmt: str = '%Z: %m/%d/%Y %H:%M:%S',
+                 position=(10, 30),
+                 color=(0, 255, 0),
+                 scale: float = 0.8,
+                 thickness: int = 2):
+        super().__init__(fmt, position, color, scale, thickness)
+        self.timezone = get_timezone(timezone)
+
+    def content(self, timestamp):
+        return int(timestamp)
+
+    def render(self, content):
+        text = datetime.datetime.fromtimestamp(content, self.timezone).strftime(self.text)
+        return render_text(text, self.color, self.scale, self.thickness)
+
+
+class Box(NamedTuple):
+    x1: int
+    y1: int
+    x2: int
+    y2: int
+    label: str = ''
+
+
+class BoxesLayer:
+    """detection boxes, set() them whenever the detector has new ones
+    """
+
+    def __init__(self, color=(0, 255, 0), thickness: int = 2, scale: float = 0.5, max_labels: int = 64):
+        self.color = color
+        self.thickness = thickness
+        self.scale = scale
+        self.max_labels = max_labels
+        self.boxes: List[Box] = []
+        self._labels = {}  # (label, channels) -> Patch
+
+    def set(self, boxes) -> None:
+        self.boxes = [Box(*box) for box in boxes]
+
+    def label_patch(self, label: str, channels: int) -> Patch:
+        patch = self._labels.get((label, channels))
+        if patch is None:
+            if len(self._labels) >= self.max_labels:
+                self._labels.clear()
+            patch = self._labels[(label, channels)] = make_patch(*render_text(label, self.color, self.scale, 1), channels)
+        return patch
+
+    def apply(self, frame, timestamp: float) -> None:
+        channels = 1 if frame.ndim == 2 else frame.shape[2]
+        color = max(self.color) if channels == 1 else self.color
+        for box in self.boxes:  # a reference, set() replaces the list
+            cv2.rectangle(frame, (box.x1, box.y1), (box.x2, box.y2), color, self.thickness)
+            if box.label:
+                patch = self.label_patch(box.label, channels)
+                blend(frame, patch, max(0, box.x1), max(0, box.y1 - patch.inverse.shape[0]))  # >= 0, not from the right
+
+
+class Compositor:
+    """the layers of one frame layout, applied in order
+    """
+
+    def __init__(self, layers=()):
+        self.layers = list(layers)
+
+    def apply(self, frame, timestamp: float):
+        """in place, returns frame
+        """
+        for layer in self.layers:
+            layer.apply(frame, timestamp)
+        return frame
+
+
+@functools.lru_cache(maxsize=None)
+def timestamp_compositor(timezone: str) -> Compositor:
+    """the default layout, the capture time in the top left corner
+    """
+    return Compositor([TimestampLayer(timezone)])
@@ -1,147 +1,585 @@
-#pylint: disable=missing-docstring, C0301, E1101, W0703
-
-"""
-# 1. install dependencies
-sudo apt install -y libatlas-base-dev
-pip install opencv-python==3.4.17.61
-pip install numpy==1.22.2
-pip install schedule==1.1.0
-
-
-# 2. autostart when system rebooted
-
-```bash
-# 1. use contab
-crontab -e
-# 2. append this line to the end, save then exit
-@reboot /usr/bin/python /home/pi/Desktop/pi_cam_stream_client.py
-# 3. reboot the board
-```
-
-# 3. enable camera
-```bash
-sudo raspi-config
-"3. Interface Options"  -> "I1 Legacy Camera" -> "Yes" -> "Finish" -> "Reboot"
-```
-
-"""
-import os
-import sys
-import time
-import asyncio
-import datetime
-import socket
-import logging
-
-import cv2
-
-assert sys.version_info >= (3, 5, 2)
-
-# (chr(255)+chr(0)+chr(0)+chr(0)+chr(255)+chr(0)+chr(0)+chr(0)+chr(255)).encode('utf-8')
-FRAME_SEPARATOR = b'\xc3\xbf\x00\x00\x00\xc3\xbf\x00\x00\x00\xc3\xbf'
-
-# send video stream to this server
-SERVER_IP = '10.0.0.99'
-SERVER_PORT = 8888
-
-# only capture videos during night (8pm to 8am)
-CAPTURE_HOURS = set([20, 21, 22, 23, 0, 1, 2, 3, 4, 5, 6, 7, 8])
-
-
-logging.basicConfig(filename='default.log',
-                    filemode='a',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.DEBUG)
-
-LOG = logging.getLogger('pi_cam_client')
-
-
-def internet_connected(host="8.8.8.8", port=53, timeout=3):
-    """
-    Host: 8.8.8.8 (google-public-dns-a.google.com)
-    OpenPort: 53/tcp
-    Service: domain (DNS/TCP)
-    """
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        LOG.info(f'test internet connection [OK]')
-        return True
-    except socket.error as ex:
-        LOG.error(f'test internet connection [Failed], {ex}')
-        return False
-
-
-async def connect_server() -> None:
-    """connect to server
-    """
-    while True:
-        try:
-            LOG.info(f'connect server -> {SERVER_IP}:{SERVER_PORT}')
-            reader, writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
-            return reader, writer
-        except Exception as err:
-            LOG.error(f'failed to connect server -> {err}')
-        time.sleep(1)
-
-
-async def client_camera(video_width=1280,
-                        video_height=720,
-                        video_color_gray=False) -> None:
-    """
-    start the camera
-
-    """
-    # connect to server
-    reader, writer = await connect_server()
-    LOG.info('server connected')
-
-    # start camera
-    cap = cv2.VideoCapture(0)
-    cap.set(3, video_width)  # width, max 3280
-    cap.set(4, video_height)  # height, max 2464
-    cap.set(5, 24)  # Frame Per Second
-    LOG.info('camera connected')
-
-    start_time = time.time()
-    while True:
-        try:
-            if int(time.time() - start_time) % 60 == 0:  # every minute check out if internet connection OK
-                if not internet_connected():
-                    LOG.error('internet disconnected, reboot the machine')
-                    time.sleep(60)  # wait for a minute
-                    os.system('sudo reboot')
-
-            hour = datetime.datetime.now().hour
-            if hour not in CAPTURE_HOURS:  # only capture video within CAPTURE_HOURS
-                time_seconds_to_sleep = int(20 - hour) * 3600  # 20 is '8pm'
-                LOG.info('hibernate')
-                time.sleep(time_seconds_to_sleep)  # hibernate
-
-            _, frame = cap.read()
-            if video_color_gray:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            #frame = cv2.flip(frame, 0)  # vertical flip
-            frame = cv2.flip(frame, -1)  # flip both horizontally and vetically 
-            _, buffer = cv2.imencode('.jpg', frame)
-            data = buffer.tostring()  # class 'bytes'
-            writer.write(data)
-            writer.write(FRAME_SEPARATOR)
-            await writer.drain()
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
-        except Exception as err:
-            LOG.error(f'steaming failed, try to reconnect -> {err}')
-            reader, writer = await connect_server()
-
-    LOG.info('close the camera')
-    cap.release()
-    cv2.destroyAllWindows()
-    LOG.info('close the connection')
-    writer.close()
-    await writer.wait_closed()
-    LOG.info('exit')
-
-if __name__ == '__main__':
-    asyncio.run(client_camera())
+#pylint: disable=missing-docstring, C0301, E1101, W0703
+
+"""
+# 1. install dependencies
+sudo apt install -y libatlas-base-dev
+pip install opencv-python==3.4.17.61
+pip install numpy==1.22.2
+pip install schedule==1.1.0
+
+
+# 2. autostart when system rebooted
+
+```bash
+# 1. use contab
+crontab -e
+# 2. append this line to the end, save then exit
+@reboot /usr/bin/python /home/pi/Desktop/pi_cam_stream_client.py
+# 3. reboot the board
+```
+
+# 3. enable camera
+```bash
+sudo raspi-config
+"3. Interface Options"  -> "I1 Legacy Camera" -> "Yes" -> "Finish" -> "Reboot"
+```
+
+"""
+import sys
+import time
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import socket
+import logging
+
+import cv2
+
+import capture
+import frame_protocol
+import health
+import motion
+import rate_control
+import spool
+import tiles
+import udp_stream
+
+assert sys.version_info >= (3, 5, 2)
+
+# send video stream to this server
+SERVER_IP = '10.0.0.99'
+SERVER_PORT = 8888
+
+# recordings of this camera go to <VIDEO_SAVE_PATH>/<CAMERA_ID>/ on the server
+CAMERA_ID = socket.gethostname()
+
+# send the frames as datagrams to UDP_PORT of the server instead (udp_stream.py): a lost packet costs the frame
+# it belongs to instead of delaying every frame behind it, for a live view that must not lag. the server
+# reports how many frames got lost, rate control steps down above RATE_MAX_LOSS. a spooled frame that gets lost is
+# sent again on the next connection. UDP_LOSS_INJECTION drops that fraction of the datagrams, to try it on loopback
+UDP_TRANSPORT = False
+UDP_PORT = SERVER_PORT
+UDP_FRAGMENT_BYTES = 1400  # + headers stays under a 1500 byte MTU
+UDP_LOSS_INJECTION = 0.0
+
+# frame_protocol.PROTOCOL_LEGACY to always use FRAME_SEPARATOR, e.g. for a server that is not upgraded yet
+FRAME_PROTOCOL_VERSION = frame_protocol.PROTOCOL_VERSION
+
+CAPTURE_FPS = 24
+# single channel JPEGs, e.g. for IR night cameras, a v7 server decodes and records them as such
+VIDEO_COLOR_GRAY = False
+JPEG_QUALITY = 95  # cv2.imencode default
+# frames encoded in parallel, the capture thread and the sender run next to them
+ENCODE_WORKERS = 2
+# JPEGs waiting for the socket, when the link is slower the oldest is dropped, bounds the latency
+SEND_QUEUE_DEPTH = 2
+CLIENT_STATS_INTERVAL = 60  # seconds between capture/encode/send counter logs
+
+# adapt to the link: when frames take too long to be acknowledged (or drain blocks, or the write
+# buffer grows, or the bitrate cap is hit) lower the JPEG quality down to RATE_MIN_QUALITY, then
+# the resolution through RATE_SCALES, then send every n-th frame of RATE_FRAME_SKIPS.
+# steps down at most once per second, steps up after RATE_UP_HOLD seconds without congestion
+RATE_CONTROL = True
+RATE_MIN_QUALITY = 50
+RATE_QUALITY_STEP = 10
+RATE_SCALES = (1.0, 0.75, 0.5)
+RATE_FRAME_SKIPS = (1, 2, 4)
+RATE_MAX_LAG = 0.5  # seconds from send to ack that count as congestion
+RATE_UP_HOLD = 5
+RATE_MAX_BYTES_PER_SECOND = None  # e.g. 500_000 on a metered uplink
+RATE_MAX_LOSS = 0.1  # fraction of the frames, UDP_TRANSPORT only
+# kernel send buffer, a few frames, the default grows to megabytes and hides seconds of lag
+# from drain(), None keeps the default
+SEND_BUFFER_BYTES = 256 * 1024
+
+# overnight most frames show the same scene: every frame is compared with the last one sent on a
+# 160 px wide grayscale copy, when less than STATIC_SCENE_THRESHOLD of the pixels changed by more than
+# STATIC_SCENE_PIXEL_THRESHOLD gray levels the frame is neither encoded nor sent.
+# a v3 server gets a heartbeat after HEARTBEAT_SECONDS without a frame and repeats the last frame
+STATIC_SCENE_SKIP = False
+STATIC_SCENE_THRESHOLD = 0.002
+STATIC_SCENE_PIXEL_THRESHOLD = 12
+HEARTBEAT_SECONDS = 5
+
+# a v8 server (face.py) reports the faces it sees: from the first one until FACE_BOOST_SECONDS after the
+# last one every frame is sent, at JPEG quality FACE_BOOST_QUALITY or better and past the static scene filter
+FACE_BOOST = True
+FACE_BOOST_SECONDS = 3
+FACE_BOOST_QUALITY = 85
+
+# send a full keyframe every TILE_KEYFRAME_SECONDS and in between only the TILE_SIZE tiles where more than
+# TILE_THRESHOLD of the pixels changed, each one a small JPEG (tiles.py). the tiles build on each other,
+# they are encoded on one thread. needs a v4 server, full JPEGs otherwise
+TILE_DELTA_ENCODING = False
+TILE_SIZE = (80, 80)  # width, height
+TILE_THRESHOLD = 0.002  # 13 pixels of an 80x80 tile
+TILE_KEYFRAME_SECONDS = 10
+
+# frames captured while the server is unreachable go to an on-disk ring (spool.py), SPOOL_FPS per second
+# and at most SPOOL_MAX_BYTES, a long outage keeps its latest part. after reconnecting a v5 server gets
+# them next to the live stream, at most SPOOL_UPLOAD_BYTES_PER_SECOND, and records them by capture time.
+# a frame leaves the spool once the server acknowledged it. None switches it off
+SPOOL_PATH = '/home/pi/Desktop/spool/'
+SPOOL_FPS = 2
+SPOOL_MAX_BYTES = 1 << 30
+SPOOL_UPLOAD_BYTES_PER_SECOND = 200 * 1024
+
+# connectivity watchdog (health.py): frames the server accepts show it is reachable, after WATCHDOG_INTERVAL
+# seconds without one a TCP connect to SERVER_IP:SERVER_PORT is tried, failed probes are repeated with
+# exponential backoff up to WATCHDOG_MAX_BACKOFF seconds. a probe that succeeds does not end the outage, only
+# frames and acks do. the longer the stream stalls the stronger the remedy: drop and make the connection again
+# (a half open one stalls while the server answers probes), reopen the camera, run WATCHDOG_REBOOT_COMMAND
+# (only while the probes fail). None skips a stage
+WATCHDOG_INTERVAL = 60
+WATCHDOG_PROBE_TIMEOUT = 3
+WATCHDOG_MAX_BACKOFF = 300
+WATCHDOG_RECONNECT_AFTER = 60
+WATCHDOG_RESTART_CAMERA_AFTER = 10 * 60
+WATCHDOG_REBOOT_AFTER = 60 * 60
+WATCHDOG_REBOOT_COMMAND = 'sudo reboot'
+
+# a second, small stream for the live view next to the recording stream, from the same capture:
+# PREVIEW_SIZE at PREVIEW_QUALITY and PREVIEW_FPS, on its own connection (camera <CAMERA_ID>-preview) with its
+# own encoder thread and a small send buffer, so it stays real-time while the recording stream fills the link.
+# the recording stream keeps the settings above and may lag behind or spool. PREVIEW_IP_TOS / STREAM_IP_TOS mark
+# the packets for routers that prioritize (0x10 low delay, 0x08 throughput, None leaves them alone).
+# needs a v6 server, the server shows the preview live and does not record it
+PREVIEW_STREAM = False
+PREVIEW_SIZE = (320, 180)
+PREVIEW_QUALITY = 50
+PREVIEW_FPS = 10
+PREVIEW_SEND_BUFFER_BYTES = 32 * 1024
+PREVIEW_IP_TOS = 0x10
+STREAM_IP_TOS = None
+PREVIEW_SUFFIX = '-preview'
+PREVIEW_MAX_BACKOFF = 60  # seconds between attempts while the server does not answer the HELLO
+
+# only capture videos during night (8pm to 8am)
+CAPTURE_HOURS = set([20, 21, 22, 23, 0, 1, 2, 3, 4, 5, 6, 7, 8])
+
+
+logging.basicConfig(filename='default.log',
+                    filemode='a',
+                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                    datefmt='%H:%M:%S',
+                    level=logging.DEBUG)
+
+LOG = logging.getLogger('pi_cam_client')
+
+
+def set_socket_options(writer, send_buffer_bytes=None, ip_tos=None) -> None:
+    sock = writer.get_extra_info('socket')
+    if send_buffer_bytes is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_bytes)
+    if ip_tos is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, ip_tos)
+        except OSError as err:  # e.g. an IPv6 socket
+            LOG.warning(f'IP_TOS {ip_tos:#x} not set -> {err}')
+
+
+async def connect_server(on_report=None):
+    """connect to server, negotiate the framing
+
+    returns (reader, writer, protocol version), on_report(udp_stream.Report) gets the loss reports over UDP
+    """
+    version = FRAME_PROTOCOL_VERSION
+    while True:
+        try:
+            if UDP_TRANSPORT:
+                LOG.info(f'connect server -> udp {SERVER_IP}:{UDP_PORT}')
+                reader, writer, agreed = await udp_stream.open_connection(SERVER_IP, UDP_PORT, CAMERA_ID, version,
+                                                                          UDP_FRAGMENT_BYTES, UDP_LOSS_INJECTION, on_report)
+                set_socket_options(writer, SEND_BUFFER_BYTES, STREAM_IP_TOS)
+                LOG.info(f'framing -> {frame_protocol.describe(agreed)} over udp')
+                return reader, writer, agreed
+            LOG.info(f'connect server -> {SERVER_IP}:{SERVER_PORT}')
+            reader, writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
+            set_socket_options(writer, SEND_BUFFER_BYTES, STREAM_IP_TOS)
+            if version == frame_protocol.PROTOCOL_LEGACY:
+                return reader, writer, version
+            agreed = await frame_protocol.negotiate(reader, writer, version, camera_id=CAMERA_ID)
+            if agreed != frame_protocol.PROTOCOL_LEGACY:
+                LOG.info(f'framing -> {frame_protocol.describe(agreed)}')
+                return reader, writer, agreed
+            # old server, it took the HELLO as frame data, start over without it
+            LOG.warning('server did not acknowledge HELLO, fall back to legacy framing')
+            writer.close()
+            version = frame_protocol.PROTOCOL_LEGACY
+            continue
+        except Exception as err:
+            LOG.error(f'failed to connect server -> {err}')
+        await asyncio.sleep(1)  # the spool keeps capturing meanwhile
+
+
+def encode_frame(frame, video_color_gray=False, settings: rate_control.RateSettings = None, tile_encoder: tiles.TileEncoder = None):
+    """flip + resize + JPEG encode, on an encoder thread
+
+    returns (jpeg bytes, width, height), with a tile_encoder (payload, width, height, CODEC_TILES)
+    """
+    quality = JPEG_QUALITY
+    if settings is not None:
+        quality = settings.quality
+        if settings.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=settings.scale, fy=settings.scale, interpolation=cv2.INTER_AREA)
+    if video_color_gray:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    #frame = cv2.flip(frame, 0)  # vertical flip
+    frame = cv2.flip(frame, -1)  # flip both horizontally and vetically 
+    video_h, video_w = frame.shape[:2]
+    if tile_encoder is not None:
+        return tile_encoder.encode(frame, quality), video_w, video_h, frame_protocol.CODEC_TILES
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes(), video_w, video_h
+
+
+async def housekeeping(watchdog: health.ConnectivityWatchdog) -> None:
+    """hibernation, blocks everything while it runs, connectivity is health.ConnectivityWatchdog's job
+    """
+    while True:
+        hour = datetime.datetime.now().hour
+        if hour not in CAPTURE_HOURS:  # only capture video within CAPTURE_HOURS
+            time_seconds_to_sleep = int(20 - hour) * 3600  # 20 is '8pm'
+            LOG.info('hibernate')
+            time.sleep(time_seconds_to_sleep)  # hibernate
+            watchdog.ok()  # the stream was paused on purpose, not an outage
+        await asyncio.sleep(1)
+
+
+async def reboot() -> None:
+    """last stage of the connectivity watchdog
+    """
+    LOG.error(f'server unreachable for too long, reboot the machine -> {WATCHDOG_REBOOT_COMMAND}')
+    process = await asyncio.create_subprocess_shell(WATCHDOG_REBOOT_COMMAND)
+    await process.wait()
+
+
+def open_camera(video_width=1280, video_height=720) -> cv2.VideoCapture:
+    cap = cv2.VideoCapture(0)
+    cap.set(3, video_width)  # width, max 3280
+    cap.set(4, video_height)  # height, max 2464
+    cap.set(5, CAPTURE_FPS)  # Frame Per Second
+    return cap
+
+
+async def client_camera(video_width=1280,
+                        video_height=720,
+                        video_color_gray=False) -> None:
+    """
+    start the camera
+
+    the capture thread keeps running across reconnects, a new ClientPipeline sends on every connection
+    """
+    # start camera
+    camera = capture.CaptureThread(open_camera(video_width, video_height),
+                                   functools.partial(open_camera, video_width, video_height))
+    camera.start()
+    LOG.info('camera connected')
+
+    encoders = concurrent.futures.ThreadPoolExecutor(ENCODE_WORKERS, thread_name_prefix='encode')
+    controller = None
+    if RATE_CONTROL:
+        ladder = rate_control.build_ladder(JPEG_QUALITY, RATE_MIN_QUALITY, RATE_QUALITY_STEP, RATE_SCALES, RATE_FRAME_SKIPS)
+        controller = rate_control.RateController(ladder,
+                                                 up_hold=RATE_UP_HOLD,
+                                                 lag_high=RATE_MAX_LAG,
+                                                 lag_low=RATE_MAX_LAG / 3,
+                                                 max_bytes_per_second=RATE_MAX_BYTES_PER_SECOND,
+                                                 loss_high=RATE_MAX_LOSS,
+                                                 loss_low=RATE_MAX_LOSS / 5)
+    scene = None
+    if STATIC_SCENE_SKIP:
+        scene = motion.SceneChangeFilter(STATIC_SCENE_THRESHOLD, STATIC_SCENE_PIXEL_THRESHOLD)
+    tile_encoder = None
+    if TILE_DELTA_ENCODING:
+        tile_encoder = tiles.TileEncoder(*TILE_SIZE, TILE_THRESHOLD, keyframe_interval=TILE_KEYFRAME_SECONDS)
+    frame_spool = None
+    if SPOOL_PATH is not None:
+        frame_spool = spool.FrameSpool(SPOOL_PATH, SPOOL_MAX_BYTES)
+    loop = asyncio.get_running_loop()
+    writer = None
+
+    def on_report(report: udp_stream.Report):
+        if report.dropped:
+            LOG.debug(f'udp -> {report.completed} frames arrived, {report.dropped} dropped, {report.loss:.1%} of the datagrams lost')
+        if controller is not None and report.completed + report.dropped:
+            controller.on_loss(report.dropped / (report.completed + report.dropped))
+
+    def drop_connection():
+        if writer is not None:
+            writer.transport.abort()  # close() would wait for a write buffer that never drains
+
+    stages = [health.Stage(after, name, action, unreachable_only)
+              for after, name, action, unreachable_only in ((WATCHDOG_RECONNECT_AFTER, 'reconnect', drop_connection, False),
+                                                            (WATCHDOG_RESTART_CAMERA_AFTER, 'restart camera', camera.restart, False),
+                                                            (WATCHDOG_REBOOT_AFTER, 'reboot', reboot, True))
+              if after is not None]
+    watchdog = health.ConnectivityWatchdog(SERVER_IP, SERVER_PORT, stages,
+                                           interval=WATCHDOG_INTERVAL,
+                                           timeout=WATCHDOG_PROBE_TIMEOUT,
+                                           max_backoff=WATCHDOG_MAX_BACKOFF)
+    checks = [asyncio.ensure_future(housekeeping(watchdog)), asyncio.ensure_future(watchdog.run())]
+    if PREVIEW_STREAM and FRAME_PROTOCOL_VERSION >= frame_protocol.PROTOCOL_PREVIEW:
+        checks.append(asyncio.ensure_future(preview_stream(camera, video_color_gray)))
+    try:
+        while True:
+            # connect to server, spool what is captured until it answers
+            spooling = None
+            if frame_spool is not None:
+                spooling = asyncio.ensure_future(spool_frames(camera, encoders, frame_spool, video_color_gray))
+            try:
+                reader, writer, version = await connect_server(on_report)
+            finally:
+                if spooling is not None:
+                    spooling.cancel()
+            LOG.info('server connected')
+            seq = 0
+            backlog = spool.UploadWindow()  # spool positions of the sent backlog, committed in order as they are acknowledged
+            last_send = time.monotonic()
+            acked = version >= frame_protocol.PROTOCOL_ACKS
+            face_until = 0.0  # monotonic time the last face the server reported stops counting
+            if controller is not None:
+                controller.reset()
+            if scene is not None:
+                scene.reset()  # the server starts a new segment with the first frame
+            gray = frame_protocol.FLAG_GRAY if video_color_gray and version >= frame_protocol.PROTOCOL_GRAY else 0
+            delta = tile_encoder if version >= frame_protocol.PROTOCOL_TILES else None
+            if delta is not None:
+                delta.reset()
+
+            send_lock = asyncio.Lock()  # one drain() at a time, python < 3.10 asserts on a second waiter
+
+            async def send(timestamp, data, video_w, video_h, codec=frame_protocol.CODEC_JPEG, spooled: spool.Position = None):
+                nonlocal seq, last_send
+                async with send_lock:  # the live stream and the backlog upload both send
+                    frame_seq = seq % frame_protocol.SEQ_MODULO
+                    seq += 1
+                    if version == frame_protocol.PROTOCOL_LEGACY:
+                        frame_protocol.write_legacy_frame(writer, data)
+                    elif spooled is not None:
+                        header = frame_protocol.make_header(frame_seq, timestamp, len(data), video_w, video_h, codec,
+                                                            flags=frame_protocol.FLAG_BACKLOG | gray)
+                        frame_protocol.write_frame(writer, header, data)
+                        backlog.sent(frame_seq, spooled)
+                    else:
+                        header = frame_protocol.make_header(frame_seq, timestamp, len(data), video_w, video_h, codec, flags=gray)
+                        frame_protocol.write_frame(writer, header, data)
+                        last_send = time.monotonic()
+                    write_buffer = writer.transport.get_write_buffer_size()
+                    drain_start = time.monotonic()
+                    await writer.drain()
+                if not UDP_TRANSPORT and not writer.transport.is_closing():  # drain returns on an aborted connection too
+                    watchdog.ok()  # a datagram always goes out, over UDP only the acks count
+                if controller is not None:
+                    controller.on_send(frame_seq, len(data), time.monotonic() - drain_start, write_buffer, acked)
+                    stream.frame_skip = controller.settings.frame_skip
+
+            async def heartbeat():
+                """tell the server the camera is alive while the scene does not change
+                """
+                nonlocal seq, last_send
+                while True:
+                    await asyncio.sleep(max(0.0, last_send + HEARTBEAT_SECONDS - time.monotonic()))
+                    if time.monotonic() - last_send < HEARTBEAT_SECONDS:
+                        continue
+                    async with send_lock:  # not in the middle of a frame's drain, seq stays in order
+                        header = frame_protocol.make_header(seq % frame_protocol.SEQ_MODULO, time.time(), 0,
+                                                            flags=frame_protocol.FLAG_HEARTBEAT)
+                        frame_protocol.write_frame(writer, header, b'')
+                        seq += 1
+                        last_send = time.monotonic()
+
+            def on_ack(seq):
+                watchdog.ok()
+                if controller is not None:
+                    controller.on_ack(seq)
+                committed = backlog.ack(seq)
+                if committed is not None:
+                    loop.run_in_executor(None, frame_spool.commit, committed)
+
+            def on_results(results: frame_protocol.Results):
+                nonlocal face_until
+                if not FACE_BOOST or not results.boxes:
+                    return
+                if time.monotonic() >= face_until:
+                    names = ', '.join(name for name in results.names if name)
+                    LOG.info(f'server -> {len(results.boxes)} faces' + (f' ({names})' if names else ''))
+                face_until = time.monotonic() + FACE_BOOST_SECONDS
+                if controller is not None:
+                    controller.boost(FACE_BOOST_SECONDS, FACE_BOOST_QUALITY)
+                    stream.frame_skip = controller.settings.frame_skip
+
+            def encode(frame):
+                if scene is not None and time.monotonic() >= face_until and not scene.check(frame):
+                    return None
+                return encode_frame(frame, video_color_gray, controller.settings if controller is not None else None, delta)
+
+            stream = capture.ClientPipeline(camera,
+                                            encode,
+                                            send,
+                                            encoders,
+                                            encode_workers=1 if delta is not None else ENCODE_WORKERS,
+                                            send_queue_depth=SEND_QUEUE_DEPTH)
+            if controller is not None:
+                stream.frame_skip = controller.settings.frame_skip
+            tasks = [asyncio.ensure_future(log_stats(stream, delta))]
+            if acked:
+                tasks.append(asyncio.ensure_future(read_server(reader, on_ack, on_results)))
+            if frame_spool is not None and version >= frame_protocol.PROTOCOL_BACKLOG:
+                tasks.append(asyncio.ensure_future(upload_backlog(frame_spool, send)))
+            if scene is not None and version >= frame_protocol.PROTOCOL_HEARTBEAT:
+                tasks.append(asyncio.ensure_future(heartbeat()))
+            try:
+                await stream.run()
+            except Exception as err:
+                LOG.error(f'steaming failed, try to reconnect -> {err}')
+            finally:
+                for task in tasks:
+                    task.cancel()
+                writer.close()
+                backlog.clear()  # what was not acknowledged is uploaded again on the next connection
+    finally:
+        for task in checks:
+            task.cancel()
+        LOG.info('close the camera')
+        camera.stop()
+        encoders.shutdown(wait=False)
+        if frame_spool is not None:
+            frame_spool.close()
+        cv2.destroyAllWindows()
+        LOG.info('exit')
+
+
+async def preview_stream(camera: capture.CaptureThread, video_color_gray=False) -> None:
+    """the low resolution live substream, independent of the recording stream's connection and encoders
+
+    the newest frame only (send queue depth 1), stops for good when the server's ACK is older than v6.
+    no ACK at all (busy, restarting or a legacy server) is retried with backoff
+    """
+    encoder = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='preview')
+    settings = rate_control.RateSettings(PREVIEW_QUALITY, 1.0, 1)
+
+    def encode(frame):
+        return encode_frame(cv2.resize(frame, PREVIEW_SIZE, interpolation=cv2.INTER_AREA), video_color_gray, settings)
+
+    backoff = 1
+    try:
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
+                set_socket_options(writer, PREVIEW_SEND_BUFFER_BYTES, PREVIEW_IP_TOS)
+                version = await frame_protocol.negotiate(reader, writer, FRAME_PROTOCOL_VERSION, camera_id=CAMERA_ID + PREVIEW_SUFFIX,
+                                                         legacy_fallback=False)
+            except Exception as err:
+                LOG.error(f'preview -> failed to connect server, retry in {backoff}s -> {err}')
+                if writer is not None:
+                    writer.close()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, PREVIEW_MAX_BACKOFF)
+                continue
+            backoff = 1
+            if version < frame_protocol.PROTOCOL_PREVIEW:
+                LOG.warning(f'preview -> the server speaks {frame_protocol.describe(version)}, no preview stream')
+                writer.close()
+                return
+            LOG.info(f'preview -> {PREVIEW_SIZE[0]}x{PREVIEW_SIZE[1]} q{PREVIEW_QUALITY} at {PREVIEW_FPS} fps')
+            seq = 0
+            flags = frame_protocol.FLAG_PREVIEW
+            if video_color_gray and version >= frame_protocol.PROTOCOL_GRAY:
+                flags |= frame_protocol.FLAG_GRAY
+
+            async def send(timestamp, data, video_w, video_h):
+                nonlocal seq
+                header = frame_protocol.make_header(seq, timestamp, len(data), video_w, video_h, flags=flags)
+                frame_protocol.write_frame(writer, header, data)
+                seq = (seq + 1) % frame_protocol.SEQ_MODULO
+                await writer.drain()
+
+            stream = capture.ClientPipeline(camera, encode, send, encoder, encode_workers=1, send_queue_depth=1)
+            stream.frame_skip = max(1, round(CAPTURE_FPS / PREVIEW_FPS))
+            acks = asyncio.ensure_future(read_server(reader, lambda seq: None))
+            try:
+                await stream.run()
+            except Exception as err:
+                LOG.error(f'preview -> failed, try to reconnect -> {err}')
+            finally:
+                acks.cancel()
+                writer.close()
+            await asyncio.sleep(1)
+    finally:
+        encoder.shutdown(wait=False)
+
+
+async def spool_frames(camera: capture.CaptureThread, encoders, frame_spool: spool.FrameSpool, video_color_gray=False) -> None:
+    """keep SPOOL_FPS frames per second on disk while there is no connection, until cancelled
+    """
+    loop = asyncio.get_running_loop()
+
+    async def store(timestamp, data, video_w, video_h):
+        await loop.run_in_executor(None, frame_spool.append, timestamp, data, video_w, video_h)
+
+    def encode(frame):
+        return encode_frame(frame, video_color_gray)
+
+    stream = capture.ClientPipeline(camera, encode, store, encoders, encode_workers=1, send_queue_depth=SEND_QUEUE_DEPTH)
+    stream.frame_skip = max(1, round(CAPTURE_FPS / SPOOL_FPS))
+    try:
+        await stream.run()
+    finally:
+        if stream.sent:
+            LOG.info(f'spool -> {stream.sent} frames kept during the outage, {frame_spool.lost} files lost to SPOOL_MAX_BYTES')
+
+
+async def upload_backlog(frame_spool: spool.FrameSpool, send) -> None:
+    """send the spooled frames next to the live stream, SPOOL_UPLOAD_BYTES_PER_SECOND at most
+
+    on_ack commits the frames up to the first one the server did not acknowledge, that one and
+    everything after it is sent again on the next connection
+    """
+    loop = asyncio.get_running_loop()
+    frame_spool.rewind()
+    pending = await loop.run_in_executor(None, frame_spool.pending_bytes)
+    if not pending:
+        return
+    LOG.info(f'spool -> uploading {pending} bytes')
+    uploaded = 0
+    try:
+        while True:
+            frames = await loop.run_in_executor(None, frame_spool.read)
+            if not frames:
+                break
+            for frame in frames:
+                await send(frame.timestamp, frame.jpeg, frame.width, frame.height, spooled=frame.end)
+                uploaded += 1
+                await asyncio.sleep(len(frame.jpeg) / SPOOL_UPLOAD_BYTES_PER_SECOND)
+    except ConnectionError as err:
+        LOG.error(f'spool -> upload stopped after {uploaded} frames -> {err}')
+        return
+    LOG.info(f'spool -> uploaded {uploaded} frames')
+
+
+async def read_server(reader, on_ack, on_results=None) -> None:
+    """FRAME_ACKs of a v2 server, they must be read even without rate control, and RESULTS of a v8 one
+    """
+    try:
+        while True:
+            message = await frame_protocol.read_server_message(reader)
+            if isinstance(message, int):
+                on_ack(message)
+            elif on_results is not None:
+                on_results(message)
+    except (asyncio.IncompleteReadError, ConnectionError, frame_protocol.ProtocolError) as err:
+        LOG.error(f'ack channel closed -> {err}')
+
+
+async def log_stats(stream: capture.ClientPipeline, tile_encoder: tiles.TileEncoder = None) -> None:
+    while True:
+        await asyncio.sleep(CLIENT_STATS_INTERVAL)
+        LOG.info(f'pipeline -> {stream.stats()}')
+        if tile_encoder is not None:
+            LOG.info(f'tiles -> {tile_encoder.keyframes} keyframes, {tile_encoder.deltas} deltas, {tile_encoder.tiles} tiles')
+
+if __name__ == '__main__':
+    asyncio.run(client_camera(video_color_gray=VIDEO_COLOR_GRAY))
@@ -1,156 +1,696 @@
-#pylint: disable=missing-docstring, C0301, E1101, W0703
-
-"""
-
-sudo apt install -y libatlas-base-dev
-pip install opencv-python==3.4.17.61
-pip install numpy==1.22.2 pytz==2021.3
-
-# 2. autostart when system rebooted
-
-```bash
-# 1. use contab
-crontab -e
-# 2. append this line to the end, save then exit
-@reboot /usr/bin/python /home/pi/Desktop/pi_cam_stream_server.py
-# 3. reboot the board
-```
-
-# 3. set static IP as 10.0.0.4
-sudo nano /etc/dhcpcd.conf
-
-interface wlan0
-static ip_address=10.0.0.4/24
-static routers=10.0.0.1
-static domain_name_servers=10.0.0.1
-
-"""
-
-import os
-import sys
-import time
-import asyncio
-import datetime
-import glob
-import pytz
-import numpy as np
-import cv2
-
-assert sys.version_info >= (3, 5, 2)  # for reader.readuntil
-
-#FRAME_SEPARATOR = b'\xE2\x82\xAC\xE2\x82\xAC'
-# (chr(255)+chr(0)+chr(0)+chr(0)+chr(255)+chr(0)+chr(0)+chr(0)+chr(255)).encode('utf-8')
-FRAME_SEPARATOR = b'\xc3\xbf\x00\x00\x00\xc3\xbf\x00\x00\x00\xc3\xbf'
-SEPARATOR_LENGTH = len(FRAME_SEPARATOR)
-
-SERVER_IP = '10.0.0.99'
-SERVER_PORT = 8888
-
-WRITE_VIDEO_TO_FILE = True
-VIDEO_SAVE_PATH = '/home/pi/Desktop/videos/'
-VIDEO_FPS = 10
-VIDEO_CLIP_LENGTH_MINUTES = 60  # generate a new file every VIDEO_CLIP_LENGTH_MINUTES mins
-
-DISPLAY_VIDEO = False
-
-# max number of video files to be saved, 5 days. 120 = 24*5, if a video file is 1 hr long
-MAX_NUM_VIDEOS_ROTATION = 60
-
-
-def refresh_video_file(video_width:int=1280, video_height:int=720) -> cv2.VideoWriter:
-    """rotate files, maintain a ringbuffer of 10 files
-    """
-    # ascending order
-    #filenames = sorted([os.path.basename(name) for name in glob.glob(f'{VIDEO_SAVE_PATH}*')])
-    filenames = sorted(glob.glob(f'{VIDEO_SAVE_PATH}*'))
-    num_files = len(filenames)
-    if num_files >= MAX_NUM_VIDEOS_ROTATION:
-        oldest_filename = filenames[0]
-        if os.path.exists(oldest_filename):
-            print(f'Delete: {oldest_filename}')
-            os.remove(oldest_filename)
-    timestamp = datetime.datetime.now(pytz.timezone('US/Pacific')).strftime('%Y_%m_%d_%H_%M_%S')
-    #output_video_file = os.path.join(VIDEO_SAVE_PATH, f'{timestamp}.mp4')
-    #   # XVID-> .avi, mp4v-> .mp4, FMP4-> .mp4
-    #video_writer = cv2.VideoWriter(output_video_file,
-    #                               cv2.VideoWriter_fourcc(*'FMP4'),
-    #                               VIDEO_FPS,
-    #                               (720, 1280))
-    #idx = filename_idx % MAX_NUM_VIDEOS_ROTATION  # 000_<date>.avi
-    #output_video_file = os.path.join(VIDEO_SAVE_PATH, f'{idx:03}_{timestamp}.avi')
-    output_video_file = os.path.join(VIDEO_SAVE_PATH, f'{timestamp}.avi')
-    video_writer = cv2.VideoWriter(output_video_file,
-                                   cv2.VideoWriter_fourcc(*'XVID'),
-                                   VIDEO_FPS,
-                                   (video_width, video_height))
-    print(f'Output File: {output_video_file}')
-    return video_writer
-
-async def handle_cam(reader, writer):
-    """called whenever a new client connection is established
-    """
-    start_time = time.time()
-    video_writer = None
-
-    while True:
-        try:
-            raw_data = await reader.readuntil(separator=FRAME_SEPARATOR)  # blocked until read something
-            # truncate the separator
-            raw_data = raw_data[:-SEPARATOR_LENGTH]  # bytes
-            frame = np.asarray(bytearray(raw_data), dtype=np.uint8)
-            frame = cv2.imdecode(frame, -1)
-            (video_height, video_width, channels) = frame.shape
-            if frame is not None:
-                # print the timestamp on frame
-                now = datetime.datetime.now(pytz.timezone('US/Pacific')).strftime('%m/%d/%Y %H:%M:%S')
-                cv2.putText(frame, f'PST: {now}', (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-
-                if DISPLAY_VIDEO:
-                    #gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                    cv2.imshow('jpg', frame)
-                    cv2.waitKey(1)
-
-                if WRITE_VIDEO_TO_FILE:  # persist to disk file
-                    if video_writer is None:
-                        video_writer = refresh_video_file(video_width, video_height)
-                    video_writer.write(frame)
-                    now = time.time()
-                    if int(now - start_time) >= 60 * VIDEO_CLIP_LENGTH_MINUTES:  # generate a new file every 30 mins
-                        start_time = now
-                        video_writer.release()
-                        # refresh video file
-                        video_writer = refresh_video_file(video_width, video_height)
-            #data = str.encode("hello"+'\n')
-            #writer.write(data)
-            #await writer.drain()
-        except (asyncio.IncompleteReadError, ConnectionResetError, ConnectionAbortedError) as err:
-            #asyncio.exceptions.IncompleteReadError: 0 bytes read on a total of undefined expected bytes
-            raise err
-
-        except Exception as err:
-            raise err
-            #cv2.destroyAllWindows()
-
-
-async def main():
-    """main entrypoint
-
-    """
-    while True:
-        try:
-            server = await asyncio.start_server(handle_cam,
-                                        SERVER_IP,
-                                        SERVER_PORT,
-                                        limit=1024*1204*8)
-            print('Serving on {}:{}'.format(SERVER_IP, SERVER_PORT))
-            async with server:
-                await server.serve_forever()
-        except Exception as err:  # try to recover from any exceptions by re-establishing connection
-            print(f'Unhandled: {err}')
-    #print(dir(server))
-    #await asyncio.sleep(60)
-    #server.close()
-    #await server.wait_closed()
-
-if __name__ == '__main__':
-    asyncio.run(main())
+#pylint: disable=missing-docstring, C0301, E1101, W0703
+
+"""
+
+sudo apt install -y libatlas-base-dev
+pip install opencv-python==3.4.17.61
+pip install numpy==1.22.2 pytz==2021.3
+
+# 2. autostart when system rebooted
+
+```bash
+# 1. use contab
+crontab -e
+# 2. append this line to the end, save then exit
+@reboot /usr/bin/python /home/pi/Desktop/pi_cam_stream_server.py
+# 3. reboot the board
+```
+
+# 3. set static IP as 10.0.0.4
+sudo nano /etc/dhcpcd.conf
+
+interface wlan0
+static ip_address=10.0.0.4/24
+static routers=10.0.0.1
+static domain_name_servers=10.0.0.1
+
+"""
+
+import os
+import sys
+import time
+import asyncio
+import concurrent.futures
+import multiprocessing
+import socket
+import datetime
+import numpy as np
+import cv2
+
+import catalog
+import frame_protocol
+import ingest
+import live_http
+import motion
+import overlay
+import pipeline
+import recorder
+import tiles
+import udp_stream
+
+assert sys.version_info >= (3, 5, 2)  # for reader.readuntil
+
+SERVER_IP = '10.0.0.99'
+SERVER_PORT = 8888
+
+# worker processes sharing SERVER_PORT, each one handles whole camera connections
+NUM_WORKERS = os.cpu_count() or 1
+WORKER_RESTART_DELAY = 1  # seconds, a crashing worker is restarted at most this often
+
+WRITE_VIDEO_TO_FILE = True
+VIDEO_SAVE_PATH = '/home/pi/Desktop/videos/'  # one sub directory per camera id
+VIDEO_FPS = 10
+VIDEO_CLIP_LENGTH_MINUTES = 60  # generate a new file every VIDEO_CLIP_LENGTH_MINUTES mins
+
+DISPLAY_VIDEO = False
+
+# burned into transcoded and displayed frames (overlay.py), rendered once per change and blended in.
+# positions are the top left corner in pixels, negative from the right / bottom edge, None leaves a layer out.
+# the file names use recorder.TIMEZONE
+OVERLAY_TIMEZONE = recorder.TIMEZONE
+OVERLAY_TIMESTAMP_FORMAT = '%Z: %m/%d/%Y %H:%M:%S'
+OVERLAY_TIMESTAMP_POSITION = (10, 30)
+OVERLAY_CAMERA_ID_POSITION = None  # e.g. (-10, 30) for the top right corner
+OVERLAY_COLOR = (0, 255, 0)
+OVERLAY_SCALE = 0.8
+
+# RECORD_TRANSCODE: decode, burn in the timestamp, encode to XVID at VIDEO_FPS
+# RECORD_PASSTHROUGH: write the received JPEGs unchanged to an MJPEG AVI, every frame, no decode/encode,
+#                     capture times go to the .idx seek index, `python export.py` burns them in
+RECORD_TRANSCODE = 'transcode'
+RECORD_PASSTHROUGH = 'passthrough'
+RECORD_MODE = RECORD_TRANSCODE
+
+# live view, the received JPEGs re-served as MJPEG over HTTP without re-encoding:
+# http://SERVER_IP:LIVE_HTTP_PORT/camera/<CAMERA_ID>, /stats for the viewer counters, None switches it off.
+# every worker also listens on LIVE_HTTP_PORT + 1 + worker id, a viewer that lands on a worker
+# without the camera is redirected there
+LIVE_HTTP_PORT = 8080
+
+# record only while something moves. every frame gets a 1/4 size grayscale decode for the motion score,
+# the last MOTION_PRE_ROLL_SECONDS of JPEGs wait in memory and are written first when the score crosses
+# MOTION_THRESHOLD, recording stops MOTION_POST_ROLL_SECONDS after the last motion
+MOTION_GATED_RECORDING = False
+MOTION_THRESHOLD = 0.01  # fraction of the pixels that changed
+MOTION_PIXEL_THRESHOLD = 25  # gray level difference that counts as a change
+MOTION_PRE_ROLL_SECONDS = 5
+MOTION_POST_ROLL_SECONDS = 10
+MOTION_PRE_ROLL_MAX_FRAMES = 300  # bounds the memory of the pre-roll whatever the frame rate
+
+# a client with STATIC_SCENE_SKIP sends nothing while its scene does not change, only a heartbeat every
+# few seconds (protocol v3). transcoded recordings repeat the last frame to keep VIDEO_FPS, a gap longer
+# than MAX_REPEAT_SECONDS (the camera was gone) stays a gap. passthrough recordings keep the capture
+# times in their index and need no filler
+MAX_REPEAT_SECONDS = 30
+
+# also take frames over UDP on this port (udp_stream.py), for clients with UDP_TRANSPORT. a frame that is
+# not complete after UDP_REASSEMBLY_DEADLINE seconds is dropped, the loss rate goes back to the client
+# every UDP_REPORT_INTERVAL seconds. None switches it off
+UDP_PORT = None
+UDP_REASSEMBLY_DEADLINE = 0.2
+UDP_REPORT_INTERVAL = 1.0
+UDP_PEER_TIMEOUT = 10  # seconds without a datagram that end a session
+UDP_RECEIVE_BUFFER_BYTES = 4 << 20  # a few frames of fragments, capped by net.core.rmem_max
+UDP_LOSS_INJECTION = 0.0  # drop this fraction of the datagrams, for testing
+
+# read frames into a preallocated buffer with ingest.FrameIngestProtocol instead of StreamReader.readuntil
+ZERO_COPY_INGEST = True
+
+# decode + overlay threads shared by all connections, frames in flight per connection
+DECODE_WORKERS = 2
+# frames waiting for a decode thread / for the writer, per connection
+DECODE_QUEUE_DEPTH = 8
+WRITE_QUEUE_DEPTH = 16
+# what to do with a new frame when the decode queue is full:
+# pipeline.DROP_OLDEST (keep the latest), pipeline.DROP_NEWEST, pipeline.BLOCK (stop reading the socket)
+DROP_POLICY = pipeline.DROP_OLDEST
+PIPELINE_STATS_INTERVAL = 60  # seconds between per-connection queue/counter reports
+
+# every segment is recorded in a sqlite catalog, the supervisor deletes the oldest ones
+# every RETENTION_INTERVAL seconds (at most RETENTION_BATCH at a time) until all limits hold.
+# None switches a limit off
+CATALOG_PATH = os.path.join(VIDEO_SAVE_PATH, 'catalog.sqlite3')
+RETENTION_INTERVAL = 10
+RETENTION_BATCH = 20
+# max number of video files to be saved per camera, 5 days. 120 = 24*5, if a video file is 1 hr long
+MAX_NUM_VIDEOS_ROTATION = 60
+MAX_VIDEO_AGE_DAYS = None
+# once the recordings take more than the high watermark, delete down to the low watermark
+DISK_QUOTA_HIGH_BYTES = None
+DISK_QUOTA_LOW_BYTES = None
+MIN_FREE_DISK_BYTES = 1 << 30  # never let the SD card fill up completely
+
+
+def new_video_path(camera_id: str, start_time: float = None, suffix: str = '') -> str:
+    """name of the next file of a camera, old files are deleted by the supervisor (catalog.RetentionPolicy)
+
+    named after start_time (seconds since epoch) when given, now otherwise
+    """
+    camera_path = os.path.join(VIDEO_SAVE_PATH, camera_id)
+    os.makedirs(camera_path, exist_ok=True)
+    timezone = overlay.get_timezone(recorder.TIMEZONE)
+    start = datetime.datetime.now(timezone) if start_time is None else datetime.datetime.fromtimestamp(start_time, timezone)
+    timestamp = start.strftime('%Y_%m_%d_%H_%M_%S')
+    #output_video_file = os.path.join(VIDEO_SAVE_PATH, f'{timestamp}.mp4')
+    #   # XVID-> .avi, mp4v-> .mp4, FMP4-> .mp4
+    #video_writer = cv2.VideoWriter(output_video_file,
+    #                               cv2.VideoWriter_fourcc(*'FMP4'),
+    #                               VIDEO_FPS,
+    #                               (720, 1280))
+    #idx = filename_idx % MAX_NUM_VIDEOS_ROTATION  # 000_<date>.avi
+    #output_video_file = os.path.join(VIDEO_SAVE_PATH, f'{idx:03}_{timestamp}.avi')
+    return os.path.join(camera_path, f'{timestamp}{suffix}.avi')
+
+
+def refresh_video_file(output_video_file: str, video_width:int=1280, video_height:int=720, color: bool = True) -> cv2.VideoWriter:
+    video_writer = cv2.VideoWriter(output_video_file,
+                                   cv2.VideoWriter_fourcc(*'XVID'),
+                                   VIDEO_FPS,
+                                   (video_width, video_height),
+                                   isColor=color)
+    print(f'Output File: {output_video_file}')
+    return video_writer
+
+
+def refresh_passthrough_file(output_video_file: str, video_width:int=1280, video_height:int=720, color: bool = True) -> recorder.MjpegAviWriter:
+    video_writer = recorder.MjpegAviWriter(output_video_file, video_width, video_height, VIDEO_FPS, color)
+    print(f'Output File: {output_video_file} (passthrough)')
+    return video_writer
+
+
+def overlay_compositor(camera_id: str) -> overlay.Compositor:
+    layers = []
+    if OVERLAY_TIMESTAMP_POSITION is not None:
+        layers.append(overlay.TimestampLayer(OVERLAY_TIMEZONE, OVERLAY_TIMESTAMP_FORMAT, OVERLAY_TIMESTAMP_POSITION,
+                                             OVERLAY_COLOR, OVERLAY_SCALE))
+    if OVERLAY_CAMERA_ID_POSITION is not None:
+        layers.append(overlay.TextLayer(camera_id, OVERLAY_CAMERA_ID_POSITION, OVERLAY_COLOR, OVERLAY_SCALE))
+    return overlay.Compositor(layers)
+
+
+def open_catalog() -> catalog.SegmentCatalog:
+    return catalog.SegmentCatalog(CATALOG_PATH, sidecar_suffixes=(recorder.INDEX_SUFFIX,))
+
+
+def retention_policy() -> catalog.RetentionPolicy:
+    return catalog.RetentionPolicy(quota_high_bytes=DISK_QUOTA_HIGH_BYTES,
+                                   quota_low_bytes=DISK_QUOTA_LOW_BYTES,
+                                   min_free_bytes=MIN_FREE_DISK_BYTES,
+                                   max_age_seconds=MAX_VIDEO_AGE_DAYS * 86400 if MAX_VIDEO_AGE_DAYS else None,
+                                   max_count=MAX_NUM_VIDEOS_ROTATION,
+                                   batch=RETENTION_BATCH)
+
+
+_catalog = None
+
+
+def get_catalog() -> catalog.SegmentCatalog:
+    """the catalog connection of this worker process
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = open_catalog()
+    return _catalog
+
+
+_live_hub = None
+_live_port = None  # the port of this worker, where viewers of its cameras get redirected
+
+
+def get_live_hub() -> live_http.LiveHub:
+    global _live_hub
+    if _live_hub is None:
+        _live_hub = live_http.LiveHub()
+    return _live_hub
+
+
+_decode_executor = None
+
+
+def get_decode_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _decode_executor
+    if _decode_executor is None:
+        _decode_executor = concurrent.futures.ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix='decode')
+    return _decode_executor
+
+
+class CameraSession:
+    """per connection state, fed one frame at a time by handle_cam or ingest.FrameIngestProtocol
+
+    on_frame runs on the event loop and only queues the frame, decode and overlay run on
+    the shared decode threads and the VideoWriter on the pipeline's writer thread.
+    backlog frames (FLAG_BACKLOG) go to a second session with backlog=True, it records
+    into its own segments named after the capture time. its queue is bounded (DROP_NEWEST) and
+    never pauses the connection, the live frames share it: a backlog frame that does not fit
+    gets no FRAME_ACK, stays in the client's spool and is uploaded again on the next connection.
+    a client with VIDEO_COLOR_GRAY marks its frames with FLAG_GRAY, they stay single channel from
+    the decode to the writer.
+    """
+
+    def __init__(self, transport, camera_id: str, version: int, backlog: bool = False):
+        self.peername = transport.get_extra_info('peername')
+        self.transport = transport
+        self.camera_id = camera_id
+        self.version = version
+        self.backlog = backlog
+        self.backlog_session = None
+        self.start_time = time.time()
+        self.video_writer = None
+        self.segment_index = None  # seek index of a transcoded segment, MjpegAviWriter keeps its own
+        self.segment_path = None
+        self.segment_id = None
+        self.segment_frames = 0
+        self.segment_end = None
+        self.segment_color = True  # a frame with the other channel count starts a new segment
+        self.last_frame = None  # repeated while the scene is unchanged
+        self.overlay = overlay_compositor(camera_id)
+        self.canvas = tiles.TileCanvas()  # CODEC_TILES frames are rebuilt here, on the writer thread
+        self.tile_count = 0  # CODEC_TILES frames queued (and lost before), numbers the updates
+        self.tile_next = 0  # the number of the update the canvas expects next, writer thread
+        self.tiles_stale = False  # an update went missing, deltas are skipped until the next keyframe
+        self.tiles_skipped = 0
+        self.loop = asyncio.get_event_loop()
+        self.heartbeats = 0
+        self.expected_seq = None
+        self.dropped_frames = 0
+        self.stats_time = time.time()
+        self.live = LIVE_HTTP_PORT is not None and not backlog
+        if self.live:
+            get_live_hub().add_camera(camera_id, self)
+            if _live_port is not None:
+                get_catalog().set_live(camera_id, _live_port, os.getpid())
+        self.motion_detector = None
+        self.motion_gate = None
+        if MOTION_GATED_RECORDING:
+            self.motion_detector = motion.MotionDetector(MOTION_PIXEL_THRESHOLD)
+            self.motion_gate = motion.MotionGate(MOTION_THRESHOLD,
+                                                 MOTION_PRE_ROLL_SECONDS,
+                                                 MOTION_POST_ROLL_SECONDS,
+                                                 MOTION_PRE_ROLL_MAX_FRAMES)
+        self.pipeline = pipeline.FramePipeline(self.process_frame,
+                                               self.write_frame,
+                                               get_decode_executor(),
+                                               workers=DECODE_WORKERS,
+                                               queue_depth=DECODE_QUEUE_DEPTH,
+                                               write_queue_depth=WRITE_QUEUE_DEPTH,
+                                               drop_policy=pipeline.DROP_NEWEST if backlog else DROP_POLICY,
+                                               finish=self.release,
+                                               pause=None if backlog else transport.pause_reading,
+                                               resume=None if backlog else transport.resume_reading,
+                                               name=f'{camera_id}-backlog' if backlog else camera_id)
+
+    def on_frame(self, header, payload) -> None:
+        """header is None for legacy clients, payload is bytes or a memoryview of the receive buffer
+        """
+        if header is not None:
+            if self.expected_seq is not None and header.seq != self.expected_seq:
+                self.dropped_frames += frame_protocol.seq_gap(self.expected_seq, header.seq)
+                self.tile_count += 1  # a lost tile delta shows as a gap in the update numbers
+                print(f'Dropped frames: {self.dropped_frames} (expected #{self.expected_seq}, got #{header.seq})')
+            self.expected_seq = (header.seq + 1) % frame_protocol.SEQ_MODULO
+            acked = self.version >= frame_protocol.PROTOCOL_ACKS
+            if header.flags & frame_protocol.FLAG_BACKLOG:
+                if self.backlog_session is None:
+                    self.backlog_session = CameraSession(self.transport, self.camera_id, self.version, backlog=True)
+                    print(f'Client {self.peername} ({self.camera_id}): receiving backlog')
+                if self.backlog_session.queue_frame(header, payload) and acked:  # refused ones stay in the spool
+                    self.transport.write(frame_protocol.pack_frame_ack(header.seq))
+                return
+            if acked:
+                self.transport.write(frame_protocol.pack_frame_ack(header.seq))
+        self.queue_frame(header, payload)
+
+    def queue_frame(self, header, payload) -> bool:
+        """False when the pipeline dropped the frame right away
+        """
+        if header is not None:
+            if header.flags & frame_protocol.FLAG_PREVIEW:  # live view only, nothing to decode or record
+                if self.live:
+                    get_live_hub().publish(self.camera_id, bytes(payload))
+                return True
+            if header.flags & frame_protocol.FLAG_HEARTBEAT:
+                self.heartbeats += 1
+                return self.pipeline.submit((header.timestamp, None, None, None, False))
+        timestamp = header.timestamp if header is not None else time.time()
+        codec = header.codec if header is not None else frame_protocol.CODEC_JPEG
+        # per frame, the client may switch VIDEO_COLOR_GRAY while earlier frames are still queued
+        single_channel = header is not None and bool(header.flags & frame_protocol.FLAG_GRAY)
+        # the receive buffer is reused as soon as this returns, the queue needs its own copy
+        payload = bytes(payload)
+        if self.live:
+            if codec == frame_protocol.CODEC_JPEG:
+                get_live_hub().publish(self.camera_id, payload)  # the same copy, viewers only read it
+            elif codec == frame_protocol.CODEC_TILES:
+                jpeg = tiles.keyframe_jpeg(payload)  # deltas are published by rebuild_frame
+                if jpeg is not None:
+                    get_live_hub().publish(self.camera_id, jpeg)
+        number = None
+        if codec == frame_protocol.CODEC_TILES:
+            number = self.tile_count
+            self.tile_count += 1
+        queued = self.pipeline.submit((timestamp, payload, codec, number, single_channel))
+        now = time.time()
+        if now - self.stats_time >= PIPELINE_STATS_INTERVAL:
+            self.stats_time = now
+            print(f'Pipeline {self.camera_id}: {self.pipeline.stats()}')
+        return queued
+
+    def decode_frame(self, timestamp, payload, gray=False):
+        frame = np.frombuffer(payload, dtype=np.uint8)  # no copy
+        frame = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE if gray else -1)
+        if frame is not None:
+            # print the capture time on frame
+            self.overlay.apply(frame, timestamp)
+        return frame
+
+    def process_frame(self, item):
+        """decode + overlay, on a decode thread
+
+        returns (timestamp, payload, frame, gray, single_channel), frame is None when nothing needs the pixels
+        (passthrough mode, or an idle scene with motion gating) and gray is the motion detection input.
+        for CODEC_TILES frame is the TileUpdate and gray its number. single_channel is the FLAG_GRAY of the frame
+        """
+        timestamp, payload, codec, number, single_channel = item
+        if payload is None:  # heartbeat
+            return timestamp, None, None, None, single_channel
+        if codec == frame_protocol.CODEC_TILES:  # pasted on the canvas in frame order by write_frame
+            return timestamp, payload, tiles.decode(payload), number, single_channel
+        gray = motion.small_gray(payload) if self.motion_gate is not None else None
+        transcode = RECORD_MODE == RECORD_TRANSCODE and (self.motion_gate is None or self.motion_gate.recording)
+        if not DISPLAY_VIDEO and not transcode:
+            return timestamp, payload, None, gray, single_channel
+        frame = self.decode_frame(timestamp, payload, single_channel)
+        if frame is None:
+            return None
+        return timestamp, payload, frame, gray, single_channel
+
+    def write_frame(self, item) -> None:
+        """display + persist, on the writer thread, frames arrive in order
+        """
+        timestamp, payload, frame, gray, single_channel = item
+        if self.backlog and self.video_writer is not None and timestamp - self.segment_end > MAX_REPEAT_SECONDS:
+            self.release()  # the next outage of the backlog gets its own segment
+        if isinstance(frame, tiles.TileUpdate):
+            payload, frame, gray = self.rebuild_frame(timestamp, payload, frame, gray)
+            if payload is None and frame is None:
+                return  # no keyframe yet
+        elif payload is None:
+            if WRITE_VIDEO_TO_FILE and RECORD_MODE == RECORD_TRANSCODE and self.motion_gate is None:
+                self.repeat_last_frame(timestamp, heartbeat=True)
+            return
+        if DISPLAY_VIDEO and not self.backlog:
+            #gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            cv2.imshow(self.camera_id, frame)
+            cv2.waitKey(1)
+
+        if WRITE_VIDEO_TO_FILE:  # persist to disk file
+            if self.motion_gate is None:
+                self.record(timestamp, payload, frame, single_channel)
+                return
+            # the pre-roll keeps the JPEG only, decoded frames are too big to hold for seconds
+            score = self.motion_detector.score(gray)
+            item = (payload, frame if self.motion_gate.recording else None, single_channel)
+            for timestamp, (payload, frame, single_channel) in self.motion_gate.feed(timestamp, item, score):
+                self.record(timestamp, payload, frame, single_channel)
+
+    def rebuild_frame(self, timestamp, payload, update, number):
+        """paste a tile update on the canvas, on the writer thread
+
+        returns (jpeg, frame, gray) like process_frame does for a JPEG, the canvas is encoded to
+        a JPEG only for passthrough, the motion pre-roll and live viewers.
+        a delta after a missing update (dropped by DROP_POLICY, failed to decode, lost over UDP) would
+        leave stale tiles on the canvas, the deltas up to the next keyframe are skipped instead
+        """
+        if update.keyframe:
+            if self.tiles_stale:
+                print(f'Tiles {self.camera_id}: keyframe after {self.tiles_skipped} skipped deltas')
+            self.tiles_stale = False
+            self.tiles_skipped = 0
+        elif number != self.tile_next:
+            self.tiles_stale = True
+        self.tile_next = number + 1
+        if self.tiles_stale:
+            self.tiles_skipped += 1
+            return None, None, None
+        canvas = self.canvas.apply(update)
+        if canvas is None:
+            return None, None, None
+        jpeg = tiles.keyframe_jpeg(payload)
+        viewers = self.live and not update.keyframe and get_live_hub().viewers(self.camera_id)
+        if jpeg is None and (RECORD_MODE == RECORD_PASSTHROUGH or self.motion_gate is not None or viewers):
+            jpeg = cv2.imencode('.jpg', canvas)[1].tobytes()
+        if viewers:
+            self.loop.call_soon_threadsafe(get_live_hub().publish, self.camera_id, jpeg)
+        gray = motion.reduce_gray(canvas) if self.motion_gate is not None else None
+        frame = None
+        if DISPLAY_VIDEO or (RECORD_MODE == RECORD_TRANSCODE and (self.motion_gate is None or self.motion_gate.recording)):
+            frame = self.overlay.apply(canvas.copy(), timestamp)
+        return jpeg, frame, gray
+
+    def record(self, timestamp, payload, frame, single_channel=False) -> None:
+        if RECORD_MODE == RECORD_PASSTHROUGH:
+            self.write_passthrough(timestamp, payload, single_channel)
+        else:
+            if frame is None:  # pre-roll, or decoded while the motion gate was closed
+                frame = self.decode_frame(timestamp, payload, single_channel)
+                if frame is None:
+                    return
+            self.write_transcode(timestamp, frame)
+        if self.video_writer is None:
+            return
+        self.segment_frames += 1
+        self.segment_end = timestamp
+        now = time.time()
+        full = RECORD_MODE == RECORD_PASSTHROUGH and self.video_writer.full
+        if int(now - self.start_time) >= 60 * VIDEO_CLIP_LENGTH_MINUTES or full:  # generate a new file every 30 mins
+            self.start_time = now
+            self.release()  # the next frame opens a new file
+
+    def open_segment(self, timestamp, video_width, video_height, color=True) -> None:
+        if self.backlog:
+            self.segment_path = new_video_path(self.camera_id, timestamp, '_backlog')
+        else:
+            self.segment_path = new_video_path(self.camera_id)
+        if RECORD_MODE == RECORD_PASSTHROUGH:
+            self.video_writer = refresh_passthrough_file(self.segment_path, video_width, video_height, color)
+        else:
+            self.video_writer = refresh_video_file(self.segment_path, video_width, video_height, color)
+            self.segment_index = recorder.SegmentIndexWriter(self.segment_path)
+        self.segment_frames = 0
+        self.segment_color = color
+        self.segment_id = get_catalog().open_segment(self.camera_id, self.segment_path, timestamp)
+
+    def write_transcode(self, timestamp, frame) -> None:
+        (video_height, video_width) = frame.shape[:2]
+        if self.video_writer is not None and (frame.ndim == 3) != self.segment_color:
+            self.release()  # VIDEO_COLOR_GRAY switched while connected
+        if self.video_writer is None:
+            self.open_segment(timestamp, video_width, video_height, color=frame.ndim == 3)
+        elif self.motion_gate is None:  # motion gated recordings have gaps on purpose
+            self.repeat_last_frame(timestamp)
+        self.video_writer.write(frame)
+        self.last_frame = frame
+        # XVID does not tell where a frame starts, export seeks by frame number
+        self.segment_index.write(self.segment_frames, 0, 0, 0, timestamp)
+
+    def repeat_last_frame(self, timestamp, heartbeat=False) -> None:
+        """fill the time since the last written frame at VIDEO_FPS, the client skipped an unchanged scene
+
+        up to and including timestamp for a heartbeat, before it for a new frame
+        """
+        if self.video_writer is None or self.last_frame is None:
+            return
+        gap = timestamp - self.segment_end
+        if gap > MAX_REPEAT_SECONDS:
+            return
+        repeats = int(gap * VIDEO_FPS + 0.5) - (0 if heartbeat else 1)
+        for _ in range(repeats):
+            self.segment_end += 1 / VIDEO_FPS
+            self.video_writer.write(self.last_frame)
+            self.segment_index.write(self.segment_frames, 0, 0, 0, self.segment_end)
+            self.segment_frames += 1
+
+    def write_passthrough(self, timestamp, payload, single_channel=False) -> None:
+        if self.video_writer is not None and single_channel == self.segment_color:
+            self.release()  # VIDEO_COLOR_GRAY switched while connected
+        if self.video_writer is None:
+            size = recorder.jpeg_size(payload)
+            if size is None:
+                return  # not a JPEG
+            self.open_segment(timestamp, *size, color=not single_channel)
+        self.video_writer.write(payload, timestamp)
+
+    def release(self) -> None:
+        """close the current file and complete its catalog entry
+        """
+        if self.video_writer is None:
+            return
+        if RECORD_MODE == RECORD_PASSTHROUGH:
+            self.video_writer.close()
+        else:
+            self.video_writer.release()
+            self.segment_index.close()
+            self.segment_index = None
+        self.video_writer = None
+        self.last_frame = None
+        try:
+            size = os.path.getsize(self.segment_path)
+        except OSError as err:  # e.g. the VideoWriter could not open the file
+            print(f'Segment {self.segment_path} not on disk -> {err}')
+            size = 0
+        get_catalog().close_segment(self.segment_id, self.segment_end, size, self.segment_frames)
+
+    def close(self) -> None:
+        """connection is gone, write what is still queued in the background
+        """
+        print(f'Client {self.peername} ({self.pipeline.name}) disconnected, pipeline: {self.pipeline.stats()}')
+        if self.heartbeats:
+            print(f'Static scene {self.camera_id}: {self.heartbeats} heartbeats')
+        if self.backlog_session is not None:
+            self.backlog_session.close()
+        if self.motion_gate is not None:
+            print(f'Motion {self.camera_id}: {self.motion_gate.events} events, {self.motion_gate.skipped} frames not recorded')
+        # a stale connection closed after the camera reconnected leaves the new session's viewers and
+        # live_streams row alone, the row of a reconnect to another worker has that worker's pid
+        if self.live and get_live_hub().remove_camera(self.camera_id, self):
+            if _live_port is not None:
+                get_catalog().clear_live(os.getpid(), self.camera_id)
+        asyncio.ensure_future(self.pipeline.close())
+
+
+async def handle_cam(reader, writer):
+    """called whenever a new client connection is established, StreamReader based ingest
+    """
+    try:
+        version, camera_id, pending = await frame_protocol.accept(reader, writer)
+    except asyncio.IncompleteReadError:
+        return  # closed before the first bytes, e.g. the connectivity probe of a client
+    session = CameraSession(writer.transport, camera_id, version)
+    print(f'Client {session.peername}: camera {camera_id}, {frame_protocol.describe(version)} framing')
+
+    try:
+        while True:
+            if version == frame_protocol.PROTOCOL_LEGACY:
+                header = None
+                raw_data = await frame_protocol.read_legacy_frame(reader, pending)
+                pending = b''
+            else:
+                header, raw_data = await frame_protocol.read_frame(reader)
+            session.on_frame(header, raw_data)
+            #data = str.encode("hello"+'\n')
+            #writer.write(data)
+            #await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError, ConnectionAbortedError) as err:
+        #asyncio.exceptions.IncompleteReadError: 0 bytes read on a total of undefined expected bytes
+        raise err
+    finally:
+        session.close()
+
+
+async def start_server(sock: socket.socket = None):
+    """listen on `sock` (shared by all workers), or bind SERVER_PORT with SO_REUSEPORT
+    """
+    if sock is not None:
+        address = {'sock': sock}
+    else:
+        address = {'host': SERVER_IP, 'port': SERVER_PORT, 'reuse_port': hasattr(socket, 'SO_REUSEPORT')}
+    if ZERO_COPY_INGEST:
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: ingest.FrameIngestProtocol(CameraSession), **address)
+    return await asyncio.start_server(handle_cam, limit=1024*1204*8, **address)
+
+
+async def start_udp_server():
+    """UDP_PORT, with SO_REUSEPORT every worker binds it and the kernel keeps a client on one worker
+    """
+    return await udp_stream.create_server(lambda: udp_stream.DatagramIngestProtocol(CameraSession,
+                                                                                   UDP_REASSEMBLY_DEADLINE,
+                                                                                   UDP_REPORT_INTERVAL,
+                                                                                   UDP_PEER_TIMEOUT,
+                                                                                   UDP_LOSS_INJECTION),
+                                          SERVER_IP,
+                                          UDP_PORT,
+                                          reuse_port=hasattr(socket, 'SO_REUSEPORT'),
+                                          receive_buffer_bytes=UDP_RECEIVE_BUFFER_BYTES)
+
+
+async def start_live_servers(worker_id: int, live_sock: socket.socket = None):
+    """LIVE_HTTP_PORT (shared like SERVER_PORT) and the port of this worker
+    """
+    global _live_port
+    if live_sock is not None:
+        address = {'sock': live_sock}
+    else:
+        address = {'host': SERVER_IP, 'port': LIVE_HTTP_PORT, 'reuse_port': hasattr(socket, 'SO_REUSEPORT')}
+    locate = get_catalog().live_port
+    shared = await live_http.start_http_server(get_live_hub(), locate, **address)
+    _live_port = LIVE_HTTP_PORT + 1 + worker_id
+    own = await live_http.start_http_server(get_live_hub(), None, host=SERVER_IP, port=_live_port)
+    return [shared, own]
+
+
+async def serve(worker_id: int, sock: socket.socket = None, live_sock: socket.socket = None):
+    servers = [await start_server(sock)]
+    if UDP_PORT is not None and (worker_id == 0 or hasattr(socket, 'SO_REUSEPORT')):
+        await start_udp_server()
+    if LIVE_HTTP_PORT is not None:
+        servers += await start_live_servers(worker_id, live_sock)
+    print(f'Worker {worker_id} (pid {os.getpid()}) serving on {SERVER_IP}:{SERVER_PORT}')
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def run_worker(worker_id: int, sock: socket.socket = None, live_sock: socket.socket = None):
+    """entrypoint of a worker process
+    """
+    asyncio.run(serve(worker_id, sock, live_sock))
+
+
+def main():
+    """main entrypoint, supervise NUM_WORKERS worker processes
+
+    with SO_REUSEPORT every worker binds SERVER_PORT itself and the kernel spreads the
+    connections, otherwise the supervisor binds once and the workers accept on that socket.
+    a worker that dies is restarted, the cameras on the other workers keep streaming.
+    the supervisor also applies the retention limits to the segment catalog.
+    """
+    segments = open_catalog()
+    segments.recover()
+    adopted = segments.adopt(VIDEO_SAVE_PATH)
+    if adopted:
+        print(f'Catalog: added {adopted} existing files')
+    retention = retention_policy()
+    retention_time = 0
+
+    sock = None
+    live_sock = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sock = socket.create_server((SERVER_IP, SERVER_PORT), reuse_port=False)
+        sock.setblocking(False)
+        if LIVE_HTTP_PORT is not None:
+            live_sock = socket.create_server((SERVER_IP, LIVE_HTTP_PORT), reuse_port=False)
+            live_sock.setblocking(False)
+
+    def spawn(worker_id):
+        worker = multiprocessing.Process(target=run_worker, args=(worker_id, sock, live_sock), name=f'worker-{worker_id}', daemon=True)
+        worker.start()
+        return worker
+
+    workers = {worker_id: spawn(worker_id) for worker_id in range(NUM_WORKERS)}
+    print(f'Started {NUM_WORKERS} workers on {SERVER_IP}:{SERVER_PORT}')
+    while True:
+        time.sleep(WORKER_RESTART_DELAY)
+        for worker_id, worker in workers.items():
+            if not worker.is_alive():
+                print(f'Worker {worker_id} (pid {worker.pid}) exited with {worker.exitcode}, restart it')
+                segments.clear_live(worker.pid)
+                workers[worker_id] = spawn(worker_id)
+        if time.time() - retention_time >= RETENTION_INTERVAL:
+            retention_time = time.time()
+            try:
+                retention.enforce(segments, VIDEO_SAVE_PATH)
+            except Exception as err:
+                print(f'Retention failed: {err}')
+
+
+if __name__ == '__main__':
+    main()
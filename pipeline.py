@@ -0,0 +1,209 @@
+"""
+staged frame pipeline for pi_cam_stream_server.py, keeps decode/overlay/VideoWriter off the event loop
+
+    network reader (event loop)
+      -> decode queue, bounded, DROP_OLDEST / DROP_NEWEST / BLOCK when full
+      -> worker pool, `workers` frames in flight: decode + overlay
+      -> reorder, results leave in the order they were dispatched
+      -> write queue, bounded
+      -> single writer thread: VideoWriter.write, display
+
+a slow writer (SD card) fills the write queue, then stalls the workers, then fills the decode
+queue where the drop policy applies, the event loop keeps reading sockets all the time.
+with BLOCK the transport stops reading instead, which pushes back on the client through TCP.
+
+cv2.imdecode, cv2.putText and VideoWriter.write release the GIL, so threads are enough
+and frames never get pickled.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+_CLOSE = object()
+
+
+class StageStats:
+    """counters of one stage, updated from the event loop only"""
+
+    def __init__(self):
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.busy_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'ms_per_frame': round(1000 * self.busy_seconds / self.frames, 2) if self.frames and self.busy_seconds else None,
+        }
+
+
+def _timed(func, item):
+    start = time.perf_counter()
+    result = func(item)
+    return result, time.perf_counter() - start
+
+
+class FramePipeline:
+    """one pipeline per connection, so every camera gets its own ordered writer
+
+    process(item) -> result or None, runs on `executor` (shared by all connections)
+    write(result), runs on the pipeline's own writer thread, in submit order
+    finish(), runs on the writer thread after the last write, e.g. VideoWriter.release
+    pause() / resume(), flow control for the BLOCK policy, e.g. transport.pause_reading
+    """
+
+    def __init__(self,
+                 process,
+                 write,
+                 executor: concurrent.futures.Executor,
+                 workers: int = 2,
+                 queue_depth: int = 8,
+                 write_queue_depth: int = 16,
+                 drop_policy: str = DROP_OLDEST,
+                 finish=None,
+                 pause=None,
+                 resume=None,
+                 name: str = 'pipeline'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f'drop_policy must be one of {DROP_POLICIES}, got {drop_policy!r}')
+        self.name = name
+        self.queue_depth = queue_depth
+        self.drop_policy = drop_policy
+        self.ingest = StageStats()
+        self.decode = StageStats()
+        self.write = StageStats()
+        self._process = process
+        self._write = write
+        self._finish = finish
+        self._pause = pause
+        self._resume = resume
+        self._paused = False
+        self._executor = executor
+        self._write_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=f'{name}-write')
+        self._queue = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(workers)
+        self._write_queue = asyncio.Queue(write_queue_depth)
+        self._done = {}  # dispatch index -> result, waiting for the earlier frames
+        self._next_index = 0
+        self._next_write = 0
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._tasks = set()
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._writer = asyncio.ensure_future(self._write_loop())
+
+    def submit(self, item) -> bool:
+        """called by the network reader, never blocks, False when item itself was dropped
+        """
+        self.ingest.frames += 1
+        if self._closing:
+            self.ingest.dropped += 1
+            return False
+        if len(self._queue) >= self.queue_depth:
+            if self.drop_policy == DROP_NEWEST:
+                self.ingest.dropped += 1
+                return False
+            if self.drop_policy == DROP_OLDEST:
+                self._queue.popleft()
+                self.ingest.dropped += 1
+        self._queue.append(item)
+        self.ingest.queued = len(self._queue)
+        self.ingest.max_queued = max(self.ingest.max_queued, self.ingest.queued)
+        if self.drop_policy == BLOCK and not self._paused and len(self._queue) >= self.queue_depth and self._pause:
+            self._paused = True
+            self._pause()
+        self._wakeup.set()
+        return True
+
+    def stats(self) -> dict:
+        self.decode.queued = self._next_index - self._next_write
+        self.write.queued = self._write_queue.qsize()
+        return {
+            'ingest': self.ingest.as_dict(),
+            'decode': self.decode.as_dict(),
+            'write': self.write.as_dict(),
+        }
+
+    async def close(self) -> None:
+        """finish everything already queued, then release the writer
+        """
+        self._closing = True
+        self._wakeup.set()
+        await self._dispatcher
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        await self._write_queue.put(_CLOSE)
+        await self._writer
+        self._write_executor.shutdown(wait=False)
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._slots.acquire()
+            item = self._queue.popleft()
+            self.ingest.queued = len(self._queue)
+            if self._paused and len(self._queue) < self.queue_depth:
+                self._paused = False
+                self._resume()
+            task = loop.create_task(self._work(self._next_index, item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._next_index += 1
+
+    async def _work(self, index, item):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                result, seconds = await loop.run_in_executor(self._executor, _timed, self._process, item)
+                self.decode.frames += 1
+                self.decode.busy_seconds += seconds
+            except Exception as err:
+                print(f'{self.name}: decode failed -> {err}')
+                self.decode.errors += 1
+                result = None
+            self._done[index] = result
+            async with self._flush_lock:
+                while self._next_write in self._done:
+                    result = self._done.pop(self._next_write)
+                    if result is not None:
+                        await self._write_queue.put(result)  # blocks while the writer is behind
+                        self.write.max_queued = max(self.write.max_queued, self._write_queue.qsize())
+                    self._next_write += 1
+        finally:
+            self._slots.release()
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            result = await self._write_queue.get()
+            if result is _CLOSE:
+                break
+            try:
+                _, seconds = await loop.run_in_executor(self._write_executor, _timed, self._write, result)
+                self.write.frames += 1
+                self.write.busy_seconds += seconds
+            except Exception as err:
+                print(f'{self.name}: write failed -> {err}')
+                self.write.errors += 1
+        if self._finish is not None:
+            await loop.run_in_executor(self._write_executor, self._finish)
@@ -0,0 +1,197 @@
+"""
+adaptive rate control for pi_cam_stream_client.py
+
+the controller walks a ladder of encoder settings, best first:
+
+    quality max_quality .. min_quality in quality_step steps, full resolution, every frame
+    then the resolution scales down (scales), at min_quality
+    then frames are skipped (frame_skips), send every n-th frame
+
+once per `window` seconds it looks at what the connection did:
+- ack lag: send -> FRAME_ACK from the server (protocol v2), the best measure of queued data
+- drain: fraction of the window the sender spent in writer.drain()
+- write buffer: bytes the transport could not hand to the kernel yet
+- bitrate: bytes sent per second against max_bytes_per_second
+- loss: fraction of the frames the server could not put together over UDP (udp_stream.py), a frame
+  of more datagrams is more likely to lose one, smaller frames help
+
+any signal over its high mark steps one level down, all signals under their low marks for
+up_hold seconds step one level up, in between nothing changes. after a step down the
+controller waits as long as the lag was before it steps again, the data already queued has
+to drain before the new settings show.
+every step is logged with the signals that caused it.
+
+boost(seconds, quality) overrides the ladder for a while, e.g. when face.py reports a face: every
+frame is sent and at least `quality`, the scale stays where congestion put it.
+"""
+import collections
+import logging
+import time
+from typing import NamedTuple
+
+LOG = logging.getLogger('pi_cam_client')
+
+
+class RateSettings(NamedTuple):
+    quality: int  # IMWRITE_JPEG_QUALITY
+    scale: float  # of the captured resolution
+    frame_skip: int  # send every frame_skip-th frame
+
+
+def build_ladder(max_quality=95, min_quality=50, quality_step=10, scales=(1.0, 0.75, 0.5), frame_skips=(1, 2, 4)):
+    ladder = []
+    for quality in range(max_quality, min_quality - 1, -quality_step):
+        ladder.append(RateSettings(quality, scales[0], frame_skips[0]))
+    if ladder[-1].quality != min_quality:
+        ladder.append(RateSettings(min_quality, scales[0], frame_skips[0]))
+    ladder += [RateSettings(min_quality, scale, frame_skips[0]) for scale in scales[1:]]
+    ladder += [RateSettings(min_quality, scales[-1], frame_skip) for frame_skip in frame_skips[1:]]
+    return ladder
+
+
+class RateController:
+    """fed by the sender (on_send) and the ack reader (on_ack), both on the event loop
+    """
+
+    def __init__(self,
+                 ladder,
+                 window: float = 1.0,
+                 up_hold: float = 5.0,
+                 lag_high: float = 0.5,
+                 lag_low: float = 0.15,
+                 drain_high: float = 0.8,
+                 drain_low: float = 0.3,
+                 buffer_high: int = 256 * 1024,
+                 buffer_low: int = 32 * 1024,
+                 max_bytes_per_second: int = None,
+                 loss_high: float = 0.1,
+                 loss_low: float = 0.02):
+        self.ladder = ladder
+        self.level = 0
+        self.window = window
+        self.up_hold = up_hold
+        self.lag_high = lag_high
+        self.lag_low = lag_low
+        self.drain_high = drain_high
+        self.drain_low = drain_low
+        self.buffer_high = buffer_high
+        self.buffer_low = buffer_low
+        self.max_bytes_per_second = max_bytes_per_second
+        self.loss_high = loss_high
+        self.loss_low = loss_low
+        self._sent_at = collections.OrderedDict()  # seq -> send time, waiting for the ack
+        self._window_start = time.monotonic()
+        self._clear_since = None
+        self._down_until = 0.0
+        self._boost_until = 0.0
+        self._boost_quality = 0
+        self._reset_window()
+
+    @property
+    def settings(self) -> RateSettings:
+        settings = self.ladder[self.level]
+        if time.monotonic() < self._boost_until:
+            return settings._replace(quality=max(settings.quality, self._boost_quality), frame_skip=1)
+        return settings
+
+    @property
+    def boosted(self) -> bool:
+        return time.monotonic() < self._boost_until
+
+    def boost(self, seconds: float, quality: int) -> None:
+        """every frame at quality or better for the next seconds, a boost running is extended
+        """
+        if not self.boosted:
+            LOG.info(f'rate control: boost for {seconds:.0f}s, every frame at quality >= {quality}')
+        self._boost_until = time.monotonic() + seconds
+        self._boost_quality = quality
+
+    def reset(self) -> None:
+        """new connection, the acks of the old one never come
+        """
+        self._sent_at.clear()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._bytes = 0
+        self._drain_seconds = 0.0
+        self._max_buffer = 0
+        self._max_lag = None
+        self._max_loss = None
+
+    def on_send(self, seq: int, nbytes: int, drain_seconds: float, write_buffer: int, acked: bool) -> None:
+        now = time.monotonic()
+        self._bytes += nbytes
+        self._drain_seconds += drain_seconds
+        self._max_buffer = max(self._max_buffer, write_buffer)
+        if acked:
+            self._sent_at[seq] = now - drain_seconds  # handed to the transport before the drain
+            while len(self._sent_at) > 1000:  # acks that got lost with a connection
+                self._sent_at.popitem(last=False)
+        if now - self._window_start >= self.window:
+            self._decide(now)
+
+    def on_ack(self, seq: int) -> None:
+        sent_at = self._sent_at.pop(seq, None)
+        if sent_at is not None:
+            # acks come in order, an older frame still waiting got lost (UDP) and has no lag
+            while self._sent_at and next(iter(self._sent_at.values())) <= sent_at:
+                self._sent_at.popitem(last=False)
+            lag = time.monotonic() - sent_at
+            self._max_lag = lag if self._max_lag is None else max(self._max_lag, lag)
+
+    def on_loss(self, loss: float) -> None:
+        """fraction of the frames lost since the last report of the server, UDP only
+        """
+        self._max_loss = loss if self._max_loss is None else max(self._max_loss, loss)
+
+    def _decide(self, now):
+        seconds = now - self._window_start
+        if self._boost_until and now >= self._boost_until:
+            self._boost_until = 0.0
+            LOG.info(f'rate control: boost over, back to {self.settings}')
+        # frames still waiting for their ack count with the time they have waited so far
+        lag = self._max_lag
+        if self._sent_at:
+            oldest = now - next(iter(self._sent_at.values()))
+            if lag is None or oldest > lag:
+                lag = oldest
+        signals = {
+            'lag': lag,
+            'drain': self._drain_seconds / seconds,
+            'buffer': self._max_buffer,
+            'bitrate': self._bytes / seconds,
+            'loss': self._max_loss,
+        }
+        congested = [name for name, high in (('lag', self.lag_high),
+                                             ('drain', self.drain_high),
+                                             ('buffer', self.buffer_high),
+                                             ('bitrate', self.max_bytes_per_second),
+                                             ('loss', self.loss_high))
+                     if high is not None and signals[name] is not None and signals[name] > high]
+        clear = ((lag is None or lag < self.lag_low)
+                 and signals['drain'] < self.drain_low
+                 and signals['buffer'] < self.buffer_low
+                 and (self.max_bytes_per_second is None or signals['bitrate'] < 0.8 * self.max_bytes_per_second)
+                 and (self._max_loss is None or self.loss_low is None or self._max_loss < self.loss_low))
+        summary = (f"lag {'-' if lag is None else f'{lag:.2f}s'}, drain {signals['drain']:.0%}, "
+                   f"buffer {signals['buffer']}B, {signals['bitrate'] / 1024:.0f}KB/s")
+        if self._max_loss is not None:
+            summary += f', loss {self._max_loss:.1%}'
+        if congested:
+            self._clear_since = None
+            if self.level < len(self.ladder) - 1 and now >= self._down_until:
+                self.level += 1
+                self._down_until = now + (lag or 0.0)
+                LOG.info(f'rate control: down to {self.settings} ({", ".join(congested)} high: {summary})')
+        elif clear:
+            if self._clear_since is None:
+                self._clear_since = now
+            elif now - self._clear_since >= self.up_hold and self.level > 0:
+                self.level -= 1
+                self._clear_since = now  # hold again before the next step up
+                LOG.info(f'rate control: up to {self.settings} (clear for {self.up_hold:.0f}s: {summary})')
+        else:
+            self._clear_since = None
+        self._reset_window()
@@ -0,0 +1,288 @@
+"""
+JPEG passthrough recording, the received JPEG bytes go to disk unchanged
+
+MjpegAviWriter writes an MJPEG AVI (RIFF, one '00dc' chunk per JPEG, idx1 index) that plays in
+VLC/ffplay/cv2.VideoCapture without any decode or encode on the server. the capture time of
+every frame goes to a sidecar file next to the AVI instead of being burned into the pixels,
+export.py burns it in when a clip is exported.
+
+    2022_03_01_20_00_00.avi       MJPEG frames
+    2022_03_01_20_00_00.avi.idx   seek index, one fixed size entry per frame:
+                                  frame number, byte offset, length, flags, capture time
+
+the index is written while recording (also for transcoded segments, with offset 0), entries
+are sorted by capture time so a clip is found with a binary search over the file.
+
+AVI 1.0 sizes are 32 bit and many players stop at 1GB, the writer reports `full` before that
+and the server starts a new segment.
+"""
+import os
+import struct
+from typing import List, NamedTuple
+
+import overlay
+
+MAX_AVI_BYTES = 1 << 30  # 1GB
+# longer pauses between two frames are gaps in the recording (motion gating, reconnects),
+# they do not count towards the playback rate
+MAX_FRAME_INTERVAL = 2.0
+INDEX_SUFFIX = '.idx'
+TIMEZONE = 'US/Pacific'
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+_AVIH = struct.Struct('<10I16x')  # 56 bytes
+_STRH = struct.Struct('<4s4sIHHIIIIIIII4h')  # 56 bytes
+_STRF = struct.Struct('<IiiHH4sIiiII')  # 40 bytes, BITMAPINFOHEADER
+_CHUNK = struct.Struct('<4sI')
+_IDX1_ENTRY = struct.Struct('<4sIII')
+
+INDEX_MAGIC = b'PCIX'
+INDEX_VERSION = 1
+INDEX_KEYFRAME = 0x1  # the frame decodes on its own
+INDEX_JPEG = 0x2  # offset/length point at a complete JPEG in the segment, it can be copied as is
+_INDEX_HEADER = struct.Struct('<4sI')
+_INDEX_ENTRY = struct.Struct('<IQIId')  # frame, offset, length, flags, timestamp
+
+# size of the fixed header written by _header(), the first chunk follows it
+_HEADER_SIZE = 12 + 8 + 4 + 8 + _AVIH.size + 8 + 4 + 8 + _STRH.size + 8 + _STRF.size + 12
+
+
+def jpeg_size(data):
+    """(width, height) from the SOF marker of a JPEG, None if there is none
+
+    only walks the marker segments in front of the image data, a few dozen bytes
+    """
+    data = memoryview(data)
+    pos = 2  # skip SOI
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def avi_color(path: str):
+    """False for a segment MjpegAviWriter wrote with color=False, True with color, None for any other file
+    """
+    with open(path, 'rb') as avi:
+        header = avi.read(_HEADER_SIZE)
+    strf = _HEADER_SIZE - 12 - _STRF.size - 8  # the fixed layout of _header()
+    if len(header) < _HEADER_SIZE or header[:4] != b'RIFF' or header[strf:strf + 4] != b'strf':
+        return None
+    bit_count = _STRF.unpack_from(header, strf + 8)[4]
+    return bit_count != 8
+
+
+def burn_in_timestamp(frame, timestamp: float, timezone: str = TIMEZONE):
+    """print the capture time on frame, in place, the default layout of overlay.py
+    """
+    return overlay.timestamp_compositor(timezone).apply(frame, timestamp)
+
+
+class IndexEntry(NamedTuple):
+    frame: int
+    offset: int
+    length: int
+    flags: int
+    timestamp: float
+
+
+class SegmentIndexWriter:
+    """append the seek index of a segment, path is the segment, the index goes next to it
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path + INDEX_SUFFIX, 'wb')
+        self._file.write(_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+
+    def write(self, frame: int, offset: int, length: int, flags: int, timestamp: float) -> None:
+        self._file.write(_INDEX_ENTRY.pack(frame, offset, length, flags, timestamp))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SegmentIndex:
+    """read side of the seek index, entries are read on demand, never the whole file
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path + INDEX_SUFFIX, 'rb')
+        magic, version = _INDEX_HEADER.unpack(self._file.read(_INDEX_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self._file.close()
+            raise ValueError(f'{path}{INDEX_SUFFIX}: not a segment index')
+        # a segment that is still recording may end with half an entry
+        self._length = (os.fstat(self._file.fileno()).st_size - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> IndexEntry:
+        return self.entries(index, index + 1)[0]
+
+    def entries(self, first: int, last: int) -> List[IndexEntry]:
+        """entries [first, last), one read
+        """
+        first = max(first, 0)
+        last = min(last, self._length)
+        if first >= last:
+            return []
+        self._file.seek(_INDEX_HEADER.size + first * _INDEX_ENTRY.size)
+        data = self._file.read((last - first) * _INDEX_ENTRY.size)
+        return [IndexEntry(*fields) for fields in _INDEX_ENTRY.iter_unpack(data)]
+
+    def bisect(self, timestamp: float, right: bool = False) -> int:
+        """first entry captured at or after timestamp (after it, with right=True)
+        """
+        low, high = 0, self._length
+        while low < high:
+            middle = (low + high) // 2
+            entry_time = self[middle].timestamp
+            if entry_time < timestamp or (right and entry_time == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class MjpegAviWriter:
+    """append JPEGs to an MJPEG AVI, the header and idx1 are finished by close()
+
+    color=False declares 8 bit frames in the header, for single channel JPEGs
+    """
+
+    def __init__(self, path: str, width: int, height: int, fps: float, color: bool = True):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.channels = 3 if color else 1
+        self.frames = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self._capture_seconds = 0.0
+        self._intervals = 0
+        self._index = bytearray()
+        self._movi_size = 4  # 'movi'
+        self._file = open(path, 'wb')
+        self._file.write(self._header())
+        self._seek_index = SegmentIndexWriter(path)
+
+    @property
+    def size(self) -> int:
+        return _HEADER_SIZE + self._movi_size - 4 + len(self._index) + 8
+
+    @property
+    def full(self) -> bool:
+        return self.size >= MAX_AVI_BYTES
+
+    def write(self, jpeg, timestamp: float) -> None:
+        length = len(jpeg)
+        offset = self._movi_size  # relative to the 'movi' fourcc
+        self._file.write(_CHUNK.pack(b'00dc', length))
+        self._file.write(jpeg)
+        if length & 1:
+            self._file.write(b'\0')
+        self._movi_size += _CHUNK.size + length + (length & 1)
+        self._index += _IDX1_ENTRY.pack(b'00dc', AVIIF_KEYFRAME, offset, length)
+        # the 'movi' fourcc is the last 4 bytes of the header, the JPEG follows the chunk header
+        self._seek_index.write(self.frames, _HEADER_SIZE - 4 + offset + _CHUNK.size, length,
+                               INDEX_KEYFRAME | INDEX_JPEG, timestamp)
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        elif 0 < timestamp - self.last_timestamp <= MAX_FRAME_INTERVAL:
+            self._capture_seconds += timestamp - self.last_timestamp
+            self._intervals += 1
+        self.last_timestamp = timestamp
+        self.frames += 1
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self._intervals and self._capture_seconds > 0:
+            # play back at the rate the frames were captured
+            self.fps = self._intervals / self._capture_seconds
+        self._file.write(_CHUNK.pack(b'idx1', len(self._index)))
+        self._file.write(self._index)
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.close()
+        self._file = None
+        self._seek_index.close()
+
+    def _header(self) -> bytes:
+        usec_per_frame = int(1e6 / self.fps) if self.fps else 0
+        rate_scale = 1000
+        avih = _AVIH.pack(usec_per_frame, 0, 0, AVIF_HASINDEX, self.frames, 0, 1, 0, self.width, self.height)
+        strh = _STRH.pack(b'vids', b'MJPG', 0, 0, 0, 0, rate_scale, int(self.fps * rate_scale), 0,
+                          self.frames, 0, 0xFFFFFFFF, 0, 0, 0, self.width, self.height)
+        strf = _STRF.pack(_STRF.size, self.width, self.height, 1, 8 * self.channels, b'MJPG',
+                          self.width * self.height * self.channels, 0, 0, 0, 0)
+        strl = b'strl' + _CHUNK.pack(b'strh', len(strh)) + strh + _CHUNK.pack(b'strf', len(strf)) + strf
+        hdrl = b'hdrl' + _CHUNK.pack(b'avih', len(avih)) + avih + _CHUNK.pack(b'LIST', len(strl)) + strl
+        riff_size = 4 + 8 + len(hdrl) + 8 + self._movi_size + 8 + len(self._index)
+        header = (_CHUNK.pack(b'RIFF', riff_size) + b'AVI ' + _CHUNK.pack(b'LIST', len(hdrl)) + hdrl
+                  + _CHUNK.pack(b'LIST', self._movi_size) + b'movi')
+        assert len(header) == _HEADER_SIZE
+        return header
+
+
+def read_avi_frames(path: str):
+    """yield the JPEG of every '00dc' chunk of an AVI, also works on a segment that was never closed
+    """
+    with open(path, 'rb') as avi:
+        avi.seek(_HEADER_SIZE)
+        while True:
+            chunk = avi.read(_CHUNK.size)
+            if len(chunk) < _CHUNK.size:
+                return
+            fourcc, length = _CHUNK.unpack(chunk)
+            if fourcc == b'idx1':
+                return
+            data = avi.read(length + (length & 1))
+            if len(data) < length:
+                return  # cut off by a crash
+            if fourcc == b'00dc':
+                yield data[:length]
+
+
+def read_timestamps(path: str):
+    """capture time of every frame of a segment from its seek index, empty without one
+    """
+    if not os.path.exists(path + INDEX_SUFFIX):
+        return []
+    with SegmentIndex(path) as index:
+        return [entry.timestamp for entry in index.entries(0, len(index))]
+
+
+def segment_fps(timestamps, default: float = 10) -> float:
+    """average capture rate of a segment, gaps longer than MAX_FRAME_INTERVAL left out
+    """
+    intervals = [later - earlier for earlier, later in zip(timestamps, timestamps[1:])
+                 if 0 < later - earlier <= MAX_FRAME_INTERVAL]
+    if intervals:
+        return len(intervals) / sum(intervals)
+    return default
@@ -0,0 +1,190 @@
+"""
+on-disk ring of frames for pi_cam_stream_client.py, keeps what is captured while the server is unreachable
+
+    <directory>/00000001.spool   length-prefixed records, appended: timestamp, width, height, length, JPEG
+    <directory>/00000002.spool   a new file every file_bytes
+    <directory>/cursor           file number and offset of the first frame the server has not confirmed
+
+when the files take more than max_bytes the oldest one is deleted, uploaded or not, so a long outage
+keeps its most recent part. the cursor only moves when the server confirmed a frame (commit), frames
+that were sent on a connection that broke are read again after a restart or rewind(). UploadWindow keeps
+the cursor behind the first frame that was not confirmed.
+"""
+import collections
+import os
+import struct
+import threading
+from typing import NamedTuple, Optional
+
+RECORD = struct.Struct('!dHHI')  # timestamp, width, height, length, then the JPEG
+SUFFIX = '.spool'
+CURSOR = 'cursor'
+
+
+class Position(NamedTuple):
+    file_number: int
+    offset: int
+
+
+class SpooledFrame(NamedTuple):
+    end: Position  # commit this once the frame arrived
+    timestamp: float
+    jpeg: bytes
+    width: int
+    height: int
+
+
+class FrameSpool:
+    """append() while disconnected, read() + commit() to upload, thread safe, every call does disk IO
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30, file_bytes: int = 8 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.file_bytes = file_bytes
+        self.appended = 0
+        self.lost = 0  # files deleted before they were uploaded
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._files = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(directory) if name.endswith(SUFFIX))
+        self._cursor = self._read_cursor()
+        self._read_position = self._cursor
+        self._append_file = None
+
+    def _path(self, file_number):
+        return os.path.join(self.directory, f'{file_number:08}{SUFFIX}')
+
+    def _read_cursor(self) -> Position:
+        first = Position(self._files[0] if self._files else 1, 0)
+        try:
+            with open(os.path.join(self.directory, CURSOR)) as cursor:
+                position = Position(*map(int, cursor.read().split()))
+        except (OSError, ValueError, TypeError):
+            return first
+        return max(position, first)
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, CURSOR)
+        with open(path + '.tmp', 'w') as cursor:
+            cursor.write(f'{self._cursor.file_number} {self._cursor.offset}')
+        os.replace(path + '.tmp', path)
+
+    def pending_bytes(self) -> int:
+        """bytes from the cursor to the end, 0 when everything was uploaded
+        """
+        with self._lock:
+            total = sum(os.path.getsize(self._path(number)) for number in self._files if number >= self._cursor.file_number)
+            return max(0, total - self._cursor.offset) if self._files else 0
+
+    def append(self, timestamp: float, jpeg, width: int, height: int) -> None:
+        with self._lock:
+            if self._append_file is None or self._append_file.tell() >= self.file_bytes:
+                self._roll()
+            self._append_file.write(RECORD.pack(timestamp, width, height, len(jpeg)))
+            self._append_file.write(jpeg)
+            self._append_file.flush()
+            self.appended += 1
+
+    def _roll(self):
+        if self._append_file is not None:
+            self._append_file.close()
+        number = self._files[-1] + 1 if self._files else max(1, self._cursor.file_number)
+        self._files.append(number)
+        self._append_file = open(self._path(number), 'ab')
+        while len(self._files) > 1 and sum(os.path.getsize(self._path(spooled)) for spooled in self._files) > self.max_bytes:
+            oldest = self._files.pop(0)
+            if oldest >= self._cursor.file_number:
+                self.lost += 1
+            os.remove(self._path(oldest))
+            if self._cursor.file_number <= oldest:
+                self._cursor = Position(self._files[0], 0)
+                self._write_cursor()
+            if self._read_position.file_number <= oldest:
+                self._read_position = Position(self._files[0], 0)
+
+    def read(self, max_frames: int = 16) -> list:
+        """the next frames after the last read, oldest first, [] when there are none
+        """
+        frames = []
+        with self._lock:
+            position = self._read_position
+            while len(frames) < max_frames and position.file_number in self._files:
+                with open(self._path(position.file_number), 'rb') as spool_file:
+                    spool_file.seek(position.offset)
+                    while len(frames) < max_frames:
+                        record = spool_file.read(RECORD.size)
+                        if len(record) < RECORD.size:
+                            break
+                        timestamp, width, height, length = RECORD.unpack(record)
+                        jpeg = spool_file.read(length)
+                        if len(jpeg) < length:
+                            break  # still being appended, or cut off by a crash
+                        position = Position(position.file_number, spool_file.tell())
+                        frames.append(SpooledFrame(position, timestamp, jpeg, width, height))
+                if len(frames) >= max_frames:
+                    break
+                # only the last file is appended to, the others are complete
+                later = [number for number in self._files if number > position.file_number]
+                if not later:
+                    break
+                position = Position(later[0], 0)
+            self._read_position = position
+        return frames
+
+    def rewind(self) -> None:
+        """read again from the cursor, the frames sent on a lost connection may not have arrived
+        """
+        with self._lock:
+            self._read_position = self._cursor
+
+    def commit(self, position: Position) -> None:
+        """the server has every frame up to position, files before it are deleted
+        """
+        with self._lock:
+            if position <= self._cursor:
+                return
+            self._cursor = position
+            while len(self._files) > 1 and self._files[0] < position.file_number:
+                os.remove(self._path(self._files.pop(0)))
+            self._write_cursor()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._append_file is not None:
+                self._append_file.close()
+                self._append_file = None
+
+
+class UploadWindow:
+    """the frames sent on one connection, in send order, for the event loop
+
+    the server may not confirm every frame (a full backlog pipeline refuses it, the ack is lost over UDP),
+    so only the end of the confirmed prefix is committed, the frames after a gap are sent again
+    on the next connection
+    """
+
+    def __init__(self):
+        self._sent = collections.OrderedDict()  # seq -> [end, confirmed]
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+    def sent(self, seq: int, end: Position) -> None:
+        self._sent[seq] = [end, False]
+
+    def ack(self, seq: int) -> Optional[Position]:
+        """the position to commit, None when the confirmed prefix did not grow
+        """
+        frame = self._sent.get(seq)
+        if frame is None:
+            return None
+        frame[1] = True
+        end = None
+        while self._sent and next(iter(self._sent.values()))[1]:
+            end = self._sent.popitem(last=False)[1][0]
+        return end
+
+    def clear(self) -> None:
+        """the connection ended, its unconfirmed frames are read again after rewind()
+        """
+        self._sent.clear()
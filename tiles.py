@@ -0,0 +1,179 @@
+"""
+tile delta codec (frame_protocol.CODEC_TILES), for mostly static scenes with small moving objects
+
+the frame is a grid of tile_width x tile_height tiles. a keyframe carries the whole frame as one
+JPEG, the frames in between carry only the tiles that changed since they were last sent, each one
+its own JPEG with its grid position:
+
+    header     !BHHH   keyframe (0/1), tile_width, tile_height, count
+    per tile   !HHI    column, row, length, then `length` bytes of JPEG
+
+    TileEncoder   client side, finds changed tiles with absdiff + threshold + an INTER_AREA resize,
+                  encodes only those, a keyframe every keyframe_interval seconds
+    TileCanvas    server side, the frame as last rebuilt, tiles are pasted in frame order
+
+deltas build on each other, the client sends them in order with a single encoder and the server
+applies them on its writer thread. the server numbers the updates it queues, after a missing one
+(dropped by DROP_POLICY, failed to decode, lost over UDP) it skips the deltas until the next
+keyframe instead of pasting them over stale tiles, the recording and live view pause meanwhile.
+"""
+import struct
+import threading
+import time
+from typing import List, NamedTuple
+
+import numpy as np
+import cv2
+
+TILE_HEADER = struct.Struct('!BHHH')
+TILE_ENTRY = struct.Struct('!HHI')
+
+
+class Tile(NamedTuple):
+    column: int
+    row: int
+    image: object  # decoded on a server decode thread, JPEG bytes while parsing
+
+
+class TileUpdate(NamedTuple):
+    keyframe: bool
+    tile_width: int
+    tile_height: int
+    tiles: List[Tile]
+
+
+def parse(payload) -> TileUpdate:
+    """split a CODEC_TILES payload, the tile images stay memoryviews of payload
+    """
+    payload = memoryview(payload)
+    keyframe, tile_width, tile_height, count = TILE_HEADER.unpack_from(payload)
+    offset = TILE_HEADER.size
+    tiles = []
+    for _ in range(count):
+        column, row, length = TILE_ENTRY.unpack_from(payload, offset)
+        offset += TILE_ENTRY.size
+        tiles.append(Tile(column, row, payload[offset:offset + length]))
+        offset += length
+    return TileUpdate(bool(keyframe), tile_width, tile_height, tiles)
+
+
+def decode(payload) -> TileUpdate:
+    """parse + cv2.imdecode every tile, thread safe
+    """
+    update = parse(payload)
+    tiles = []
+    for tile in update.tiles:
+        image = cv2.imdecode(np.frombuffer(tile.image, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError(f'tile {tile.column},{tile.row} does not decode')
+        tiles.append(tile._replace(image=image))
+    return update._replace(tiles=tiles)
+
+
+def keyframe_jpeg(payload):
+    """the JPEG of a keyframe payload as bytes, None for a delta
+    """
+    update = parse(payload)
+    return bytes(update.tiles[0].image) if update.keyframe and update.tiles else None
+
+
+def pack(keyframe: bool, tile_width: int, tile_height: int, tiles) -> bytes:
+    """tiles: (column, row, jpeg bytes)
+    """
+    parts = [TILE_HEADER.pack(int(keyframe), tile_width, tile_height, len(tiles))]
+    for column, row, jpeg in tiles:
+        parts.append(TILE_ENTRY.pack(column, row, len(jpeg)))
+        parts.append(jpeg)
+    return b''.join(parts)
+
+
+class TileEncoder:
+    """keeps the frame the server has, call encode() for the frames in send order
+    """
+
+    def __init__(self,
+                 tile_width: int = 80,
+                 tile_height: int = 80,
+                 threshold: float = 0.002,
+                 pixel_threshold: int = 12,
+                 keyframe_interval: float = 10):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = 0
+        self.deltas = 0
+        self.tiles = 0
+        self._reference = None
+        self._keyframe_time = 0.0
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        """the next frame is a keyframe, e.g. on a new connection
+        """
+        with self._lock:
+            self._reference = None
+
+    def changed_tiles(self, frame):
+        """(rows, columns) of the tiles where more than threshold of the pixels differ from the reference
+        """
+        diff = cv2.absdiff(frame, self._reference)
+        if diff.ndim == 3:
+            blue, green, red = cv2.split(diff)
+            diff = cv2.max(cv2.max(blue, green), red)
+        _, mask = cv2.threshold(diff, self.pixel_threshold, 1, cv2.THRESH_BINARY)
+        height, width = mask.shape
+        rows = -(-height // self.tile_height)
+        columns = -(-width // self.tile_width)
+        mask = cv2.copyMakeBorder(mask, 0, rows * self.tile_height - height, 0, columns * self.tile_width - width,
+                                  cv2.BORDER_CONSTANT, value=0)
+        # INTER_AREA by a whole factor is the mean of every tile, the fraction of its pixels that changed
+        changed = cv2.resize(mask.astype(np.float32), (columns, rows), interpolation=cv2.INTER_AREA)
+        return np.nonzero(changed > self.threshold)
+
+    def encode(self, frame, quality: int = 95) -> bytes:
+        """CODEC_TILES payload of frame, a keyframe when it is due or the size changed
+        """
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        with self._lock:
+            now = time.monotonic()
+            if (self._reference is None or self._reference.shape != frame.shape
+                    or now - self._keyframe_time >= self.keyframe_interval):
+                self._reference = frame.copy()
+                self._keyframe_time = now
+                self.keyframes += 1
+                return pack(True, self.tile_width, self.tile_height, [(0, 0, cv2.imencode('.jpg', frame, params)[1].tobytes())])
+            tiles = []
+            for row, column in zip(*self.changed_tiles(frame)):
+                y, x = row * self.tile_height, column * self.tile_width
+                tile = frame[y:y + self.tile_height, x:x + self.tile_width]
+                self._reference[y:y + self.tile_height, x:x + self.tile_width] = tile
+                tiles.append((int(column), int(row), cv2.imencode('.jpg', tile, params)[1].tobytes()))
+            self.deltas += 1
+            self.tiles += len(tiles)
+            return pack(False, self.tile_width, self.tile_height, tiles)
+
+
+class TileCanvas:
+    """the rebuilt frame of one connection, only used from the writer thread
+    """
+
+    def __init__(self):
+        self.image = None
+
+    def apply(self, update: TileUpdate):
+        """paste a decoded update, returns the canvas (not a copy), None before the first keyframe
+        """
+        if update.keyframe:
+            self.image = update.tiles[0].image
+            return self.image
+        if self.image is None:
+            return None
+        for tile in update.tiles:
+            y, x = tile.row * update.tile_height, tile.column * update.tile_width
+            height, width = tile.image.shape[:2]
+            if tile.image.ndim != self.image.ndim or y + height > self.image.shape[0] or x + width > self.image.shape[1]:
+                continue  # does not fit, the frame size changed without a keyframe
+            self.image[y:y + height, x:x + width] = tile.image
+        return self.image
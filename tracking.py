@@ -0,0 +1,219 @@
+"""
+detect every N frames, track in between: boxes on every frame for a fraction of the detector's CPU
+
+the detector (face.DetectionPool) gets every detect_every-th frame, and an earlier one when a track
+loses confidence. on the other frames every box follows sparse optical flow: up to max_points
+corners inside the box (cv2.goodFeaturesToTrack), one cv2.calcOpticalFlowPyrLK forward and one
+backward for the corners of all boxes together, the median motion and scale of the corners that
+come back to where they started (forward-backward error below fb_threshold pixels) move the box.
+the share of such corners is the track's confidence. flow runs on a gray copy at most track_width
+pixels wide, the boxes stay in frame pixels.
+
+detections arrive a few frames late from the worker processes. every track keeps its boxes of the
+last `history` frames, a detection is matched by IoU against the boxes of the frame it was made on
+and moved by what the track moved since. unmatched detections start tracks with new ids, a track no
+detection confirmed max_misses times in a row is dropped.
+
+    track(frame) -> tracks                   every frame, also applies the detections that arrived
+    detection_due() -> bool                  send this frame (number `frame`) to the detector,
+    submitted()                              ... and say so once it was accepted
+    add_detection(frame, boxes, scores)      from any thread
+"""
+import collections
+import itertools
+from typing import List
+
+import numpy as np
+import cv2
+
+MIN_POINTS = 3  # tracked corners needed to move a box
+
+
+def iou(boxes_a, boxes_b):
+    """N x M intersection over union of two x1, y1, x2, y2 box arrays
+    """
+    boxes_a = np.asarray(boxes_a, np.float32).reshape(-1, 1, 4)
+    boxes_b = np.asarray(boxes_b, np.float32).reshape(1, -1, 4)
+    width = np.clip(np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0]), 0, None)
+    height = np.clip(np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1]), 0, None)
+    intersection = width * height
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-6)
+
+
+class Track:
+
+    def __init__(self, track_id: int, box, score: float, history: int):
+        self.id = track_id
+        self.box = np.asarray(box, np.float32)  # x1, y1, x2, y2 in frame pixels
+        self.score = float(score)  # of the last matching detection
+        self.confidence = 1.0  # share of the corners the last flow step kept
+        self.misses = 0  # detections in a row that did not match
+        self.history = collections.deque(maxlen=history)  # (frame, box)
+
+    def box_at(self, frame: int):
+        """the box on frame, the oldest one known for an earlier frame
+        """
+        for seen, box in reversed(self.history):
+            if seen <= frame:
+                return box
+        return self.history[0][1] if self.history else self.box
+
+
+class DetectionScheduler:
+    """one per camera, track() and detection_due() from the frame loop
+    """
+
+    def __init__(self,
+                 detect_every: int = 5,
+                 min_confidence: float = 0.5,
+                 iou_threshold: float = 0.3,
+                 max_misses: int = 2,
+                 max_points: int = 30,
+                 fb_threshold: float = 1.0,
+                 track_width: int = 320,
+                 history: int = 60):
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.max_points = max_points
+        self.fb_threshold = fb_threshold
+        self.track_width = track_width
+        self.history = history
+        self.tracks: List[Track] = []
+        self.frame = 0  # number of the last frame passed to track()
+        self.detections = 0  # frames sent to the detector
+        self._ids = itertools.count(1)
+        self._gray = None
+        self._scale = 1.0  # gray pixels per frame pixel
+        self._submitted_frame = -detect_every
+        self._pending = False  # a submitted detection has not arrived yet
+        self._detected_frame = 0  # the newest frame a detection was applied for
+        self._arrived = collections.deque()  # (frame, boxes, scores), appended from any thread
+
+    def add_detection(self, frame: int, boxes, scores) -> None:
+        """the detector's boxes for frame, applied on the next track()
+        """
+        self._arrived.append((frame, np.asarray(boxes, np.float32).reshape(-1, 4), np.asarray(scores, np.float32)))
+
+    def detection_due(self) -> bool:
+        if self.frame - self._submitted_frame >= self.detect_every:
+            return True
+        if self._pending or self.frame == self._submitted_frame:
+            return False
+        return any(track.confidence < self.min_confidence for track in self.tracks)
+
+    def submitted(self) -> None:
+        """the current frame went to the detector
+        """
+        self._submitted_frame = self.frame
+        self._pending = True
+        self.detections += 1
+
+    def detect_ratio(self) -> float:
+        return self.detections / max(self.frame, 1)
+
+    def stats(self) -> str:
+        return f'frames {self.frame} detections {self.detections} ({self.detect_ratio():.0%}) tracks {len(self.tracks)}'
+
+    def track(self, frame) -> List[Track]:
+        """move the tracks to frame, then apply the detections that arrived
+        """
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.track_width / width)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if scale < 1.0:
+            gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        if self._gray is not None and self._gray.shape == gray.shape and self.tracks:
+            self._flow(self._gray, gray)
+        self._gray = gray
+        self._scale = scale
+        self.frame += 1
+        self.tracks = [track for track in self.tracks
+                       if track.box[2] > 0 and track.box[3] > 0 and track.box[0] < width and track.box[1] < height]
+        for track in self.tracks:
+            track.history.append((self.frame, track.box.copy()))
+        while self._arrived:
+            self._apply(*self._arrived.popleft())
+        return list(self.tracks)
+
+    def _flow(self, previous, gray) -> None:
+        height, width = previous.shape
+        points, owners = [], []
+        for index, track in enumerate(self.tracks):
+            x1, y1, x2, y2 = np.round(track.box * self._scale).astype(int)
+            x1, y1, x2, y2 = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+            corners = None
+            if x2 - x1 >= 4 and y2 - y1 >= 4:
+                corners = cv2.goodFeaturesToTrack(previous[y1:y2, x1:x2], self.max_points, 0.01, 2)
+            if corners is None:
+                track.confidence = 0.0
+                continue
+            points.append(corners.reshape(-1, 2) + (x1, y1))
+            owners.append(np.full(len(points[-1]), index))
+        if not points:
+            return
+        points = np.concatenate(points).astype(np.float32)
+        owners = np.concatenate(owners)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(previous, gray, points, None, winSize=(15, 15), maxLevel=2)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, previous, moved, None, winSize=(15, 15), maxLevel=2)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+            (np.linalg.norm(back - points, axis=1) < self.fb_threshold)
+        for index in np.unique(owners):
+            track = self.tracks[index]
+            mine = owners == index
+            kept = mine & good
+            track.confidence = kept.sum() / mine.sum()
+            if kept.sum() < MIN_POINTS:
+                continue  # the box stays, a detection is due
+            before, after = points[kept], moved[kept]
+            shift = np.median(after - before, axis=0) / self._scale
+            spread_before = np.linalg.norm(before - before.mean(axis=0), axis=1)
+            spread_after = np.linalg.norm(after - after.mean(axis=0), axis=1)
+            spread = spread_before > 1
+            zoom = float(np.median(spread_after[spread] / spread_before[spread])) if spread.sum() >= 2 else 1.0
+            zoom = min(max(zoom, 0.8), 1.25)
+            center = (track.box[:2] + track.box[2:]) / 2 + shift
+            half = (track.box[2:] - track.box[:2]) / 2 * zoom
+            track.box = np.concatenate([center - half, center + half]).astype(np.float32)
+
+    def _apply(self, frame: int, boxes, scores) -> None:
+        if frame >= self._submitted_frame:
+            self._pending = False
+        if frame <= self._detected_frame:
+            return  # an older detection than one already applied
+        self._detected_frame = frame
+        matched_detections = set()
+        if self.tracks and len(boxes):
+            then = np.stack([track.box_at(frame) for track in self.tracks])
+            overlap = iou(then, boxes)
+            # greedy, best overlap first
+            for flat in np.argsort(overlap, axis=None)[::-1]:
+                track_index, detection_index = np.unravel_index(flat, overlap.shape)
+                if overlap[track_index, detection_index] < self.iou_threshold:
+                    break
+                track = self.tracks[track_index]
+                if track.misses < 0 or detection_index in matched_detections:
+                    continue
+                # the detection is `frame` old, move it by what the track moved since
+                correction = boxes[detection_index] - then[track_index]
+                track.box = track.box + correction
+                for entry, (seen, box) in enumerate(track.history):  # the next late detection compares to these
+                    track.history[entry] = (seen, box + correction)
+                track.score = float(scores[detection_index]) if len(scores) > detection_index else 0.0
+                track.confidence = 1.0
+                track.misses = -1  # matched in this round
+                matched_detections.add(detection_index)
+        kept = []
+        for track in self.tracks:
+            track.misses = 0 if track.misses < 0 else track.misses + 1
+            if track.misses < self.max_misses:
+                kept.append(track)
+        for index, box in enumerate(boxes):
+            if index not in matched_detections:
+                track = Track(next(self._ids), box, scores[index] if len(scores) > index else 0.0, self.history)
+                track.history.append((frame, track.box.copy()))
+                kept.append(track)
+        self.tracks = kept
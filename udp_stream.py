@@ -0,0 +1,453 @@
+"""
+UDP transport for pi_cam_stream_client.py -> pi_cam_stream_server.py, for a live view that must not lag
+
+over TCP one lost packet holds back every frame behind it until it is retransmitted. here every
+message of frame_protocol (HELLO, FRAME, ACK, FRAME_ACK) travels as it would over TCP, a FRAME is
+split into datagrams of at most fragment_bytes:
+
+    magic        4s  b'PCUD'
+    frame id     I   +1 per frame
+    index        H   of this fragment
+    count        H   fragments of the frame
+    then the next bytes of header(28) + payload
+
+the server puts the fragments back together and gives up on a frame that is not complete within
+`deadline` seconds or once a newer frame is complete, a lost datagram costs one frame and never
+delays the next one. every report_interval seconds it tells the client how much got lost:
+
+    REPORT  magic(4) completed(4) dropped(4) loss(f)    <-    server
+
+loss is the fraction of the fragments that did not arrive, the client's rate control steps down
+on the fraction of the frames dropped like on ack lag. HELLO is repeated until the ACK arrives, there is no legacy fallback.
+
+    open_connection          client side, (reader, writer, version) like asyncio.open_connection
+                             + frame_protocol.negotiate, the reader yields the FRAME_ACKs
+    DatagramIngestProtocol   server side, one session per client address, same session_factory
+                             as ingest.FrameIngestProtocol
+    create_server            binds the server socket, reads every datagram that is waiting per event
+                             loop wakeup (asyncio's datagram transport reads one, ~180 for a 250KB frame)
+    Reassembler              fragments -> frames, no IO, one per client
+
+loss= drops that fraction of the datagrams on purpose, to try the mode on loopback.
+"""
+import asyncio
+import random
+import socket
+import struct
+import time
+from typing import NamedTuple
+
+import frame_protocol
+
+DATAGRAM_MAGIC = b'PCUD'
+REPORT_MAGIC = b'PCRP'
+DATAGRAM_STRUCT = struct.Struct('!4sIHH')
+REPORT_STRUCT = struct.Struct('!4sIIf')
+
+FRAGMENT_BYTES = 1400  # + 12 + 28 (UDP/IP) bytes stays under a 1500 byte MTU
+HELLO_INTERVAL = 0.5  # seconds between HELLOs until the ACK arrives
+MAX_DATAGRAM_BYTES = 65535
+READ_BATCH = 256  # datagrams per wakeup at most, the other callbacks of the loop get their turn
+
+
+class Report(NamedTuple):
+    completed: int  # frames since the last report
+    dropped: int  # incomplete at the deadline, or overtaken by a newer frame
+    loss: float  # fraction of the fragments that did not arrive
+
+
+def _newer(frame_id: int, than: int) -> bool:
+    return 0 < frame_protocol.seq_gap(than, frame_id) < frame_protocol.SEQ_MODULO // 2
+
+
+class _Partial:
+
+    def __init__(self, count, now):
+        self.count = count
+        self.first_seen = now
+        self.chunks = {}
+
+
+class Reassembler:
+    """add() datagrams, a complete frame comes back as bytes (header + payload), expire() drops the late ones
+    """
+
+    def __init__(self, deadline: float = 0.2):
+        self.deadline = deadline
+        self.completed = 0
+        self.dropped = 0
+        self.late = 0  # fragments of frames that were already given up or delivered
+        self._partial = {}  # frame id -> _Partial
+        self._last = None  # frame id of the last frame delivered or given up
+        self._expected = 0  # fragments of the finished frames, for the loss rate
+        self._received = 0
+        self._window = (0, 0)  # completed, dropped at the last report
+
+    def add(self, datagram, now: float = None):
+        if len(datagram) < DATAGRAM_STRUCT.size:
+            return None
+        magic, frame_id, index, count = DATAGRAM_STRUCT.unpack_from(datagram)
+        if magic != DATAGRAM_MAGIC or index >= count:
+            return None
+        if self._last is not None and not _newer(frame_id, self._last):
+            self.late += 1
+            return None
+        now = time.monotonic() if now is None else now
+        partial = self._partial.get(frame_id)
+        if partial is None:
+            partial = self._partial[frame_id] = _Partial(count, now)
+        partial.chunks[index] = bytes(memoryview(datagram)[DATAGRAM_STRUCT.size:])
+        if len(partial.chunks) < partial.count:
+            return None
+        # older frames would arrive out of order, the newest one wins
+        older = [older for older in self._partial if _newer(frame_id, older)]
+        for older in sorted(older, key=lambda older: frame_protocol.seq_gap(older, frame_id), reverse=True):
+            self._give_up(older)
+        del self._partial[frame_id]
+        self._finish(frame_id, partial)
+        self.completed += 1
+        return b''.join(partial.chunks[index] for index in range(partial.count))
+
+    def expire(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        for frame_id in [frame_id for frame_id, partial in self._partial.items() if now - partial.first_seen > self.deadline]:
+            self._give_up(frame_id)
+
+    def _give_up(self, frame_id):
+        partial = self._partial.pop(frame_id)
+        self._finish(frame_id, partial)
+        self.dropped += 1
+
+    def _finish(self, frame_id, partial):
+        if self._last is not None and _newer(frame_id, self._last):
+            # frames of which not a single fragment arrived, assume they were as large as this one
+            missing = frame_protocol.seq_gap(self._last, frame_id) - 1
+            self._expected += missing * partial.count
+            self.dropped += missing
+        if self._last is None or _newer(frame_id, self._last):
+            self._last = frame_id
+        self._expected += partial.count
+        self._received += len(partial.chunks)
+
+    def report(self) -> Report:
+        """counters since the last report
+        """
+        completed, dropped = self._window
+        loss = 1 - self._received / self._expected if self._expected else 0.0
+        report = Report(self.completed - completed, self.dropped - dropped, loss)
+        self._window = (self.completed, self.dropped)
+        self._expected = self._received = 0
+        return report
+
+
+def pack_report(report: Report) -> bytes:
+    return REPORT_STRUCT.pack(REPORT_MAGIC, *report)
+
+
+def fragments(frame_id: int, message, fragment_bytes: int = FRAGMENT_BYTES):
+    """the datagrams of one message (frame header + payload)
+    """
+    message = memoryview(message)
+    count = max(1, -(-len(message) // fragment_bytes))
+    for index in range(count):
+        chunk = message[index * fragment_bytes:(index + 1) * fragment_bytes]
+        yield DATAGRAM_STRUCT.pack(DATAGRAM_MAGIC, frame_id % frame_protocol.SEQ_MODULO, index, count) + chunk
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, reader: asyncio.StreamReader, on_report=None):
+        self.reader = reader
+        self.on_report = on_report
+        self.ack = asyncio.get_event_loop().create_future()
+        self.transport = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        magic = data[:4]
+        if magic == frame_protocol.FRAME_ACK_MAGIC:
+            self.reader.feed_data(data)
+        elif magic == REPORT_MAGIC and len(data) == REPORT_STRUCT.size:
+            if self.on_report is not None:
+                self.on_report(Report(*REPORT_STRUCT.unpack(data)[1:]))
+        elif magic == frame_protocol.ACK_MAGIC and len(data) == frame_protocol.ACK_STRUCT.size and not self.ack.done():
+            self.ack.set_result(frame_protocol.ACK_STRUCT.unpack(data)[1])
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the server is gone
+        self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.reader.feed_eof()
+        self.can_write.set()
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+class DatagramWriter:
+    """the part of asyncio.StreamWriter the client uses, write() takes whole frame_protocol messages
+    """
+
+    def __init__(self, transport, protocol: _ClientProtocol, fragment_bytes: int = FRAGMENT_BYTES, loss: float = 0.0):
+        self.transport = transport
+        self._protocol = protocol
+        self.fragment_bytes = fragment_bytes
+        self.loss = loss
+        self.frame_id = 0
+        self._pending = bytearray()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def write(self, data) -> None:
+        """buffers until a whole FRAME (header + payload) is there, then sends it
+        """
+        self._pending += data
+        while len(self._pending) >= frame_protocol.HEADER_SIZE:
+            length = frame_protocol.HEADER_SIZE + frame_protocol.unpack_header(self._pending).length
+            if len(self._pending) < length:
+                return
+            self._send(memoryview(self._pending)[:length])
+            del self._pending[:length]
+
+    def _send(self, message):
+        if self.transport.is_closing():
+            return
+        for datagram in fragments(self.frame_id, message, self.fragment_bytes):
+            if self.loss and random.random() < self.loss:
+                continue  # injected loss
+            self.transport.sendto(datagram)
+        self.frame_id += 1
+
+    async def drain(self) -> None:
+        if self.transport.is_closing():
+            raise ConnectionResetError('datagram transport closed')
+        await self._protocol.can_write.wait()
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+async def open_connection(host: str,
+                          port: int,
+                          camera_id: str,
+                          version: int = frame_protocol.PROTOCOL_VERSION,
+                          fragment_bytes: int = FRAGMENT_BYTES,
+                          loss: float = 0.0,
+                          on_report=None,
+                          timeout: float = frame_protocol.NEGOTIATE_TIMEOUT):
+    """HELLO until the server answers, returns (reader, writer, agreed version)
+
+    raises ConnectionError when there is no ACK within timeout
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: _ClientProtocol(reader, on_report),
+                                                              remote_addr=(host, port))
+    hello = frame_protocol.pack_hello(version, camera_id)
+    deadline = loop.time() + timeout
+    while not protocol.ack.done() and not transport.is_closing() and loop.time() < deadline:
+        transport.sendto(hello)
+        try:
+            await asyncio.wait_for(asyncio.shield(protocol.ack), min(HELLO_INTERVAL, max(0.0, deadline - loop.time())))
+        except asyncio.TimeoutError:
+            pass
+    if not protocol.ack.done():
+        transport.abort()
+        raise ConnectionError(f'no answer from udp {host}:{port}')
+    return reader, DatagramWriter(transport, protocol, fragment_bytes, loss), protocol.ack.result()
+
+
+class _PeerTransport:
+    """what a session sees of the datagram endpoint, acks go back to its own client
+    """
+
+    def __init__(self, transport, addr):
+        self._transport = transport
+        self._addr = addr
+        self.paused = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._addr
+        return self._transport.get_extra_info(name, default)
+
+    def write(self, data) -> None:
+        self._transport.sendto(data, self._addr)
+
+    def pause_reading(self) -> None:
+        self.paused = True  # a datagram cannot wait, frames are dropped meanwhile
+
+    def resume_reading(self) -> None:
+        self.paused = False
+
+
+class _Peer:
+
+    def __init__(self, transport, addr, deadline):
+        self.transport = _PeerTransport(transport, addr)
+        self.reassembler = Reassembler(deadline)
+        self.session = None
+        self.last_seen = time.monotonic()
+
+
+class DatagramIngestProtocol(asyncio.DatagramProtocol):
+    """one session per client address, session_factory(transport, camera_id, version) as for
+    ingest.FrameIngestProtocol, sessions of clients that went quiet for peer_timeout seconds are closed
+    """
+
+    def __init__(self,
+                 session_factory,
+                 deadline: float = 0.2,
+                 report_interval: float = 1.0,
+                 peer_timeout: float = 10.0,
+                 loss: float = 0.0):
+        self._session_factory = session_factory
+        self.deadline = deadline
+        self.report_interval = report_interval
+        self.peer_timeout = peer_timeout
+        self.loss = loss
+        self._peers = {}
+        self._transport = None
+        self._timer = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._timer = asyncio.get_event_loop().call_later(self.report_interval, self._tick)
+
+    def connection_lost(self, exc):
+        if self._timer is not None:
+            self._timer.cancel()
+        for addr in list(self._peers):
+            self._close_peer(addr)
+
+    def datagram_received(self, data, addr):
+        if self.loss and random.random() < self.loss:
+            return  # injected loss
+        peer = self._peers.get(addr)
+        if data[:4] == frame_protocol.HELLO_MAGIC:
+            self._hello(data, addr, peer)
+            return
+        if peer is None or peer.session is None:
+            return  # no HELLO yet, or it was lost
+        peer.last_seen = time.monotonic()
+        peer.reassembler.expire(peer.last_seen)
+        message = peer.reassembler.add(data, peer.last_seen)
+        if message is None or peer.transport.paused:
+            return
+        try:
+            header = frame_protocol.unpack_header(message)
+        except (frame_protocol.ProtocolError, struct.error) as err:
+            print(f'Client {addr}: bad datagram frame -> {err}')
+            return
+        if len(message) - frame_protocol.HEADER_SIZE != header.length:
+            return
+        peer.session.on_frame(header, memoryview(message)[frame_protocol.HEADER_SIZE:])
+
+    def _hello(self, data, addr, peer):
+        try:
+            client_version, camera_id = frame_protocol.unpack_hello(data)
+        except (frame_protocol.ProtocolError, struct.error, IndexError) as err:
+            print(f'Client {addr}: bad udp HELLO -> {err}')
+            return
+        version = min(client_version, frame_protocol.PROTOCOL_VERSION)
+        if peer is None or peer.session is None or peer.session.camera_id != camera_id:
+            if peer is not None:
+                self._close_peer(addr)
+            peer = self._peers[addr] = _Peer(self._transport, addr, self.deadline)
+            peer.session = self._session_factory(peer.transport, camera_id, version)
+            print(f'Client {addr}: camera {camera_id}, {frame_protocol.describe(version)} framing over udp')
+        peer.last_seen = time.monotonic()
+        # a repeated HELLO means the ACK got lost, answer again
+        self._transport.sendto(frame_protocol.ACK_STRUCT.pack(frame_protocol.ACK_MAGIC, version), addr)
+
+    def _close_peer(self, addr):
+        peer = self._peers.pop(addr)
+        if peer.session is not None:
+            peer.session.close()
+            print(f'Client {addr}: udp {peer.reassembler.completed} frames, {peer.reassembler.dropped} dropped, '
+                  f'{peer.reassembler.late} late fragments')
+
+    def _tick(self):
+        now = time.monotonic()
+        for addr, peer in list(self._peers.items()):
+            if now - peer.last_seen > self.peer_timeout:
+                self._close_peer(addr)
+                continue
+            peer.reassembler.expire(now)
+            self._transport.sendto(pack_report(peer.reassembler.report()), addr)
+        self._timer = asyncio.get_event_loop().call_later(self.report_interval, self._tick)
+
+
+class _BatchDatagramTransport(asyncio.BaseTransport):
+    """a non-blocking UDP socket read with add_reader, all pending datagrams per wakeup
+    """
+
+    def __init__(self, loop, sock: socket.socket, protocol: asyncio.DatagramProtocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._closing = False
+        self._extra = {'socket': sock, 'sockname': sock.getsockname()}
+        loop.add_reader(sock.fileno(), self._read_ready)
+        protocol.connection_made(self)
+
+    def _read_ready(self):
+        for _ in range(READ_BATCH):
+            try:
+                data, addr = self._sock.recvfrom(MAX_DATAGRAM_BYTES)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                self._protocol.error_received(err)
+                return
+            self._protocol.datagram_received(data, addr)
+
+    def sendto(self, data, addr) -> None:
+        """acks and reports are small, one that does not fit in the socket buffer is dropped like a lost datagram
+        """
+        if self._closing:
+            return
+        try:
+            self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as err:
+            self._protocol.error_received(err)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self) -> None:
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._protocol.connection_lost(None)
+
+
+async def create_server(protocol_factory, host: str, port: int, reuse_port: bool = False, receive_buffer_bytes: int = None):
+    """bind host:port, returns the transport, close() it to stop
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if receive_buffer_bytes is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_bytes)
+        sock.bind((host, port))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return _BatchDatagramTransport(asyncio.get_running_loop(), sock, protocol_factory())